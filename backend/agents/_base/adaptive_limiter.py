@@ -0,0 +1,281 @@
+"""
+Vertex AI のクォータに合わせた同時実行数の自動調整（AIMD）
+
+Vertex AI のクォータ（1分あたりのリクエスト数・トークン数）を超えると、
+実行中のチャットがまとめて 429（RESOURCE_EXHAUSTED）で失敗し、
+ユーザーの再送でさらに負荷が増える悪循環になります。
+
+このモジュールは、プロセス全体で LLM の同時呼び出し数（limit）を自動で調整します。
+- 成功するたびに limit を少しずつ増やす（limit 回成功するごとに +1 = 加算的増加）
+- クォータ超過のたびに limit を半分にする（乗算的減少）
+→ 同時呼び出し数がクォータの少し手前で落ち着き、失敗と回復を繰り返さない。
+
+【再試行】
+クォータ超過・一時的な障害（503）は、ランダムな待ち時間（ジッター付き指数バックオフ）を
+置いて数回まで再試行する。ただし締め切り（deadline）までに終わらない待ち時間なら再試行しない。
+
+【使い方】
+    limiter = get_llm_limiter()
+    response = await limiter.call(lambda: llm.ainvoke(messages), deadline=deadline)
+
+【処理時間】
+枠が空くまでの待ち時間はリクエストの queue、LLM の応答待ち（再試行を含む）は llm の段階に加える（common/timing.py）。
+
+【注意】
+インスタンス内でのみ有効（インスタンスごとに独立して調整する）。
+ChatVertexAI 自身の再試行（最大6回・数十秒）は締め切りを超えてしまうため、
+llm_pool では無効にしてここで再試行する。
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from langchain_core.runnables import RunnableConfig
+
+from common.config import config
+from common.timing import add_duration, timed
+
+logger = logging.getLogger(__name__)
+
+
+class LimiterTimeout(Exception):
+    """締め切りまでに LLM を呼び出せなかった"""
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """クォータ超過（429 / RESOURCE_EXHAUSTED）のエラーか"""
+    return getattr(error, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_unavailable_error(error: BaseException) -> bool:
+    """一時的な障害（503 / UNAVAILABLE）のエラーか"""
+    return getattr(error, "code", None) == 503 or "UNAVAILABLE" in str(error)
+
+
+def get_llm_deadline(config: RunnableConfig | None) -> float | None:
+    """
+    実行時の設定から LLM 呼び出しの締め切り（time.monotonic() の値）を取り出す
+
+    応答後のチェックポイントの保存の時間を残すため、全体の締め切りより少し早い（base_agent 参照）。
+    """
+    configurable = (config or {}).get("configurable") or {}
+    return configurable.get("llm_deadline", configurable.get("deadline"))
+
+
+def _wake(future: asyncio.Future) -> None:
+    """待っているイベントループ上で空きができたことを通知"""
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD による同時実行数の制限（スレッドセーフ）
+
+    Attributes:
+        limit: 現在の同時実行数の上限（小数。実際の上限は切り捨てた値）
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = 16,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        decrease_factor: float = 0.5,
+        max_attempts: int = 3,
+        base_backoff: float = 0.5,
+        max_backoff: float = 8.0,
+    ):
+        """
+        Args:
+            initial_limit: 最初の同時実行数
+            min_limit: 同時実行数の下限
+            max_limit: 同時実行数の上限
+            decrease_factor: クォータ超過のときに掛ける値
+            max_attempts: 1回の呼び出しあたりの最大試行回数（最初の1回を含む）
+            base_backoff: 再試行の待ち時間の基準（秒）。試行ごとに2倍になる
+            max_backoff: 再試行の待ち時間の上限（秒）
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._in_flight = 0
+        self._waiters: deque = deque()      # 到着順の (イベントループ, Future)
+        self._last_decrease_at = 0.0
+        self._lock = threading.Lock()
+
+        self.successes = 0
+        self.quota_errors = 0
+        self.retries = 0
+        self.decreases = 0
+
+    # ----- 枠の確保・解放 -----
+
+    async def _acquire(self, deadline: float | None) -> None:
+        """枠を1つ確保（空くまで待つ）"""
+        with self._lock:
+            if self._in_flight < int(self.limit) and not self._waiters:
+                self._in_flight += 1
+                return
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    granted = False
+                else:
+                    granted = True
+            if granted:
+                # 取り消しと同時に枠を譲られた場合は、その枠を次の人に譲る
+                self._release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise LimiterTimeout() from None
+            raise
+
+    def _release(self) -> None:
+        """枠を解放（上限に余裕があれば、待っている人に譲る）"""
+        with self._lock:
+            self._in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        """上限まで待っている人を起こす（self._lock を取った状態で呼ぶ）"""
+        while self._waiters and self._in_flight < int(self.limit):
+            loop, future = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # 待っていたイベントループが既に閉じている
+                continue
+            self._in_flight += 1
+
+    # ----- 上限の調整 -----
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self.successes += 1
+            # limit 回成功すると +1
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._wake_waiters()
+
+    def _on_quota_error(self, started_at: float) -> None:
+        with self._lock:
+            self.quota_errors += 1
+            # 前回減らす前に送ったリクエストの失敗では減らさない
+            # （同時に失敗した複数のリクエストで、何度も半分にしないため）
+            if started_at < self._last_decrease_at:
+                return
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease_at = time.monotonic()
+            self.decreases += 1
+        logger.warning(f"Vertex AI のクォータ超過: 同時呼び出し数の上限を {self.limit:.1f} に下げます")
+
+    def _backoff(self, attempt: int) -> float:
+        """再試行までの待ち時間（0〜上限のランダム: 再試行が同時に集中しないように）"""
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    # ----- 呼び出し -----
+
+    async def call(self, func: Callable[[], Awaitable[Any]], deadline: float | None = None) -> Any:
+        """
+        枠を確保して func() を呼び出す（クォータ超過・一時的な障害は再試行）
+
+        Args:
+            func: LLM を呼び出す関数（再試行のたびに呼ばれる）
+            deadline: 締め切り（time.monotonic() の値）。None なら無制限
+
+        Returns:
+            func() の戻り値
+
+        Raises:
+            LimiterTimeout: 締め切りまでに枠が空かなかった・応答が返らなかった
+            その他: func() の例外（再試行しても成功しなかった場合は最後の例外）
+        """
+        for attempt in range(self.max_attempts):
+            queued_at = time.monotonic()
+            try:
+                await self._acquire(deadline)
+            finally:
+                add_duration("queue", time.monotonic() - queued_at)
+            started_at = time.monotonic()
+            timeout = None if deadline is None else deadline - started_at
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise LimiterTimeout()
+                # 締め切りを過ぎたら LLM の応答を待たずに打ち切る
+                with timed("llm"):
+                    result = await asyncio.wait_for(func(), timeout)
+            except (LimiterTimeout, asyncio.TimeoutError):
+                self._release()
+                raise LimiterTimeout() from None
+            except asyncio.CancelledError:
+                # クライアントの切断などで実行を取り消された
+                self._release()
+                raise
+            except Exception as e:
+                self._release()
+                quota = is_quota_error(e)
+                if not quota and not is_unavailable_error(e):
+                    raise
+                if quota:
+                    self._on_quota_error(started_at)
+
+                wait_seconds = self._backoff(attempt)
+                last_attempt = attempt + 1 >= self.max_attempts
+                if last_attempt or (deadline is not None and time.monotonic() + wait_seconds >= deadline):
+                    raise
+                with self._lock:
+                    self.retries += 1
+                await asyncio.sleep(wait_seconds)
+                continue
+
+            self._release()
+            self._on_success()
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "successes": self.successes,
+                "quota_errors": self.quota_errors,
+                "retries": self.retries,
+                "decreases": self.decreases,
+            }
+
+
+# プロセス全体で共有するリミッター（Vertex AI のクォータはプロジェクト単位のため）
+_default_limiter: AdaptiveLimiter | None = None
+_default_lock = threading.Lock()
+
+
+def get_llm_limiter() -> AdaptiveLimiter:
+    """共有のリミッターを取得（設定は環境変数 LLM_CONCURRENCY_*）"""
+    global _default_limiter
+    if _default_limiter is None:
+        with _default_lock:
+            if _default_limiter is None:
+                _default_limiter = AdaptiveLimiter(
+                    initial_limit=config.LLM_CONCURRENCY_INITIAL,
+                    min_limit=config.LLM_CONCURRENCY_MIN,
+                    max_limit=config.LLM_CONCURRENCY_MAX,
+                    max_attempts=config.LLM_RETRY_MAX_ATTEMPTS,
+                )
+    return _default_limiter
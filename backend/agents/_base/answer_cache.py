@@ -0,0 +1,158 @@
+"""
+意味の近い質問への回答キャッシュ（FAQ 向け）
+
+「返品できますか？」「返品は可能でしょうか」のように、
+言い回しが違うだけの同じ質問に、LLM を呼ばずに前回の回答を返します。
+
+【仕組み】
+1. 質問を正規化（全角半角・大文字小文字・空白の違いをなくす）
+2. 正規化した質問が完全に一致すれば、そのまま回答を返す（埋め込みの計算も不要）
+3. 一致しなければ埋め込みベクトルを計算し、保存済みの質問すべてとの類似度を一度に計算
+4. 類似度が閾値（顧客ごとに設定可能）以上の質問があれば、その回答を返す
+
+【有効期限と削除】
+- ttl_seconds を過ぎた回答は使わない（情報が古くなるため）
+- 上限件数に達したら、最も長く使われていない回答から置き換える
+- システムプロンプトが変わったら全て削除する（回答の前提が変わるため）
+"""
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+# 文末の記号は意味を変えないので取り除く
+_TRAILING_PUNCTUATION = re.compile(r"[?？!！。．.、,，\s]+$")
+
+
+def normalize_question(text: str) -> str:
+    """質問を正規化（NFKC・小文字化・空白の統一・文末記号の除去）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+class SemanticAnswerCache:
+    """
+    質問の埋め込みで検索する回答キャッシュ（スレッドセーフ）
+
+    エージェント1つ（＝顧客1つ）につき1つ作成する（顧客内のユーザー間では回答を共有する）。
+
+    Attributes:
+        hits: キャッシュの回答を返した回数
+        misses: 見つからなかった回数
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 86400):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._prompt_hash = None
+        self._clear()
+
+    def _clear(self) -> None:
+        self._vectors: np.ndarray | None = None   # 質問の埋め込み（正規化済み, 件数 × 次元）
+        self._created_at = np.zeros(self.max_entries)
+        self._last_used = np.zeros(self.max_entries)
+        self._questions: list[str | None] = [None] * self.max_entries
+        self._answers: list[str | None] = [None] * self.max_entries
+        self._slots: dict[str, int] = {}          # 正規化した質問 → 位置
+        self._size = 0
+
+    def _check_prompt(self, system_prompt: str) -> None:
+        """システムプロンプトが変わっていたら全て削除（self._lock を取った状態で呼ぶ）"""
+        prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+        if prompt_hash != self._prompt_hash:
+            self._clear()
+            self._prompt_hash = prompt_hash
+
+    def _valid(self, now: float) -> np.ndarray:
+        """使用中かつ期限内の位置"""
+        return (self._created_at[:self._size] > now - self.ttl_seconds)
+
+    def lookup_exact(self, question: str, system_prompt: str) -> str | None:
+        """正規化した質問が完全に一致する回答を返す（埋め込み不要）"""
+        now = time.time()
+        with self._lock:
+            self._check_prompt(system_prompt)
+            slot = self._slots.get(question)
+            if slot is None or self._created_at[slot] <= now - self.ttl_seconds:
+                return None
+            self._last_used[slot] = now
+            self.hits += 1
+            return self._answers[slot]
+
+    def lookup(self, question: str, vector: np.ndarray, threshold: float, system_prompt: str) -> str | None:
+        """
+        意味の近い質問の回答を返す
+
+        Args:
+            question: 正規化した質問
+            vector: 質問の埋め込みベクトル
+            threshold: この類似度以上なら同じ質問とみなす（0〜1）
+            system_prompt: 現在のシステムプロンプト（変わっていたらキャッシュを破棄）
+
+        Returns:
+            キャッシュの回答。見つからなければ None
+        """
+        now = time.time()
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            self._check_prompt(system_prompt)
+            if self._size == 0 or self._vectors.shape[1] != len(query):
+                self.misses += 1
+                return None
+            scores = self._vectors[:self._size] @ query
+            scores[~self._valid(now)] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            return self._answers[best]
+
+    def store(self, question: str, vector: np.ndarray, answer: str, system_prompt: str) -> None:
+        """回答を保存（上限に達していたら、期限切れか最も長く使われていないものと置き換える）"""
+        now = time.time()
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        with self._lock:
+            self._check_prompt(system_prompt)
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._clear()
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+
+            slot = self._slots.get(question)
+            if slot is None:
+                if self._size < self.max_entries:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    # 期限切れは last_used に関係なく先に置き換える
+                    priority = np.where(self._valid(now), self._last_used, -1.0)
+                    slot = int(np.argmin(priority))
+                    self._slots.pop(self._questions[slot], None)
+
+            self._vectors[slot] = vector
+            self._questions[slot] = question
+            self._answers[slot] = answer
+            self._created_at[slot] = now
+            self._last_used[slot] = now
+            self._slots[question] = slot
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -6,11 +6,34 @@ AIエージェント基底クラス
 
 新しいエージェントを作る場合は _template/ をコピーしてください。
 """
+import asyncio
+import logging
+import time
+import uuid
 from abc import ABC, abstractmethod
 from typing import AsyncGenerator
+from langchain_core.messages import RemoveMessage
 from langgraph.graph import StateGraph
 from langgraph.checkpoint.base import BaseCheckpointSaver
 
+from common.timing import add_duration
+from .scheduler import PRIORITY_INTERACTIVE, FairScheduler, get_scheduler
+from .token_budget import content_text
+
+logger = logging.getLogger(__name__)
+
+# 内部処理用の LLM 呼び出し（要約など）に付けるタグ
+# このタグが付いた呼び出しの出力は、ユーザーへの応答としてストリーミングしない
+# 例: await self.llm.ainvoke(prompt, config={"tags": [INTERNAL_LLM_TAG]})
+INTERNAL_LLM_TAG = "internal"
+
+# LLM を使わずに応答するノード（回答キャッシュなど）が、応答の本文を送るイベント名
+# 例: await adispatch_custom_event(RESPONSE_EVENT, {"text": answer}, config=config)
+RESPONSE_EVENT = "agent_response"
+
+# 締め切りがある場合に、LLM の応答後のチェックポイントの保存に残しておく秒数
+CHECKPOINT_RESERVE_SECONDS = 2.0
+
 
 class BaseAgent(ABC):
     """
@@ -19,13 +42,18 @@ class BaseAgent(ABC):
     すべてのエージェントはこのクラスを継承して実装します。
     """
 
-    def __init__(self, checkpointer: BaseCheckpointSaver = None):
+    # 顧客ID（スケジューラーで顧客ごとの順番待ちを分けるのに使う）
+    customer_id: str = None
+
+    def __init__(self, checkpointer: BaseCheckpointSaver = None, scheduler: FairScheduler = None):
         """
         Args:
             checkpointer: 状態を永続化するためのチェックポインター
                           Firestoreを使う場合はFirestoreCheckpointerを渡す
+            scheduler: 実行の順番待ち（省略時はプロセス共有のスケジューラー）
         """
         self.checkpointer = checkpointer
+        self.scheduler = scheduler or get_scheduler()
         self._graph = None
 
     @abstractmethod
@@ -70,43 +98,153 @@ class BaseAgent(ABC):
         Args:
             user_input: ユーザーからの入力メッセージ
             thread_id: 会話スレッドID（会話履歴の管理に使用）
-            **kwargs: 追加のパラメータ
+            **kwargs: 追加のパラメータ（callbacks: LangChain のコールバック,
+                      deadline: 締め切り（time.monotonic() の値））
 
         Yields:
             str: エージェントからの応答（トークン単位）
         """
-        # 設定を作成
+        config, state = self._prepare_run(
+            user_input, thread_id, kwargs.get("callbacks"), kwargs.get("deadline")
+        )
+
+        # ストリーミング実行
+        try:
+            async for event in self.graph.astream_events(state, config, version="v2"):
+                # AIのテキスト出力をストリーミング
+                if event["event"] == "on_chat_model_stream":
+                    if INTERNAL_LLM_TAG in event.get("tags", []):
+                        continue
+                    chunk = event["data"]["chunk"]
+                    if hasattr(chunk, "content") and chunk.content:
+                        yield chunk.content
+                elif event["event"] == "on_custom_event" and event["name"] == RESPONSE_EVENT:
+                    yield event["data"]["text"]
+        except asyncio.CancelledError:
+            await self._discard_unanswered_input(thread_id, state)
+            raise
+
+    def _prepare_run(
+        self, user_input: str, thread_id: str, callbacks=None, deadline: float = None
+    ) -> tuple[dict, dict]:
+        """実行時の設定と入力状態を作成"""
         config = {"configurable": {"thread_id": thread_id}}
+        if deadline is not None:
+            # チェックポイントの読み書きと LLM の呼び出しを締め切り内に収めるために参照する
+            # LLM の締め切りは、応答後の保存の時間を残して少し早くする
+            config["configurable"]["deadline"] = deadline
+            config["configurable"]["llm_deadline"] = deadline - CHECKPOINT_RESERVE_SECONDS
+        if callbacks:
+            config["callbacks"] = callbacks
 
-        # 入力を準備
         state = self.get_initial_state()
-        state["messages"] = [{"role": "user", "content": user_input}]
+        # ID を先に決めておく（取り消された場合にチェックポイントから取り除くため）
+        state["messages"] = [{"role": "user", "content": user_input, "id": str(uuid.uuid4())}]
+        return config, state
 
-        # ストリーミング実行
-        async for event in self.graph.astream_events(state, config, version="v2"):
-            # AIのテキスト出力をストリーミング
-            if event["event"] == "on_chat_model_stream":
-                chunk = event["data"]["chunk"]
-                if hasattr(chunk, "content") and chunk.content:
-                    yield chunk.content
+    async def _discard_unanswered_input(self, thread_id: str, state: dict) -> None:
+        """
+        取り消された実行の入力（応答のないユーザー発言）をチェックポイントから取り除く
+
+        入力は最初のステップで保存されるため、応答の前に取り消される（クライアントの切断・締め切り）と、
+        応答のないユーザー発言が会話に残る。再送されると同じ質問が2回並んでしまう。
+        応答まで保存済みの場合は何もしない。
+        """
+        message_id = state["messages"][0]["id"]
+        # 締め切りは付けない（締め切りで取り消された場合も取り除く）
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            snapshot = await self.graph.aget_state(config)
+            messages = snapshot.values.get("messages") or []
+            if messages and messages[-1].id == message_id:
+                await self.graph.aupdate_state(config, {"messages": [RemoveMessage(id=message_id)]})
+        except Exception:
+            logger.warning(f"取り消された入力を会話から取り除けませんでした: thread_id={thread_id}", exc_info=True)
+
+    def has_after_turn(self) -> bool:
+        """after_turn() で行う処理があるか（False なら呼び出し側は何も実行しない）"""
+        return False
+
+    async def after_turn(self, thread_id: str, deadline: float = None) -> None:
+        """
+        応答を返した後に実行する処理（要約の更新など、応答の待ち時間に含めたくないもの）
+
+        呼び出し側は同じスレッドのターンと同時に実行しない（スレッドのロックを取って呼ぶ）。
+        行う処理があるエージェントは、has_after_turn() と合わせてオーバーライドしてください。
+
+        Args:
+            thread_id: 会話スレッドID
+            deadline: 締め切り（time.monotonic() の値）
+        """
+        pass
+
+    async def scheduling_weight(self) -> float:
+        """
+        スケジューラーでの顧客の重み（大きいほど混雑時に多くの枠を割り当てられる）
+
+        顧客設定から読み込むエージェントはオーバーライドしてください。
+        """
+        return 1.0
 
     async def run_sync(
         self,
         user_input: str,
         thread_id: str,
+        priority: str = PRIORITY_INTERACTIVE,
         **kwargs
     ) -> str:
         """
         エージェントを実行（非ストリーミング）
 
+        プロセス共有のスケジューラーで順番を待ってから実行する。
+        混雑時は、顧客の重みと優先度（対話 / 一括処理）に応じた順番になる。
+
+        【高速パス】
+        ストリーミング（astream_events）はノード・トークンごとにイベントを作って配るため、
+        全文だけが欲しい場合は無駄が多い。通常は ainvoke で実行し、
+        最終状態の最後の AI メッセージを返す。
+        コールバック（callbacks）が渡された場合のみ、ストリーミング経由で実行する。
+
         Args:
             user_input: ユーザーからの入力メッセージ
             thread_id: 会話スレッドID
+            priority: 優先度（PRIORITY_INTERACTIVE / PRIORITY_BATCH）
+            **kwargs: 追加のパラメータ（callbacks: LangChain のコールバック,
+                      deadline: 締め切り（time.monotonic() の値））
 
         Returns:
             str: エージェントからの応答（全文）
         """
-        result = []
-        async for chunk in self.run(user_input, thread_id, **kwargs):
-            result.append(chunk)
-        return "".join(result)
+        weight = await self.scheduling_weight()
+        queued_at = time.monotonic()
+        async with self.scheduler.slot(self.customer_id, priority, weight):
+            add_duration("queue", time.monotonic() - queued_at)
+            return await self._run_sync(user_input, thread_id, **kwargs)
+
+    async def _run_sync(self, user_input: str, thread_id: str, **kwargs) -> str:
+        """run_sync の本体（スケジューラーの枠を確保した後に呼ばれる）"""
+        if kwargs.get("callbacks"):
+            result = []
+            async for chunk in self.run(user_input, thread_id, **kwargs):
+                result.append(chunk)
+            return "".join(result)
+
+        config, state = self._prepare_run(user_input, thread_id, deadline=kwargs.get("deadline"))
+        try:
+            final_state = await self.graph.ainvoke(state, config)
+        except asyncio.CancelledError:
+            await self._discard_unanswered_input(thread_id, state)
+            raise
+        return self.get_response_text(final_state)
+
+    def get_response_text(self, state: dict) -> str:
+        """
+        最終状態から応答テキストを取り出す
+
+        messages の最後が AI の発言であればその本文を返す。
+        異なる状態の形を使うエージェントはオーバーライドしてください。
+        """
+        messages = state.get("messages") or []
+        if messages and getattr(messages[-1], "type", "") == "ai":
+            return content_text(messages[-1].content)
+        return ""
@@ -0,0 +1,159 @@
+"""
+ローカル用の偽 LLM（オフラインでの動作確認・テスト用）
+
+Vertex AI を呼ばずにエージェントを動かすための LLM とキャッシュバックエンドです。
+プレフィックスキャッシュのヒット / ミスなど、LLM への渡し方を記録して確認できます。
+
+【使い方】
+    from agents._base.fake_llm import FakeCacheBackend, FakeChatModel
+    from agents._base.prefix_cache import PrefixCache
+
+    llm = FakeChatModel(responses=["こんにちは"])
+    agent = TemplateAgent(llm=llm, prefix_cache=PrefixCache(FakeCacheBackend()))
+    await agent.run_sync("テスト", "thread-1")
+
+    llm.cache_hits     # cached_content 付きで呼ばれた回数
+    llm.cache_misses   # cached_content なしで呼ばれた回数
+
+文書検索を試す場合は FakeEmbeddings を使う（文字の並びが似た文ほど類似度が高くなる）:
+    agent = TemplateAgent(llm=llm, embeddings=FakeEmbeddings())
+"""
+import hashlib
+import json
+import re
+import uuid
+from typing import Any, Iterator, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    決まった応答を順番に返す偽の LLM
+
+    Attributes:
+        responses: 返す応答（最後まで使ったら先頭に戻る）
+                   文字列のほか、ツール呼び出しを返す場合は AIMessage(tool_calls=[...]) を指定
+        calls: 呼び出しごとの記録 [{"messages": [...], "cached_content": ...}, ...]
+    """
+
+    responses: list[Any] = ["これはテスト用の応答です。"]
+    calls: list[dict] = []
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools: list, **kwargs: Any) -> "FakeChatModel":
+        """ツールの指定は無視する（呼び出すツールは responses で決める）"""
+        return self
+
+    def _next_response(self, messages: list[BaseMessage], cached_content: Optional[str]) -> Any:
+        """呼び出しを記録し、次の応答を返す"""
+        if cached_content:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+        self.calls.append({"messages": messages, "cached_content": cached_content})
+        return self.responses[(len(self.calls) - 1) % len(self.responses)]
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Any = None,
+        cached_content: Optional[str] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        response = self._next_response(messages, cached_content)
+        if isinstance(response, AIMessage):
+            message = response.model_copy(update={"id": f"fake-{uuid.uuid4()}"})
+        else:
+            message = AIMessage(content=response, id=f"fake-{uuid.uuid4()}")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Any = None,
+        cached_content: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        response = self._next_response(messages, cached_content)
+        message_id = f"fake-{uuid.uuid4()}"
+        if isinstance(response, AIMessage):
+            # ツール呼び出しは分割せず1チャンクで返す
+            tool_call_chunks = [
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(response.tool_calls)
+            ]
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=response.content, id=message_id, tool_call_chunks=tool_call_chunks
+            ))
+            return
+
+        text = response
+        # 単語ごとに分割して、ストリーミング応答を再現する（空白も含めて元の文字列に戻る）
+        for token in re.findall(r"\S+\s*|\s+", text):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, id=message_id))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class FakeCacheBackend:
+    """
+    Vertex AI を呼ばないキャッシュバックエンド
+
+    Attributes:
+        created: 作成したキャッシュの記録 [(cache_id, system_prompt), ...]
+        refreshed: 延長したキャッシュ ID の記録
+    """
+
+    def __init__(self):
+        self.created: list[tuple[str, str]] = []
+        self.refreshed: list[str] = []
+
+    def create(self, llm, system_prompt: str, ttl_seconds: int) -> str:
+        cache_id = f"fake-cache-{len(self.created) + 1}"
+        self.created.append((cache_id, system_prompt))
+        return cache_id
+
+    def refresh(self, cache_id: str, ttl_seconds: int) -> None:
+        self.refreshed.append(cache_id)
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Vertex AI を呼ばない埋め込みモデル
+
+    文字の2-gram をハッシュして数えたベクトルを返す（同じ単語を含む文ほど近くなる）。
+
+    Attributes:
+        calls: 埋め込みを計算したテキストの数
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.calls = 0
+
+    def _embed(self, text: str) -> list[float]:
+        self.calls += 1
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for i in range(max(1, len(text) - 1)):
+            bucket = int.from_bytes(hashlib.md5(text[i:i + 2].encode()).digest()[:4], "little")
+            vector[bucket % self.dim] += 1.0
+        return vector.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
@@ -6,9 +6,23 @@ LangGraphの状態をFirestoreに保存します。
 
 【データ構造】
 customers/{customer_id}/checkpoints/{thread_id}/checkpoints/{checkpoint_id}
+
+ノードの途中結果（put_writes）は保存しない。
+途中で失敗した実行の再開には使っておらず、保存してもノードごとに書き込みが増えるだけのため。
+
+【締め切り】
+実行時の設定（configurable）に deadline（time.monotonic() の値）がある場合は、
+残り時間を Firestore の呼び出しのタイムアウトにする（締め切りを過ぎた読み書きで待たない）。
+
+【非同期版】
+LangGraph の ainvoke / astream_events は aget_tuple などの非同期版を呼ぶ。
+Firestore のクライアントは同期 API のため、別スレッドで実行してイベントループを止めない。
+読み書きにかかった時間は、リクエストの checkpoint_read / checkpoint_write の段階に加える（common/timing.py）。
 """
+import asyncio
 import json
-from typing import Any, Optional
+import time
+from typing import Any, AsyncIterator, Optional, Sequence
 from datetime import datetime, timezone
 from langgraph.checkpoint.base import (
     BaseCheckpointSaver,
@@ -18,6 +32,8 @@ from langgraph.checkpoint.base import (
 )
 from google.cloud import firestore
 
+from common.timing import timed
+
 
 class FirestoreCheckpointer(BaseCheckpointSaver):
     """LangGraphの状態をFirestoreに保存（マルチテナント対応）"""
@@ -37,22 +53,38 @@ class FirestoreCheckpointer(BaseCheckpointSaver):
             .collection("checkpoints")
         )
 
+    def _timeout(self, config: dict) -> Optional[float]:
+        """
+        締め切りまでの残り秒数（締め切りがなければ None）
+
+        Raises:
+            TimeoutError: 締め切りを過ぎている
+        """
+        deadline = config.get("configurable", {}).get("deadline")
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("締め切りを過ぎたため、チェックポイントの読み書きを中止しました")
+        return remaining
+
     def get_tuple(self, config: dict) -> Optional[CheckpointTuple]:
         """最新のチェックポイントを取得"""
         thread_id = config["configurable"]["thread_id"]
         checkpoint_id = config["configurable"].get("checkpoint_id")
+        timeout = self._timeout(config)
 
         ref = self._get_checkpoint_ref(thread_id)
 
         if checkpoint_id:
             # 特定のチェックポイントを取得
-            doc = ref.document(checkpoint_id).get()
+            doc = ref.document(checkpoint_id).get(timeout=timeout)
             if not doc.exists:
                 return None
             data = doc.to_dict()
         else:
             # 最新のチェックポイントを取得
-            docs = ref.order_by("created_at", direction=firestore.Query.DESCENDING).limit(1).stream()
+            docs = ref.order_by("created_at", direction=firestore.Query.DESCENDING).limit(1).stream(timeout=timeout)
             docs_list = list(docs)
             if not docs_list:
                 return None
@@ -91,7 +123,7 @@ class FirestoreCheckpointer(BaseCheckpointSaver):
             "created_at": datetime.now(timezone.utc),
         }
 
-        ref.document(checkpoint_id).set(doc_data)
+        ref.document(checkpoint_id).set(doc_data, timeout=self._timeout(config))
 
         return {
             "configurable": {
@@ -100,6 +132,16 @@ class FirestoreCheckpointer(BaseCheckpointSaver):
             }
         }
 
+    def put_writes(self, config: dict, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        """
+        ノードの途中結果の保存（LangGraph が各ノードの完了時に呼ぶ）
+
+        何もしない。get_tuple は途中結果を返さない（pending_writes なし）ため、
+        保存しても読まれず、ノードごとに Firestore の書き込みが1回増えるだけになる。
+        ステップの結果は、ステップの完了時に put() でチェックポイントとして保存される。
+        """
+        _ = (config, writes, task_id, task_path)  # 未使用引数を明示（BaseCheckpointSaverインターフェース準拠のため定義）
+
     def list(self, config: dict, *, filter: Optional[dict] = None, before: Optional[dict] = None, limit: Optional[int] = None):
         """
         チェックポイント一覧を取得
@@ -128,7 +170,7 @@ class FirestoreCheckpointer(BaseCheckpointSaver):
         if limit:
             query = query.limit(limit)
 
-        for doc in query.stream():
+        for doc in query.stream(timeout=self._timeout(config)):
             data = doc.to_dict()
             yield CheckpointTuple(
                 config={
@@ -142,6 +184,43 @@ class FirestoreCheckpointer(BaseCheckpointSaver):
                 parent_config=data.get("parent_config"),
             )
 
+    # ===== 非同期版（別スレッドで同期版を実行） =====
+
+    async def aget_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        with timed("checkpoint_read"):
+            return await asyncio.to_thread(self.get_tuple, config)
+
+    async def aput(
+        self,
+        config: dict,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: dict,
+    ) -> dict:
+        with timed("checkpoint_write"):
+            return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self, config: dict, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = ""
+    ) -> None:
+        # 保存しないため、別スレッドに渡さずにそのまま返す
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def alist(
+        self,
+        config: dict,
+        *,
+        filter: Optional[dict] = None,
+        before: Optional[dict] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        with timed("checkpoint_read"):
+            items = await asyncio.to_thread(
+                lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+            )
+        for item in items:
+            yield item
+
     def _serialize(self, obj: Any) -> str:
         """オブジェクトをJSON文字列に変換"""
         return json.dumps(obj, default=str)
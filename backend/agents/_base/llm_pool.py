@@ -0,0 +1,124 @@
+"""
+LLM クライアントの共有プール
+
+ChatVertexAI をエージェント・顧客ごとに作ると、
+顧客が増えるたびにクライアント・認証情報の更新・接続プールが増えていきます。
+このモジュールは、同じ設定のクライアントをプロセス全体で1つだけ作って使い回します。
+
+【キーの単位】
+(モデル, プロジェクト, リージョン, 生成パラメータ) ごとに1つ。
+顧客 ID などテナント固有の情報はクライアントに持たせず、呼び出しごとに渡す。
+→ メモリ・接続数は「顧客数」ではなく「モデルの種類数」に比例する。
+
+【使い方】
+    from agents._base.llm_pool import get_embeddings, get_llm
+
+    llm = get_llm("gemini-1.5-flash", project="my-project", location="asia-northeast1")
+    embeddings = get_embeddings("text-embedding-004", project="my-project")
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_clients: dict[tuple, object] = {}
+_lock = threading.Lock()
+# 再利用回数の記録用（クライアントの作成中に _lock を待たずに記録できるよう分ける）
+_stats_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+
+def get_llm(
+    model: str,
+    project: str = None,
+    location: str = "asia-northeast1",
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    streaming: bool = True,
+):
+    """
+    共有の LLM クライアントを取得（なければ作成）
+
+    Args:
+        model: モデル名
+        project: GCPプロジェクトID
+        location: Vertex AI のリージョン
+        temperature: 生成時の温度
+        max_tokens: 最大出力トークン数
+        streaming: ストリーミングで生成するか
+
+    Returns:
+        ChatVertexAI: 同じ引数で呼ばれた場合は同じインスタンス
+    """
+    global _hits, _misses
+    key = (model, project, location, temperature, max_tokens, streaming)
+
+    # 作成済みならロックを取らずに返す（dict の読み込みはスレッドセーフ。回数の記録だけ _stats_lock で守る）
+    client = _clients.get(key)
+    if client is not None:
+        with _stats_lock:
+            _hits += 1
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from langchain_google_vertexai import ChatVertexAI
+
+            client = ChatVertexAI(
+                model=model,
+                project=project,
+                location=location,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                streaming=streaming,
+                # クォータ超過の再試行は adaptive_limiter で行う（SDK の再試行は締め切りを考慮しない）
+                max_retries=1,
+            )
+            _clients[key] = client
+            with _stats_lock:
+                _misses += 1
+            logger.info(f"LLM クライアントを作成: model={model}, location={location}")
+        else:
+            with _stats_lock:
+                _hits += 1
+        return client
+
+
+def get_embeddings(model: str, project: str = None, location: str = "asia-northeast1"):
+    """
+    共有の埋め込みモデルのクライアントを取得（なければ作成）
+
+    Returns:
+        VertexAIEmbeddings: 同じ引数で呼ばれた場合は同じインスタンス
+    """
+    global _hits, _misses
+    key = ("embeddings", model, project, location)
+
+    client = _clients.get(key)
+    if client is not None:
+        with _stats_lock:
+            _hits += 1
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from langchain_google_vertexai import VertexAIEmbeddings
+
+            client = VertexAIEmbeddings(model_name=model, project=project, location=location)
+            _clients[key] = client
+            with _stats_lock:
+                _misses += 1
+            logger.info(f"埋め込みクライアントを作成: model={model}, location={location}")
+        else:
+            with _stats_lock:
+                _hits += 1
+        return client
+
+
+def get_pool_stats() -> dict:
+    """プールの状態を取得（クライアント数・再利用回数。GET /metrics の "llm_pool"）"""
+    with _stats_lock:
+        return {"clients": len(_clients), "hits": _hits, "misses": _misses}
@@ -0,0 +1,115 @@
+"""
+モデルの振り分け（質問の難しさに応じた使い分け）
+
+挨拶のような簡単なメッセージは高速・安価なモデルに、
+分析や比較などの難しい質問は高性能なモデルに振り分けます。
+
+【判定方法】
+LLM を呼ばずに、文字数・キーワード・コードの有無などから簡易的に判定する。
+（判定のための待ち時間・コストを発生させない）
+
+【振り分けルール】
+エージェントの MODEL_ROUTES がデフォルト。
+顧客ごとに Firestore で上書きできる:
+
+    customers/{customer_id}
+    └── model_routing: {"simple": "gemini-2.0-flash", "complex": "gemini-1.5-pro"}
+
+【記録】
+選ばれた振り分け先は get_route_counts()（GET /metrics の "model_routes"）で集計でき、ログにも出力される。
+判定ルールの調整に使う。
+"""
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+SIMPLE = "simple"
+COMPLEX = "complex"
+
+# 難しい質問によく含まれるキーワード（小文字で比較）
+COMPLEX_KEYWORDS = (
+    "分析", "比較", "なぜ", "理由", "設計", "検討", "手順", "計算", "証明", "最適",
+    "戦略", "実装", "コード", "違い", "メリット", "デメリット", "評価",
+    "analy", "compare", "why", "design", "explain", "implement", "calculate",
+    "step by step", "trade-off", "optimi",
+)
+
+# この文字数を超えるメッセージは難しい質問の可能性が高い
+LONG_MESSAGE_CHARS = 300
+
+# 振り分けの集計: {(customer_id, route, model): 件数}
+_route_counts: Counter = Counter()
+_route_counts_lock = threading.Lock()
+
+
+def classify_complexity(text: str) -> str:
+    """
+    メッセージの難しさを判定
+
+    Args:
+        text: ユーザーのメッセージ
+
+    Returns:
+        str: SIMPLE または COMPLEX
+    """
+    lowered = text.lower()
+    score = 0
+
+    if len(text) > LONG_MESSAGE_CHARS:
+        score += 2
+    elif len(text) > LONG_MESSAGE_CHARS // 3:
+        score += 1
+
+    if "```" in text:
+        score += 2
+
+    score += min(2, sum(1 for keyword in COMPLEX_KEYWORDS if keyword in lowered))
+
+    # 複数の質問が含まれている
+    if text.count("?") + text.count("？") >= 2:
+        score += 1
+
+    return COMPLEX if score >= 2 else SIMPLE
+
+
+def select_model(text: str, routes: dict, customer_routes: dict = None) -> tuple[str, str]:
+    """
+    メッセージに使うモデルを選ぶ
+
+    Args:
+        text: ユーザーのメッセージ
+        routes: デフォルトの振り分けルール {route: model_name}
+        customer_routes: 顧客ごとの振り分けルール（Firestore の model_routing）
+            辞書でない場合・モデル名が文字列でない場合は無視してデフォルトを使う
+
+    Returns:
+        tuple: (route, model_name)
+    """
+    route = classify_complexity(text)
+    if customer_routes and not isinstance(customer_routes, dict):
+        logger.warning(f"model_routing が辞書ではないため無視します: {customer_routes!r}")
+        customer_routes = None
+    model_name = (customer_routes or {}).get(route)
+    if model_name is not None and not (isinstance(model_name, str) and model_name):
+        logger.warning(f"model_routing.{route} が不正なため無視します: {model_name!r}")
+        model_name = None
+    return route, model_name or routes.get(route) or routes[SIMPLE]
+
+
+def record_route(customer_id: str, route: str, model_name: str) -> None:
+    """選ばれた振り分け先を記録"""
+    with _route_counts_lock:
+        _route_counts[(customer_id, route, model_name)] += 1
+    logger.info(f"モデル振り分け: customer_id={customer_id}, route={route}, model={model_name}")
+
+
+def get_route_counts() -> dict:
+    """振り分けの集計を取得 {customer_id: {route: {model: 件数}}}（GET /metrics の "model_routes"）"""
+    with _route_counts_lock:
+        counts = dict(_route_counts)
+    result: dict = {}
+    for (customer_id, route, model_name), count in counts.items():
+        result.setdefault(customer_id, {}).setdefault(route, {})[model_name] = count
+    return result
@@ -0,0 +1,162 @@
+"""
+ツールの並列実行
+
+LLM が1回の応答で複数のツール呼び出しを要求した場合に、それらを同時に実行します。
+（順番に実行すると合計時間がかかるが、並列なら一番遅いツールの時間で済む）
+
+【機能】
+- 同時実行数の上限（max_concurrency）
+- ツールごとのタイムアウト（時間切れはエラーとして LLM に返す）
+- 結果のキャッシュ（cache_seconds で指定したツールのみ。副作用のあるツールはキャッシュしない）
+- 同じターン内で同じ引数の呼び出しが重なった場合は1回だけ実行
+
+【エラーの扱い】
+ツールの失敗・タイムアウトで会話全体を失敗させず、
+エラー内容を ToolMessage として LLM に返し、LLM に対応させる。
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from langchain_core.messages import ToolMessage
+
+logger = logging.getLogger(__name__)
+
+
+class ParallelToolExecutor:
+    """
+    ツール呼び出しを並列に実行する
+
+    エージェント1つにつき1つ作成する（キャッシュはエージェント＝顧客ごとに分かれる）。
+    エージェントは複数のリクエスト（別々のスレッド・イベントループ）から同時に使われるため、
+    キャッシュと件数はロックで守る。
+
+    Attributes:
+        cache_hits: キャッシュから結果を返した回数
+        timeouts_count: タイムアウトした回数
+    """
+
+    def __init__(
+        self,
+        tools: list,
+        max_concurrency: int = 4,
+        timeout_seconds: float = 10,
+        timeouts: dict[str, float] = None,
+        cache_seconds: dict[str, float] = None,
+        cache_max_size: int = 256,
+    ):
+        """
+        Args:
+            tools: LangChain のツール（@tool で定義したもの）
+            max_concurrency: 1ターンで同時に実行するツールの上限
+            timeout_seconds: ツールのタイムアウト（秒）
+            timeouts: ツールごとのタイムアウト {ツール名: 秒}（timeout_seconds より優先）
+            cache_seconds: 結果をキャッシュするツールと秒数 {ツール名: 秒}
+            cache_max_size: キャッシュする結果の最大件数
+        """
+        self.tools = {tool.name: tool for tool in tools}
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.timeouts = timeouts or {}
+        self.cache_seconds = cache_seconds or {}
+        self.cache_max_size = cache_max_size
+        self.cache_hits = 0
+        self.timeouts_count = 0
+        # 形式: {(ツール名, 引数のJSON): (結果, 期限)}
+        self._cache: OrderedDict[tuple, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(name: str, args: dict) -> tuple:
+        return name, json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+    def _get_cached(self, key: tuple) -> str | None:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._cache.pop(key, None)
+                return None
+            self.cache_hits += 1
+            return entry[0]
+
+    def _set_cached(self, key: tuple, result: str) -> None:
+        ttl = self.cache_seconds.get(key[0])
+        if not ttl:
+            return
+        with self._lock:
+            self._cache[key] = (result, time.monotonic() + ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_max_size:
+                self._cache.popitem(last=False)
+
+    async def _invoke(self, name: str, args: dict, semaphore: asyncio.Semaphore) -> tuple[str, bool]:
+        """
+        ツールを1つ実行
+
+        Returns:
+            tuple: (結果のテキスト, 成功したか)
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            return f"エラー: ツール '{name}' は存在しません。", False
+
+        key = self._cache_key(name, args)
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached, True
+
+        timeout = self.timeouts.get(name, self.timeout_seconds)
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(tool.ainvoke(args), timeout=timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self.timeouts_count += 1
+                logger.warning(f"ツールがタイムアウトしました: tool={name}, timeout={timeout}s")
+                return f"エラー: ツール '{name}' が {timeout} 秒以内に応答しませんでした。", False
+            except Exception as e:
+                logger.warning(f"ツールの実行に失敗しました: tool={name}", exc_info=True)
+                return f"エラー: ツール '{name}' の実行に失敗しました: {e}", False
+
+        text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+        self._set_cached(key, text)
+        return text, True
+
+    async def run(self, tool_calls: list[dict]) -> list[ToolMessage]:
+        """
+        ツール呼び出しを並列に実行
+
+        Args:
+            tool_calls: AIMessage.tool_calls（[{"name": ..., "args": ..., "id": ...}, ...]）
+
+        Returns:
+            list: 呼び出しと同じ順の ToolMessage
+        """
+        # セマフォはイベントループごとに作る（リクエストごとに別のループで実行されるため）
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        # 同じツール・同じ引数の呼び出しは1回だけ実行して結果を共有する
+        tasks: dict[tuple, asyncio.Task] = {}
+        for call in tool_calls:
+            key = self._cache_key(call["name"], call["args"])
+            if key not in tasks:
+                tasks[key] = asyncio.ensure_future(self._invoke(call["name"], call["args"], semaphore))
+        await asyncio.gather(*tasks.values())
+
+        messages = []
+        for call in tool_calls:
+            text, ok = tasks[self._cache_key(call["name"], call["args"])].result()
+            messages.append(ToolMessage(
+                content=text,
+                name=call["name"],
+                tool_call_id=call["id"],
+                status="success" if ok else "error",
+                id=str(uuid.uuid4()),
+            ))
+        return messages
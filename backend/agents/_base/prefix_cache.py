@@ -0,0 +1,184 @@
+"""
+システムプロンプトのプレフィックスキャッシュ（Vertex AI コンテキストキャッシュ）
+
+毎ターン同じシステムプロンプトを送って処理させる代わりに、
+Vertex AI 側に一度だけキャッシュを作成し、以降のリクエストではその ID だけを送ります。
+
+【効果】
+システムプロンプトや参考資料が大きい顧客ほど、
+- 最初のトークンが返るまでの時間（TTFT）が短くなる
+- キャッシュ済みの入力トークンは割引料金になる
+
+【キャッシュの単位】
+(エージェント, 顧客, モデル, プロンプトのハッシュ) ごとに1つ作成し、
+全スレッド・全ユーザーで共有する。プロンプトを変更するとハッシュが変わり、自動的に作り直される。
+
+【有効期限】
+Vertex AI のキャッシュには TTL がある。期限が近づいたら（refresh_margin_seconds 前）延長する。
+
+【注意】
+Vertex AI のコンテキストキャッシュには最小サイズがある（Gemini 1.5 では 32,768 トークン）。
+それより小さいプロンプトはキャッシュせず、従来どおり毎回送る。
+"""
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Protocol
+
+logger = logging.getLogger(__name__)
+
+# キャッシュ作成に失敗した場合、次に作成を試すまでの秒数（失敗し続ける API を叩き続けない）
+_FAILURE_BACKOFF_SECONDS = 60
+
+
+class CacheBackend(Protocol):
+    """キャッシュの作成・延長を行うバックエンド（本番: Vertex AI / テスト: FakeCacheBackend）"""
+
+    def create(self, llm, system_prompt: str, ttl_seconds: int) -> str:
+        """キャッシュを作成し、キャッシュ ID を返す"""
+        ...
+
+    def refresh(self, cache_id: str, ttl_seconds: int) -> None:
+        """キャッシュの有効期限を延長する"""
+        ...
+
+
+class VertexCacheBackend:
+    """
+    Vertex AI のコンテキストキャッシュ
+
+    langchain-google-vertexai 2.0.11（requirements.txt で固定）で確認済み:
+    create_context_cache() が返すキャッシュ ID を ChatVertexAI の ainvoke(..., cached_content=ID) に渡せる。
+    キャッシュを使う呼び出しでは system_instruction・tools が無視されるため、
+    システムプロンプトはメッセージに含めず、ツールを使うエージェントでは無効にする。
+    """
+
+    def create(self, llm, system_prompt: str, ttl_seconds: int) -> str:
+        from langchain_core.messages import SystemMessage
+        from langchain_google_vertexai import create_context_cache
+
+        return create_context_cache(
+            llm,
+            [SystemMessage(content=system_prompt)],
+            time_to_live=timedelta(seconds=ttl_seconds),
+        )
+
+    def refresh(self, cache_id: str, ttl_seconds: int) -> None:
+        from vertexai.preview import caching
+
+        caching.CachedContent(cached_content_name=cache_id).update(ttl=timedelta(seconds=ttl_seconds))
+
+
+@dataclass
+class _CacheEntry:
+    cache_id: str
+    expires_at: float
+
+
+class PrefixCache:
+    """
+    プレフィックスキャッシュの管理（スレッドセーフ、プロセス内で共有）
+
+    Attributes:
+        hits: 既存のキャッシュを使った回数
+        misses: キャッシュを新規作成した回数
+        refreshes: 有効期限を延長した回数
+    """
+
+    def __init__(self, backend: CacheBackend, ttl_seconds: int = 3600, refresh_margin_seconds: int = 300):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries: dict[tuple, _CacheEntry] = {}
+        self._failed_until: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        self._key_locks: dict[tuple, threading.Lock] = {}
+
+    @staticmethod
+    def make_key(agent_name: str, customer_id: str, model: str, system_prompt: str) -> tuple:
+        """キャッシュのキー（プロンプトはハッシュにして保持する）"""
+        prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+        return (agent_name, customer_id, model, prompt_hash)
+
+    def lookup(self, key: tuple) -> str | None:
+        """
+        有効なキャッシュ ID を返す（API 呼び出しなし、すぐに返る）
+
+        Returns:
+            キャッシュ ID。作成・延長が必要な場合は None（ensure() を呼ぶ）
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at - time.time() > self.refresh_margin_seconds:
+                self.hits += 1
+                return entry.cache_id
+            return None
+
+    def is_backing_off(self, key: tuple) -> bool:
+        """直近に作成に失敗していて、再試行を控えるべきか"""
+        with self._lock:
+            return self._failed_until.get(key, 0) > time.time()
+
+    def ensure(self, key: tuple, llm, system_prompt: str) -> str | None:
+        """
+        キャッシュを作成、または有効期限を延長して ID を返す（API を呼ぶため遅い）
+
+        同じキーに対して同時に呼ばれても、作成は1回だけ行う。
+
+        Returns:
+            キャッシュ ID。失敗した場合は None（呼び出し側はキャッシュなしで続行）
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # 他のスレッドが作成済みならそれを使う
+            cache_id = self.lookup(key)
+            if cache_id or self.is_backing_off(key):
+                return cache_id
+
+            with self._lock:
+                entry = self._entries.get(key)
+            now = time.time()
+            # API の呼び出し中は self._lock を持たない（他のキーの lookup を止めない）
+            try:
+                if entry and entry.expires_at > now:
+                    self.backend.refresh(entry.cache_id, self.ttl_seconds)
+                    refreshed, cache_id = True, entry.cache_id
+                else:
+                    cache_id = self.backend.create(llm, system_prompt, self.ttl_seconds)
+                    refreshed = False
+            except Exception:
+                logger.warning(f"プレフィックスキャッシュの作成に失敗しました: key={key}", exc_info=True)
+                with self._lock:
+                    self._failed_until[key] = now + _FAILURE_BACKOFF_SECONDS
+                return None
+
+            with self._lock:
+                if refreshed:
+                    self.refreshes += 1
+                else:
+                    self.misses += 1
+                self._entries[key] = _CacheEntry(cache_id, now + self.ttl_seconds)
+            return cache_id
+
+
+# プロセス全体で共有するプレフィックスキャッシュ
+_default_cache: PrefixCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def get_prefix_cache() -> PrefixCache:
+    """Vertex AI を使う共有のプレフィックスキャッシュを取得"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = PrefixCache(VertexCacheBackend())
+    return _default_cache
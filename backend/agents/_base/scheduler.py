@@ -0,0 +1,212 @@
+"""
+重み付き公平キューイング（LLM 呼び出しの順番待ち）
+
+プロセス全体で同時に実行できるエージェントの数（max_concurrent）を決め、
+空きがないときは「重み」に応じた順番で実行します。
+
+- 対話（interactive）のチャットは、一括処理（batch）より優先される
+- 重みの大きい顧客（有料プランなど）ほど、混雑時に多くの枠を割り当てられる
+- 重みの小さい顧客も、待っていれば必ず順番が回ってくる（後から来た重い顧客に抜かされ続けない）
+
+【仕組み】（Weighted Fair Queuing の考え方）
+顧客 × 優先度ごとの流れ（フロー）に「仮想的な終了時刻」を付けて、小さい順に実行する。
+    終了時刻 = max(現在の仮想時刻, そのフローの前回の終了時刻) + 1 / 重み
+重みが2倍のフローは終了時刻の進みが半分なので、混雑時に2倍の頻度で順番が回ってくる。
+
+【顧客の重み】
+Firestore の customers/{customer_id} ドキュメントで設定します（省略時は 1）。
+    scheduler: {weight: 4}
+重みは MIN_WEIGHT〜MAX_WEIGHT に収める（極端な重みで他の顧客の順番が回ってこなくならないように）。
+
+【注意】
+インスタンス内でのみ有効。Flask はリクエストごとに別のイベントループで実行するため、
+順番待ちは loop.call_soon_threadsafe で待っているイベントループに通知する。
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from common.config import config
+
+# 優先度
+PRIORITY_INTERACTIVE = "interactive"   # 画面で応答を待っているチャット
+PRIORITY_BATCH = "batch"               # 一括処理・非同期ジョブ
+
+# 顧客の重みの範囲（範囲外は丸める。数でない値・無限大は 1 として扱う）
+MIN_WEIGHT = 1e-3
+MAX_WEIGHT = 1e3
+
+# 優先度ごとの重み（顧客の重みと掛け合わせる）
+PRIORITY_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 4.0,
+    PRIORITY_BATCH: 1.0,
+}
+
+
+@dataclass
+class _Waiter:
+    """順番待ちの1件"""
+    loop: asyncio.AbstractEventLoop
+    future: asyncio.Future
+    flow: tuple
+    start_tag: float
+    queued_at: float
+    granted: bool = False
+    cancelled: bool = False
+
+
+@dataclass
+class _FlowStats:
+    """フロー（顧客 × 優先度）ごとの統計"""
+    queued: int = 0
+    dispatched: int = 0
+    waited: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+    weight: float = 1.0
+
+
+def _grant(future: asyncio.Future) -> None:
+    """待っているイベントループ上で順番が来たことを通知"""
+    if not future.done():
+        future.set_result(None)
+
+
+class FairScheduler:
+    """
+    重み付き公平キューイング（スレッドセーフ）
+
+    使い方:
+        async with scheduler.slot(customer_id, PRIORITY_INTERACTIVE, weight=2.0):
+            ...  # エージェントを実行
+    """
+
+    def __init__(self, max_concurrent: int = 32):
+        """
+        Args:
+            max_concurrent: プロセス全体で同時に実行できる数
+        """
+        self.max_concurrent = max_concurrent
+        self._in_flight = 0
+        self._virtual_time = 0.0
+        self._finish_tags: dict[tuple, float] = {}   # {フロー: 前回の終了時刻}
+        self._queue: list = []                      # (終了時刻, 到着順, _Waiter) のヒープ
+        self._sequence = itertools.count()
+        self._stats: dict[tuple, _FlowStats] = {}
+        self._lock = threading.Lock()
+
+    @asynccontextmanager
+    async def slot(self, customer_id: str, priority: str = PRIORITY_INTERACTIVE, weight: float = 1.0):
+        """
+        実行枠を1つ確保する（ブロックを抜けると次の順番の人に譲る）
+
+        Args:
+            customer_id: 顧客ID
+            priority: PRIORITY_INTERACTIVE / PRIORITY_BATCH
+            weight: 顧客の重み（優先度の重みと掛け合わせる）
+        """
+        flow = (customer_id or "", priority)
+        if not math.isfinite(weight):
+            weight = 1.0
+        weight = min(max(weight, MIN_WEIGHT), MAX_WEIGHT) * PRIORITY_WEIGHTS.get(priority, 1.0)
+
+        with self._lock:
+            start_tag = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+            finish_tag = start_tag + 1.0 / weight
+            self._finish_tags[flow] = finish_tag
+            stats = self._stats.setdefault(flow, _FlowStats())
+            stats.weight = weight
+
+            if self._in_flight < self.max_concurrent and not self._queue:
+                self._in_flight += 1
+                self._virtual_time = max(self._virtual_time, start_tag)
+                stats.dispatched += 1
+                waiter = None
+            else:
+                loop = asyncio.get_running_loop()
+                waiter = _Waiter(loop, loop.create_future(), flow, start_tag, time.monotonic())
+                heapq.heappush(self._queue, (finish_tag, next(self._sequence), waiter))
+                stats.queued += 1
+
+        if waiter is not None:
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                with self._lock:
+                    if not waiter.granted:
+                        # ヒープからは取り出し時に読み飛ばす
+                        waiter.cancelled = True
+                        self._stats[waiter.flow].queued -= 1
+                        raise
+                # 取り消しと同時に順番が来た場合は、その枠を次の人に譲る
+                self._release()
+                raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        """枠を解放（待っている人がいれば、終了時刻の最も小さい人に譲る）"""
+        with self._lock:
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                stats = self._stats[waiter.flow]
+                stats.queued -= 1
+                try:
+                    waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+                except RuntimeError:
+                    # 待っていたイベントループが既に閉じている（次の人に譲る）
+                    continue
+                waiter.granted = True
+                self._virtual_time = max(self._virtual_time, waiter.start_tag)
+
+                wait_seconds = time.monotonic() - waiter.queued_at
+                stats.dispatched += 1
+                stats.waited += 1
+                stats.wait_seconds_total += wait_seconds
+                stats.wait_seconds_max = max(stats.wait_seconds_max, wait_seconds)
+                return
+            self._in_flight -= 1
+
+    def stats(self) -> dict:
+        """全体の実行数と、顧客 × 優先度ごとの待ち件数・待ち時間"""
+        with self._lock:
+            flows = {}
+            for (customer_id, priority), s in self._stats.items():
+                flows.setdefault(customer_id, {})[priority] = {
+                    "weight": s.weight,
+                    "queued": s.queued,
+                    "dispatched": s.dispatched,
+                    "wait_seconds_avg": s.wait_seconds_total / s.waited if s.waited else 0.0,
+                    "wait_seconds_max": s.wait_seconds_max,
+                }
+            return {
+                "max_concurrent": self.max_concurrent,
+                "in_flight": self._in_flight,
+                "queued": sum(1 for _, _, w in self._queue if not w.cancelled),
+                "customers": flows,
+            }
+
+
+# プロセス全体で共有するスケジューラー
+_default_scheduler: FairScheduler | None = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler() -> FairScheduler:
+    """共有のスケジューラーを取得（同時実行数は環境変数 SCHEDULER_MAX_CONCURRENT）"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_lock:
+            if _default_scheduler is None:
+                _default_scheduler = FairScheduler(config.SCHEDULER_MAX_CONCURRENT)
+    return _default_scheduler
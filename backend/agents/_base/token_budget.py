@@ -0,0 +1,121 @@
+"""
+トークン予算による会話履歴の制限
+
+会話履歴を「件数」ではなく「トークン数」で制限するための共通関数です。
+
+【なぜ件数ではなくトークン数か？】
+件数で制限すると、1万文字の貼り付け1件でもプロンプトが巨大になり、
+逆に短いやり取りばかりの会話では文脈を無駄に捨ててしまう。
+
+【トークン数の見積もり】
+正確なトークナイザーは呼び出しが重いため、文字種から概算する。
+- 日本語などの非ASCII文字: 1文字 ≒ 1トークン
+- 英数字などのASCII文字: 4文字 ≒ 1トークン
+- メッセージごとのオーバーヘッド: MESSAGE_OVERHEAD_TOKENS
+
+見積もりはメッセージごとに一度だけ計算し、状態（token_counts）に保存して再利用する。
+"""
+from typing import Any
+
+# メッセージ1件あたりの固定オーバーヘッド（役割・区切りなど）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def content_text(content: Any) -> str:
+    """メッセージの content からテキストを取り出す（マルチモーダル形式にも対応）"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, str):
+                parts.append(part)
+            elif isinstance(part, dict) and isinstance(part.get("text"), str):
+                parts.append(part["text"])
+        return "".join(parts)
+    return str(content)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        int: 推定トークン数
+    """
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    non_ascii_chars = len(text) - ascii_chars
+    return non_ascii_chars + (ascii_chars + 3) // 4
+
+
+def estimate_message_tokens(message: Any) -> int:
+    """
+    メッセージ1件のトークン数を概算
+
+    Args:
+        message: LangChain のメッセージ、または {"role": ..., "content": ...} 形式の辞書
+
+    Returns:
+        int: 推定トークン数（オーバーヘッド込み）
+    """
+    if isinstance(message, dict):
+        content = message.get("content", "")
+    else:
+        content = getattr(message, "content", message)
+    return estimate_tokens(content_text(content)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def trim_messages_to_budget(messages: list, token_counts: list[int], budget: int, max_messages: int = None) -> list:
+    """
+    トークン予算・件数の上限に収まるよう、古い会話から削除
+
+    会話は「ユーザーの発言から次のユーザーの発言の手前まで」（ユーザー → AI のツール呼び出し →
+    ツールの結果 → AI の回答）を1つのまとまりとして、まとまりごとに削る。
+    ツールの結果だけが残る（呼び出した AI のメッセージがない）と Gemini が拒否するため、
+    まとまりの途中からは始めない。
+
+    Args:
+        messages: 会話履歴（古い順）
+        token_counts: 各メッセージの推定トークン数（messages と同じ順番）
+        budget: 履歴に使えるトークン数（システムプロンプトの分は除く）
+        max_messages: 件数の上限（None なら件数では制限しない）
+
+    Returns:
+        list: 予算内に収まる直近のメッセージ（必ずユーザーの発言から始まる）
+              ただし最新のユーザーの発言以降（ツールの呼び出し中のやり取りを含む）は
+              予算・件数の上限を超えても必ず残す
+    """
+    if not messages:
+        return messages
+
+    # 最新のユーザーの発言から始まる、今回のまとまり
+    start = next((i for i in range(len(messages) - 1, -1, -1) if _role(messages[i]) == "user"), len(messages) - 1)
+    total = sum(token_counts[start:])
+
+    # 1つ前のまとまりごとに、予算と件数の上限に収まる間だけ遡る
+    while start > 0:
+        previous = start - 1
+        while previous > 0 and _role(messages[previous]) != "user":
+            previous -= 1
+        if _role(messages[previous]) != "user":
+            break
+        group_tokens = sum(token_counts[previous:start])
+        if total + group_tokens > budget:
+            break
+        if max_messages is not None and len(messages) - previous > max_messages:
+            break
+        start = previous
+        total += group_tokens
+
+    return messages[start:]
+
+
+def _role(message: Any) -> str:
+    """メッセージの役割（user / assistant など）を取得"""
+    if isinstance(message, dict):
+        return message.get("role", "")
+    # LangChain のメッセージ: HumanMessage.type == "human"
+    return "user" if getattr(message, "type", "") == "human" else getattr(message, "type", "")
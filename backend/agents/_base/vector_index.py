@@ -0,0 +1,363 @@
+"""
+顧客別のベクトルインデックス（社内文書の検索用）
+
+顧客ごとの文書を埋め込みベクトルにして保存し、質問に近い文書を検索します。
+
+【保存形式】
+    {RETRIEVAL_INDEX_DIR}/{customer_id}/
+    ├── CURRENT                ← 使用中のバージョンのフォルダ名
+    └── v{作成時刻}-{プロセスID}/
+        ├── embeddings.npy     ← 埋め込み行列（float32, 正規化済み, 件数 × 次元）
+        ├── documents.jsonl    ← 文書本文（1行1文書 {"text": ..., "source": ...}）
+        ├── offsets.npy        ← documents.jsonl の各行の開始位置（バイト）
+        ├── centroids.npy      ← IVF のクラスタ中心（大きなインデックスのみ）
+        ├── list_offsets.npy   ← クラスタごとの行の範囲（大きなインデックスのみ）
+        └── meta.json          ← 埋め込みモデル名・件数など
+
+【作り直し】
+新しいバージョンのフォルダにすべてのファイルを書いてから、CURRENT を os.replace で置き換える。
+検索側は CURRENT が指すフォルダのファイルだけを読むため、新旧のファイルが混ざることはない。
+古いバージョンは直前の1つだけ残して削除する（読み込み中のプロセスのメモリマップは、削除後も使える）。
+CURRENT のない古い形式（customer_id のフォルダに直接ファイルがある）も読み込める。
+
+【メモリマップ】
+ファイルは np.load(mmap_mode="r") で開くため、読み込み時にメモリへ全体をコピーしない。
+検索で触れた部分だけが OS のページキャッシュに載る。
+
+【検索方法】
+- 通常: 全件との内積（正規化済みなのでコサイン類似度）を一度に計算し、上位 k 件を取る
+- IVF: 文書をクラスタに分けておき、質問に近いクラスタ（nprobe 個）の中だけを検索する
+       件数が多い顧客でも数ミリ秒で検索できる（ごく一部の近い文書を取りこぼす可能性がある）
+
+【作成方法】
+    python scripts/ingest_documents.py --customer-id acme-corp --input ./docs/
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from common.config import config
+from common.lru_cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# この件数以上の文書は IVF で分割する（それ未満は全件検索でも数ミリ秒）
+IVF_MIN_DOCUMENTS = 10000
+
+_META_FILE = "meta.json"
+_CURRENT_FILE = "CURRENT"
+
+# フォルダ名に使う顧客IDの許可パターン（../ などでインデックスの保存先の外を指せないように）
+CUSTOMER_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')
+
+
+def index_directory(root_dir: str, customer_id: str) -> str:
+    """
+    顧客のインデックスのフォルダ
+
+    Raises:
+        ValueError: 顧客IDにフォルダ名として使えない文字が含まれる
+    """
+    if not CUSTOMER_ID_PATTERN.match(customer_id or ""):
+        raise ValueError(f"顧客IDの形式が不正です: {customer_id!r}")
+    return os.path.join(root_dir, customer_id)
+
+
+@dataclass
+class SearchResult:
+    """検索結果の1件"""
+    text: str
+    source: str
+    score: float
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """ベクトルを長さ1に正規化（内積がコサイン類似度になる）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの上位 k 件の位置を、スコアの高い順に返す（全体をソートしない）"""
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def _version_stamp(directory: str) -> tuple | None:
+    """
+    使用中のバージョンの識別（作り直されると変わる。インデックスがなければ None）
+
+    CURRENT は os.replace で置き換えるため、inode と更新時刻で判定する（中身を毎回読まない）。
+    古い形式の場合は meta.json で判定する。
+    """
+    for name in (_CURRENT_FILE, _META_FILE):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+            return name, stat.st_ino, stat.st_mtime_ns
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _version_directory(directory: str) -> str:
+    """CURRENT が指すバージョンのフォルダ（古い形式ならフォルダそのもの）"""
+    try:
+        with open(os.path.join(directory, _CURRENT_FILE), encoding="utf-8") as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return directory
+
+
+class VectorIndex:
+    """
+    メモリマップした埋め込み行列による検索インデックス
+
+    文書がまだ登録されていない顧客の場合は空のインデックスになる（検索結果は常に空）。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.stamp = _version_stamp(directory)
+        self.meta = {}
+        self.embeddings = None
+        self.centroids = None
+        self.list_offsets = None
+        if self.stamp is None:
+            return
+
+        # 以降は1つのバージョンのフォルダだけを読む（途中で作り直されても混ざらない）
+        directory = _version_directory(directory)
+        with open(os.path.join(directory, _META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self._documents = np.memmap(os.path.join(directory, "documents.jsonl"), dtype=np.uint8, mode="r")
+        if self.meta.get("lists"):
+            # クラスタ中心は小さいのでメモリに読み込む
+            self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+            self.list_offsets = np.load(os.path.join(directory, "list_offsets.npy"))
+        logger.info(f"ベクトルインデックスを読み込み: {directory}（{len(self)} 件）")
+
+    def __len__(self) -> int:
+        return 0 if self.embeddings is None else self.embeddings.shape[0]
+
+    def is_stale(self) -> bool:
+        """インデックスが作り直されたか"""
+        return _version_stamp(self.directory) != self.stamp
+
+    def _document(self, row: int) -> dict:
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(self._documents[start:end].tobytes())
+
+    def search(self, query: np.ndarray, k: int = 4, nprobe: int = 8, min_score: float = 0.0) -> list[SearchResult]:
+        """
+        質問のベクトルに近い文書を検索
+
+        Args:
+            query: 質問の埋め込みベクトル
+            k: 返す件数
+            nprobe: IVF の場合に検索するクラスタ数（多いほど正確だが遅い）
+            min_score: これ未満の類似度の文書は返さない
+
+        Returns:
+            list: 類似度の高い順の検索結果
+        """
+        if not len(self):
+            return []
+        query = normalize(query)
+
+        if self.centroids is None:
+            scores = self.embeddings @ query
+            rows = top_k(scores, k)
+            row_scores = scores[rows]
+        else:
+            # 近いクラスタの範囲だけを検索（各クラスタの行は連続して保存されている）
+            lists = top_k(self.centroids @ query, nprobe)
+            row_ids = np.concatenate([
+                np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists
+            ])
+            scores = np.concatenate([
+                self.embeddings[self.list_offsets[i]:self.list_offsets[i + 1]] @ query for i in lists
+            ])
+            best = top_k(scores, k)
+            rows, row_scores = row_ids[best], scores[best]
+
+        results = []
+        for row, score in zip(rows, row_scores):
+            if score < min_score:
+                break
+            document = self._document(int(row))
+            results.append(SearchResult(document["text"], document.get("source", ""), float(score)))
+        return results
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """球面 k-means でクラスタ中心を求める（学習には最大 100,000 件の標本を使う）"""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), 100_000), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        # クラスタごとの合計をまとめて計算（メンバーがいないクラスタは前の中心のまま）
+        order = np.argsort(assignments, kind="stable")
+        present, starts = np.unique(assignments[order], return_index=True)
+        centroids[present] = np.add.reduceat(sample[order], starts, axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 50_000) -> np.ndarray:
+    """各ベクトルを最も近いクラスタに割り当てる（メモリを抑えるため分割して計算）"""
+    return np.concatenate([
+        np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), batch_size)
+    ])
+
+
+def _write_atomic(path: str, write) -> None:
+    """一時ファイルに書いてから置き換える（読み込み中のプロセスに中途半端なファイルを見せない）"""
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _remove_old_versions(directory: str, keep: set[str]) -> None:
+    """keep 以外のバージョンのフォルダと、古い形式のファイルを削除"""
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in keep or name == _CURRENT_FILE:
+            continue
+        if os.path.isdir(path) and name.startswith("v"):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name in (_META_FILE, "embeddings.npy", "documents.jsonl", "offsets.npy", "centroids.npy", "list_offsets.npy"):
+            os.remove(path)
+
+
+def build_index(
+    directory: str,
+    documents: list[dict],
+    embeddings: np.ndarray,
+    model: str,
+    n_lists: int = None,
+) -> None:
+    """
+    インデックスを作成（既存のインデックスは置き換える）
+
+    新しいバージョンのフォルダに書き終えてから CURRENT を切り替える（検索側には新旧どちらかだけが見える）。
+
+    Args:
+        directory: 保存先（index_directory() で作る {RETRIEVAL_INDEX_DIR}/{customer_id}）
+        documents: 文書 [{"text": ..., "source": ...}, ...]
+        embeddings: documents と同じ順の埋め込みベクトル
+        model: 埋め込みモデル名（検索時に同じモデルを使っているか確認する）
+        n_lists: IVF のクラスタ数（None: 件数から自動で決める / 0: 使わない）
+    """
+    os.makedirs(directory, exist_ok=True)
+    previous = _version_directory(directory)
+    version = f"v{time.time_ns()}-{os.getpid()}"
+    customer_directory, directory = directory, os.path.join(directory, version)
+    os.makedirs(directory)
+    vectors = normalize(embeddings)
+
+    if n_lists is None:
+        n_lists = 0 if len(vectors) < IVF_MIN_DOCUMENTS else int(np.sqrt(len(vectors)))
+
+    list_offsets = None
+    centroids = None
+    if n_lists:
+        centroids = _kmeans(vectors, n_lists)
+        assignments = _assign(vectors, centroids)
+        # 同じクラスタの行が連続するよう並べ替える（検索時に連続した範囲だけを読む）
+        order = np.argsort(assignments, kind="stable")
+        vectors = vectors[order]
+        documents = [documents[i] for i in order]
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    lines = [
+        (json.dumps({"text": d["text"], "source": d.get("source", "")}, ensure_ascii=False) + "\n").encode()
+        for d in documents
+    ]
+    offsets = np.concatenate([[0], np.cumsum([len(line) for line in lines])]).astype(np.int64)
+
+    def write_documents(path):
+        with open(path, "wb") as f:
+            f.writelines(lines)
+
+    def write_npy(array):
+        def write(path):
+            with open(path, "wb") as f:
+                np.save(f, array)
+        return write
+
+    # 新しいバージョンのフォルダは検索側からまだ見えないため、直接書いてよい
+    write_npy(vectors)(os.path.join(directory, "embeddings.npy"))
+    write_documents(os.path.join(directory, "documents.jsonl"))
+    write_npy(offsets)(os.path.join(directory, "offsets.npy"))
+    if n_lists:
+        write_npy(centroids)(os.path.join(directory, "centroids.npy"))
+        write_npy(list_offsets.astype(np.int64))(os.path.join(directory, "list_offsets.npy"))
+
+    meta = {"model": model, "count": len(vectors), "dim": int(vectors.shape[1]), "lists": n_lists}
+    with open(os.path.join(directory, _META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    def write_current(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(version)
+
+    # CURRENT を置き換えた時点で、検索側が新しいバージョンを読み直す
+    _write_atomic(os.path.join(customer_directory, _CURRENT_FILE), write_current)
+    # 直前のバージョンは、切り替えの瞬間に読み込みを始めたプロセスのために残す
+    _remove_old_versions(customer_directory, keep={version, os.path.basename(previous)})
+    logger.info(f"ベクトルインデックスを作成: {directory}（{len(vectors)} 件, クラスタ数 {n_lists}）")
+
+
+class IndexStore:
+    """
+    顧客別インデックスの読み込み・キャッシュ
+
+    インデックスは初回の検索時に読み込み、上限付きの LRU で保持する。
+    作り直されたインデックスは次の検索時に自動で読み直す。
+    """
+
+    def __init__(self, root_dir: str, max_indexes: int = 32):
+        self.root_dir = root_dir
+        self._cache = BoundedCache(max_size=max_indexes, name="ベクトルインデックス")
+
+    def get(self, customer_id: str) -> VectorIndex:
+        """
+        顧客のインデックスを取得（文書がない場合は空のインデックス）
+
+        Raises:
+            ValueError: 顧客IDにフォルダ名として使えない文字が含まれる
+        """
+        directory = index_directory(self.root_dir, customer_id or "default")
+        index = self._cache.get_or_create(directory, lambda: VectorIndex(directory))
+        if index.is_stale():
+            self._cache.invalidate(directory)
+            index = self._cache.get_or_create(directory, lambda: VectorIndex(directory))
+        return index
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+# プロセス全体で共有するインデックスストア
+_default_store: IndexStore | None = None
+
+
+def get_index_store() -> IndexStore:
+    """共有のインデックスストアを取得（保存先は環境変数 RETRIEVAL_INDEX_DIR）"""
+    global _default_store
+    if _default_store is None:
+        _default_store = IndexStore(config.RETRIEVAL_INDEX_DIR, max_indexes=config.RETRIEVAL_MAX_INDEXES)
+    return _default_store
@@ -7,5 +7,6 @@
 #
 # 詳細は agents/README.md を参照
 from .agent import TemplateAgent
+from .tool_agent import ToolTemplateAgent
 
-__all__ = ["TemplateAgent"]
+__all__ = ["TemplateAgent", "ToolTemplateAgent"]
@@ -30,12 +30,32 @@
 ║                                                                              ║
 ╚══════════════════════════════════════════════════════════════════════════════╝
 """
-from langchain_google_vertexai import ChatVertexAI
-from langgraph.graph import StateGraph, END
+import asyncio
+import logging
+import math
+import threading
+import uuid
+from collections import OrderedDict
 
-from .._base.base_agent import BaseAgent
+import numpy as np
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph import StateGraph, START, END
+
+from .._base.adaptive_limiter import AdaptiveLimiter, get_llm_deadline, get_llm_limiter
+from .._base.answer_cache import SemanticAnswerCache, normalize_question
+from .._base.base_agent import INTERNAL_LLM_TAG, RESPONSE_EVENT, BaseAgent
+from .._base.llm_pool import get_embeddings, get_llm
+from .._base.model_router import COMPLEX, SIMPLE, record_route, select_model
+from .._base.prefix_cache import PrefixCache, get_prefix_cache
+from .._base.scheduler import FairScheduler
+from .._base.token_budget import content_text, estimate_message_tokens, estimate_tokens, trim_messages_to_budget
+from .._base.vector_index import IndexStore, get_index_store
 from .state import AgentState
 
+logger = logging.getLogger(__name__)
+
 
 class TemplateAgent(BaseAgent):
     """
@@ -82,62 +102,555 @@ class TemplateAgent(BaseAgent):
     MODEL_NAME = "gemini-1.5-flash"
 
     # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-    # ┃  3️⃣  会話履歴の保持数（MAX_HISTORY_MESSAGES）                         ┃
+    # ┃  3️⃣  会話履歴の保持量（MAX_HISTORY_TOKENS / MAX_HISTORY_MESSAGES）    ┃
     # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
     # ┃  多い → 文脈をよく覚える、でもコスト増                                ┃
     # ┃  少ない → コスト抑える、でも忘れやすい                                ┃
     # ┃                                                                       ┃
-    # ┃  目安: 10〜30 が一般的                                                ┃
+    # ┃  MAX_HISTORY_TOKENS: プロンプト全体のトークン数の上限                 ┃
+    # ┃    （システムプロンプト込み。古い会話から順に削られる）               ┃
+    # ┃    目安: 4000〜16000                                                  ┃
+    # ┃  MAX_HISTORY_MESSAGES: 件数の上限（トークン数に余裕があっても適用）   ┃
+    # ┃    目安: 10〜30 が一般的                                              ┃
     # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
+    MAX_HISTORY_TOKENS = 8000
     MAX_HISTORY_MESSAGES = 20
 
+    # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+    # ┃  4️⃣  古い会話の要約（ENABLE_SUMMARY）                                 ┃
+    # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+    # ┃  True  → 履歴から外れた古い会話を要約して覚えておく                   ┃
+    # ┃          （長い会話でも文脈を失わず、プロンプトの大きさは一定）       ┃
+    # ┃  False → 履歴から外れた会話は忘れる（要約の LLM 呼び出しなし）        ┃
+    # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+    ENABLE_SUMMARY = False
+
+    # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+    # ┃  5️⃣  システムプロンプトのキャッシュ（ENABLE_PREFIX_CACHE）            ┃
+    # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+    # ┃  True  → SYSTEM_PROMPT を Vertex AI 側にキャッシュして使い回す        ┃
+    # ┃          （応答開始が速くなり、入力トークンの料金も下がる）           ┃
+    # ┃  ※ 参考資料を SYSTEM_PROMPT に含めるような大きなプロンプト向け       ┃
+    # ┃    PREFIX_CACHE_MIN_TOKENS 未満のプロンプトはキャッシュされません     ┃
+    # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+    ENABLE_PREFIX_CACHE = False
+
+    # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+    # ┃  6️⃣  質問の難しさでモデルを使い分け（ENABLE_MODEL_ROUTING）           ┃
+    # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+    # ┃  True  → 簡単な質問は "simple"、難しい質問は "complex" のモデルを使う ┃
+    # ┃  False → 常に MODEL_NAME を使う                                       ┃
+    # ┃                                                                       ┃
+    # ┃  顧客ごとに Firestore の customers/{id}.model_routing で上書き可能     ┃
+    # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+    ENABLE_MODEL_ROUTING = False
+    MODEL_ROUTES = {
+        SIMPLE: "gemini-1.5-flash",
+        COMPLEX: "gemini-1.5-pro",
+    }
+
+    # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+    # ┃  7️⃣  顧客の文書を検索して回答（ENABLE_RETRIEVAL）                     ┃
+    # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+    # ┃  True  → 質問に近い文書を検索し、参考資料としてAIに渡す               ┃
+    # ┃  False → 検索しない                                                   ┃
+    # ┃                                                                       ┃
+    # ┃  文書の登録: python scripts/ingest_documents.py --customer-id ...     ┃
+    # ┃  RETRIEVAL_TOP_K: 参考資料として渡す文書の数（目安: 3〜8）            ┃
+    # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+    ENABLE_RETRIEVAL = False
+    RETRIEVAL_TOP_K = 4
+
+    # ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+    # ┃  8️⃣  よくある質問の回答を使い回す（ENABLE_ANSWER_CACHE）              ┃
+    # ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+    # ┃  True  → 意味の近い質問が以前にあれば、LLM を呼ばずに同じ回答を返す   ┃
+    # ┃  False → 毎回 LLM で回答する                                          ┃
+    # ┃                                                                       ┃
+    # ┃  ANSWER_CACHE_THRESHOLD: 同じ質問とみなす類似度（0〜1、高いほど厳密） ┃
+    # ┃    顧客ごとに customers/{id}.answer_cache_threshold で上書き可能       ┃
+    # ┃  ※ 会話の途中の質問（文脈に依存する）は対象外                         ┃
+    # ┃  ※ 回答は同じ顧客のユーザー全員で共有される（ユーザーごとに異なる     ┃
+    # ┃     回答をするエージェントでは使わないこと）                          ┃
+    # ┃  ※ 日時や在庫など、毎回変わる情報を答えるエージェントでは使わないこと ┃
+    # ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+    ENABLE_ANSWER_CACHE = False
+    ANSWER_CACHE_THRESHOLD = 0.92
+
     # ╔═══════════════════════════════════════════════════════════════════════╗
     # ║                                                                       ║
     # ║   🔒 ここから下は通常変更不要（上級者向け）                             ║
     # ║                                                                       ║
     # ╚═══════════════════════════════════════════════════════════════════════╝
 
-    def __init__(self, checkpointer=None, project_id: str = None, location: str = "asia-northeast1"):
-        super().__init__(checkpointer)
+    # 生成パラメータ（同じ値のエージェント同士で LLM クライアントを共有する）
+    TEMPERATURE = 0.7
+    MAX_OUTPUT_TOKENS = 2048
+
+    # 要約を更新するのは、履歴から外れた未要約のメッセージがこの件数以上溜まったとき
+    SUMMARY_MIN_MESSAGES = 4
+
+    # Vertex AI のコンテキストキャッシュの最小サイズ（Gemini 1.5 の場合）
+    PREFIX_CACHE_MIN_TOKENS = 32768
+
+    # 文書検索の設定
+    EMBEDDING_MODEL = "text-embedding-004"  # インデックス作成時と同じモデルを使うこと
+    RETRIEVAL_MIN_SCORE = 0.5               # これ未満の類似度の文書は参考資料にしない
+    RETRIEVAL_NPROBE = 8                    # 大きなインデックス（IVF）で検索するクラスタ数
+
+    # 回答キャッシュの設定
+    ANSWER_CACHE_MAX_HISTORY = 0            # 過去のメッセージがこの件数以下のターンだけ対象（0: 最初の質問のみ）
+    ANSWER_CACHE_MAX_ENTRIES = 1000         # 保存する回答の上限
+    ANSWER_CACHE_TTL_SECONDS = 86400        # 回答を使い回す期間（秒）
+
+    SUMMARY_PROMPT = """あなたは会話の要約担当です。
+「これまでの要約」と「新しい会話」を統合し、今後の回答に必要な事実・ユーザーの要望・決定事項を
+箇条書きで簡潔にまとめてください。要約だけを出力してください。"""
+
+    def __init__(
+        self,
+        checkpointer=None,
+        project_id: str = None,
+        location: str = "asia-northeast1",
+        customer_id: str = None,
+        llm=None,
+        prefix_cache: PrefixCache = None,
+        settings_loader=None,
+        embeddings=None,
+        index_store: IndexStore = None,
+        scheduler: FairScheduler = None,
+        llm_limiter: AdaptiveLimiter = None,
+    ):
+        """
+        Args:
+            checkpointer: 状態を永続化するためのチェックポインター
+            project_id: GCPプロジェクトID
+            location: Vertex AI のリージョン
+            customer_id: 顧客ID（プレフィックスキャッシュのキーに使用）
+            llm: 使用する LLM（省略時は共有プールの ChatVertexAI。テストでは FakeChatModel を渡す）
+            prefix_cache: プレフィックスキャッシュ（省略時はプロセス共有の Vertex AI キャッシュ）
+            settings_loader: 顧客設定（Firestore の customers/{id}）を返す関数
+                             モデルの振り分けルール・回答キャッシュの閾値の上書きに使う
+            embeddings: 埋め込みモデル（省略時は共有プールの VertexAIEmbeddings。テストでは FakeEmbeddings）
+            index_store: 文書のインデックス（省略時は RETRIEVAL_INDEX_DIR の共有ストア）
+            scheduler: 実行の順番待ち（省略時はプロセス共有のスケジューラー）
+            llm_limiter: LLM の同時呼び出し数の制限（省略時はプロセス共有のリミッター）
+        """
+        super().__init__(checkpointer, scheduler)
         self.project_id = project_id
         self.location = location
+        self.customer_id = customer_id
+
+        # システムプロンプトの推定トークン数（履歴の予算から先に差し引く）
+        self._system_prompt_tokens = estimate_tokens(self.SYSTEM_PROMPT)
+
+        # LLM はプロセス共有のプールから借りる（モデルの振り分けで使うモデルは初回使用時に取得）
+        self._injected_llm = llm
+        self.llm = self._get_llm(self.MODEL_NAME)
+        self.settings_loader = settings_loader
+        # クォータ超過時は同時呼び出し数を下げて再試行する（プロセス全体で共有）
+        self.llm_limiter = llm_limiter or get_llm_limiter()
+
+        # プレフィックスキャッシュ（有効かつプロンプトが十分大きい場合のみ）
+        self.prefix_cache = None
+        if self.ENABLE_PREFIX_CACHE and self._system_prompt_tokens >= self.PREFIX_CACHE_MIN_TOKENS:
+            self.prefix_cache = prefix_cache or get_prefix_cache()
 
-        self.llm = ChatVertexAI(
-            model=self.MODEL_NAME,
-            project=project_id,
-            location=location,
-            temperature=0.7,
-            max_tokens=2048,
-            streaming=True,
+        # 文書検索（埋め込みモデルは初回の検索時に取得）
+        self._embeddings = embeddings
+        self.index_store = index_store or (get_index_store() if self.ENABLE_RETRIEVAL else None)
+        # 質問の埋め込み（回答キャッシュと文書検索で同じ質問を二度計算しない）
+        # エージェントは複数のリクエストのスレッドで共有するため、ロックで守る
+        self._query_vectors: OrderedDict[str, list[float]] = OrderedDict()
+        self._query_vectors_lock = threading.Lock()
+
+        # 回答キャッシュ（このエージェント＝この顧客の質問だけを保存する）
+        # 顧客内のユーザー間では共有する（FAQ の回答を使い回すため。ユーザー固有の情報を含む
+        # ツールの結果を使った回答・会話の途中の回答は保存しない）
+        self.answer_cache = None
+        if self.ENABLE_ANSWER_CACHE:
+            self.answer_cache = SemanticAnswerCache(
+                max_entries=self.ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=self.ANSWER_CACHE_TTL_SECONDS
+            )
+
+    @property
+    def embeddings(self):
+        """埋め込みモデル（共有プールから取得）"""
+        if self._embeddings is None:
+            self._embeddings = get_embeddings(self.EMBEDDING_MODEL, project=self.project_id, location=self.location)
+        return self._embeddings
+
+    def _get_llm(self, model_name: str):
+        """モデル名に対応する LLM を取得（llm を渡された場合は常にそれを使う）"""
+        if self._injected_llm is not None:
+            return self._injected_llm
+        return get_llm(
+            model_name,
+            project=self.project_id,
+            location=self.location,
+            temperature=self.TEMPERATURE,
+            max_tokens=self.MAX_OUTPUT_TOKENS,
         )
 
     def create_graph(self) -> StateGraph:
-        """LangGraphのグラフを作成"""
+        """
+        LangGraphのグラフを作成
+
+        ENABLE_RETRIEVAL = True の場合、chat ノードの前に文書検索ノードを実行する。
+        ENABLE_ANSWER_CACHE = True の場合、最初に回答キャッシュを探し、見つかればそのまま終了する。
+
+            START ─→ (answer_cache →) (retrieve →) chat ─→ END
+
+        ENABLE_SUMMARY = True の場合の要約の更新はグラフに含めず、応答を返した後に
+        after_turn() で実行する（グラフは並列のノードもすべて終わるまで戻らないため、
+        グラフの中で要約すると応答の待ち時間に含まれてしまう）。
+        """
         graph = StateGraph(AgentState)
         graph.add_node("chat", self._chat_node)
-        graph.set_entry_point("chat")
         graph.add_edge("chat", END)
+        self._add_entry_edges(graph)
         return graph
 
+    def _entry_node(self) -> str:
+        """ターンの最初に実行するノード"""
+        if self.ENABLE_ANSWER_CACHE:
+            return "answer_cache"
+        return "retrieve" if self.ENABLE_RETRIEVAL else "chat"
+
+    def _add_entry_edges(self, graph: StateGraph) -> None:
+        """START から chat ノードまでの経路（回答キャッシュ・文書検索）を追加"""
+        after_cache = "chat"
+        if self.ENABLE_RETRIEVAL:
+            graph.add_node("retrieve", self._retrieve_node)
+            graph.add_edge("retrieve", "chat")
+            after_cache = "retrieve"
+
+        if self.ENABLE_ANSWER_CACHE:
+            graph.add_node("answer_cache", self._answer_cache_node)
+            graph.add_conditional_edges(
+                "answer_cache",
+                lambda state: END if state["messages"][-1].type == "ai" else after_cache,
+                [after_cache, END],
+            )
+
+        graph.add_edge(START, self._entry_node())
+
     def get_initial_state(self) -> dict:
-        return {"messages": []}
+        return {"messages": [], "token_counts": {}}
 
-    def _trim_messages(self, messages: list) -> list:
-        """メッセージ履歴を直近N件に制限"""
-        if len(messages) <= self.MAX_HISTORY_MESSAGES:
-            return messages
-        return messages[-self.MAX_HISTORY_MESSAGES:]
+    def _count_tokens(self, messages: list, token_counts: dict) -> tuple[list[int], dict]:
+        """
+        各メッセージの推定トークン数を取得（保存済みの値を再利用）
 
-    async def _chat_node(self, state: AgentState) -> dict:
-        """チャットノード: ユーザー入力に対してLLMで応答"""
+        Returns:
+            tuple: (messages と同じ順のトークン数, 新しく計算した分 {message_id: tokens})
+        """
+        counts = []
+        new_counts = {}
+        for message in messages:
+            count = token_counts.get(message.id)
+            if count is None:
+                count = estimate_message_tokens(message)
+                new_counts[message.id] = count
+            counts.append(count)
+        return counts, new_counts
+
+    def _trim_messages(self, messages: list, counts: list[int], reserved_tokens: int = 0) -> list:
+        """
+        メッセージ履歴をトークン予算と件数の上限に収める
+
+        古い会話からユーザーの発言ごとのまとまりで削り、最新のユーザー発言以降
+        （ツールの呼び出しと結果を含む）は必ず残す。
+
+        Args:
+            reserved_tokens: 履歴以外に使うトークン数（要約など）
+        """
+        budget = self.MAX_HISTORY_TOKENS - self._system_prompt_tokens - reserved_tokens
+        return trim_messages_to_budget(messages, counts, budget, self.MAX_HISTORY_MESSAGES)
+
+    def _history_window(self, state: AgentState) -> tuple[list, dict, int]:
+        """
+        今回のプロンプトに含める履歴を決める
+
+        Returns:
+            tuple: (含めるメッセージ, 新しく計算したトークン数, 含める最初のメッセージの位置)
+        """
         messages = state["messages"]
-        trimmed_messages = self._trim_messages(messages)
+        counts, new_counts = self._count_tokens(messages, state.get("token_counts") or {})
+        context_tokens = sum(estimate_tokens(block) for block in self._context_blocks(state))
+        trimmed = self._trim_messages(messages, counts, context_tokens)
+        return trimmed, new_counts, len(messages) - len(trimmed)
+
+    def _context_blocks(self, state: AgentState) -> list[str]:
+        """システムプロンプトに追加する情報（会話の要約・参考資料）"""
+        blocks = []
+        summary = state.get("summary")
+        if summary:
+            blocks.append(f"【これまでの会話の要約】\n{summary}")
+        retrieved = state.get("retrieved") if self.ENABLE_RETRIEVAL else None
+        if retrieved:
+            documents = "\n\n".join(
+                f"[{i}] {doc['text']}" + (f"（出典: {doc['source']}）" if doc.get("source") else "")
+                for i, doc in enumerate(retrieved, 1)
+            )
+            blocks.append(f"【参考資料】（回答に関係する場合のみ使うこと）\n{documents}")
+        return blocks
+
+    def _system_prompt(self, state: AgentState) -> str:
+        """システムプロンプト（要約・参考資料があれば末尾に追加）"""
+        return "\n\n".join([self.SYSTEM_PROMPT, *self._context_blocks(state)])
+
+    def _latest_user_text(self, state: AgentState) -> str:
+        """最新のユーザー発言（ツールの実行結果の後でも、ユーザーの発言を返す）"""
+        latest = next((m for m in reversed(state["messages"]) if m.type == "human"), state["messages"][-1])
+        return content_text(latest.content)
+
+    async def _get_prefix_cache_id(self, model_name: str, llm) -> str | None:
+        """
+        システムプロンプトのキャッシュ ID を取得（キャッシュはモデルごと）
+
+        Returns:
+            キャッシュ ID。キャッシュを使わない・作成に失敗した場合は None
+        """
+        if self.prefix_cache is None:
+            return None
+        key = PrefixCache.make_key(type(self).__name__, self.customer_id, model_name, self.SYSTEM_PROMPT)
+        cache_id = self.prefix_cache.lookup(key)
+        if cache_id or self.prefix_cache.is_backing_off(key):
+            return cache_id
+        # 作成・延長は API を呼ぶため、イベントループを止めないよう別スレッドで実行
+        return await asyncio.to_thread(self.prefix_cache.ensure, key, llm, self.SYSTEM_PROMPT)
+
+    async def _customer_settings(self) -> dict:
+        """顧客設定を取得（設定の読み込み関数がなければ空）"""
+        if self.settings_loader is None:
+            return {}
+        # Firestore から読む場合があるため、イベントループを止めないよう別スレッドで実行
+        return await asyncio.to_thread(self.settings_loader) or {}
+
+    async def scheduling_weight(self) -> float:
+        """顧客設定（customers/{id} の scheduler.weight）の重み（省略時・不正な値は 1）"""
+        if self.settings_loader is None:
+            return 1.0
+        scheduler_settings = (await self._customer_settings()).get("scheduler") or {}
+        if not isinstance(scheduler_settings, dict):
+            logger.warning(f"scheduler が辞書ではないため重み 1 を使います: customer_id={self.customer_id}, value={scheduler_settings!r}")
+            return 1.0
+        weight = scheduler_settings.get("weight", 1.0)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not math.isfinite(weight) or weight <= 0:
+            logger.warning(f"scheduler.weight が不正なため 1 を使います: customer_id={self.customer_id}, value={weight!r}")
+            return 1.0
+        return float(weight)
+
+    async def _embed_query(self, text: str) -> list[float]:
+        """質問の埋め込みを計算（直近の 128 件の質問は再利用）"""
+        with self._query_vectors_lock:
+            vector = self._query_vectors.get(text)
+            if vector is not None:
+                self._query_vectors.move_to_end(text)
+                return vector
+        # API の呼び出し中はロックを持たない（同じ質問が同時に来たら、それぞれ計算する）
+        vector = await self.embeddings.aembed_query(text)
+        with self._query_vectors_lock:
+            self._query_vectors[text] = vector
+            self._query_vectors.move_to_end(text)
+            while len(self._query_vectors) > 128:
+                self._query_vectors.popitem(last=False)
+        return vector
+
+    async def _select_model(self, state: AgentState) -> str:
+        """最新のユーザー発言の難しさから、使うモデルを選ぶ"""
+        if not self.ENABLE_MODEL_ROUTING:
+            return self.MODEL_NAME
+
+        customer_routes = (await self._customer_settings()).get("model_routing")
+        # ツールの結果の後に呼ばれる場合も、ツールの結果ではなくユーザーの発言で判定する
+        route, model_name = select_model(self._latest_user_text(state), self.MODEL_ROUTES, customer_routes)
+        record_route(self.customer_id, route, model_name)
+        return model_name
+
+    async def _retrieve_node(self, state: AgentState) -> dict:
+        """
+        文書検索ノード: 最新のユーザー発言に近い顧客の文書を検索する
 
-        full_messages = [
-            {"role": "system", "content": self.SYSTEM_PROMPT},
-            *trimmed_messages
+        文書が登録されていない顧客の場合は、埋め込みの API も呼ばずに終わる。
+        インデックスの読み込み・埋め込みの計算・検索に失敗した場合は、参考資料なしで回答する。
+        """
+        try:
+            # 初回はファイルを開くため、イベントループを止めないよう別スレッドで実行
+            index = await asyncio.to_thread(self.index_store.get, self.customer_id)
+            if not len(index):
+                return {"retrieved": []}
+            if index.meta.get("model") != self.EMBEDDING_MODEL:
+                # 別のモデルで作ったベクトルとは比較できない
+                logger.warning(
+                    f"インデックスの埋め込みモデルが異なります: customer_id={self.customer_id}, "
+                    f"index={index.meta.get('model')}, agent={self.EMBEDDING_MODEL}"
+                )
+                return {"retrieved": []}
+
+            vector = await self._embed_query(normalize_question(self._latest_user_text(state)))
+            results = index.search(
+                np.asarray(vector, dtype=np.float32),
+                k=self.RETRIEVAL_TOP_K,
+                nprobe=self.RETRIEVAL_NPROBE,
+                min_score=self.RETRIEVAL_MIN_SCORE,
+            )
+        except Exception as e:
+            logger.warning(f"文書検索に失敗しました（参考資料なしで回答します）: customer_id={self.customer_id}, error={e}")
+            return {"retrieved": []}
+        return {"retrieved": [{"text": r.text, "source": r.source, "score": r.score} for r in results]}
+
+    def _answer_cacheable(self, state: AgentState) -> bool:
+        """このターンの質問を回答キャッシュの対象にするか（文脈に依存しない質問のみ）"""
+        if self.answer_cache is None:
+            return False
+        latest = max(i for i, m in enumerate(state["messages"]) if m.type == "human")
+        return latest <= self.ANSWER_CACHE_MAX_HISTORY
+
+    async def _answer_cache_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """
+        回答キャッシュノード: 意味の近い質問の回答があれば、LLM を呼ばずに返す
+
+        見つかった場合は AI のメッセージを追加し、グラフはそのまま終了する。
+        埋め込みの計算・検索に失敗した場合は、キャッシュを使わずに LLM で回答する。
+        """
+        if not self._answer_cacheable(state):
+            return {}
+
+        question = normalize_question(self._latest_user_text(state))
+        try:
+            answer = self.answer_cache.lookup_exact(question, self.SYSTEM_PROMPT)
+            if answer is None:
+                settings = await self._customer_settings()
+                threshold = settings.get("answer_cache_threshold", self.ANSWER_CACHE_THRESHOLD)
+                vector = await self._embed_query(question)
+                answer = self.answer_cache.lookup(question, vector, threshold, self.SYSTEM_PROMPT)
+        except Exception as e:
+            logger.warning(f"回答キャッシュの検索に失敗しました（LLM で回答します）: customer_id={self.customer_id}, error={e}")
+            return {}
+        if answer is None:
+            return {}
+
+        # ストリーミングで実行している場合にも、応答の本文を届ける
+        await adispatch_custom_event(RESPONSE_EVENT, {"text": answer}, config=config)
+        response = AIMessage(content=answer, id=str(uuid.uuid4()))
+        return {"messages": [response], "token_counts": {response.id: estimate_message_tokens(response)}}
+
+    async def _store_answer(self, state: AgentState, response) -> None:
+        """LLM の回答を回答キャッシュに保存（失敗しても回答はそのまま返す）"""
+        if getattr(response, "tool_calls", None) or not self._answer_cacheable(state):
+            return
+        # ツールの結果を使った回答は、その時点の情報（ユーザー固有の情報を含む）に依存するため保存しない
+        if state["messages"][-1].type != "human":
+            return
+        question = normalize_question(self._latest_user_text(state))
+        try:
+            vector = await self._embed_query(question)
+            self.answer_cache.store(question, vector, content_text(response.content), self.SYSTEM_PROMPT)
+        except Exception as e:
+            logger.warning(f"回答キャッシュへの保存に失敗しました: customer_id={self.customer_id}, error={e}")
+
+    def has_after_turn(self) -> bool:
+        return self.ENABLE_SUMMARY
+
+    async def after_turn(self, thread_id: str, deadline: float = None) -> None:
+        """
+        応答を返した後に、履歴から外れたメッセージを要約に統合する
+
+        更新した要約は次のターンから使われる。失敗した場合や間に合わなかった場合は、
+        summarized_count が進まないため、次のターンの後に改めて要約する。
+        """
+        config = {"configurable": {"thread_id": thread_id}}
+        if deadline is not None:
+            config["configurable"]["deadline"] = deadline
+        snapshot = await self.graph.aget_state(config)
+        if not snapshot.values:
+            return
+        update = await self._summarize(snapshot.values, config)
+        if update:
+            await self.graph.aupdate_state(config, update)
+
+    @staticmethod
+    def _summary_line(message) -> str:
+        """要約に渡す会話の1行（ツールの呼び出し・結果も、誰の発言か分かるようにする）"""
+        text = content_text(message.content)
+        if message.type == "human":
+            return f"ユーザー: {text}"
+        if message.type == "tool":
+            return f"ツール（{getattr(message, 'name', None) or '不明'}）の結果: {text}"
+        tool_calls = getattr(message, "tool_calls", None)
+        if tool_calls and not text:
+            return f"AI: （ツールを呼び出し: {', '.join(call['name'] for call in tool_calls)}）"
+        return f"AI: {text}"
+
+    async def _summarize(self, state: AgentState, config: RunnableConfig) -> dict:
+        """
+        履歴から外れたメッセージを、これまでの要約に統合する
+
+        Returns:
+            dict: {"summary", "summarized_count"}（要約するほど溜まっていなければ空）
+        """
+        _, _, window_start = self._history_window(state)
+        if window_start - state.get("summarized_count", 0) < self.SUMMARY_MIN_MESSAGES:
+            return {}
+        evicted = state["messages"][state.get("summarized_count", 0):window_start]
+
+        conversation = "\n".join(self._summary_line(m) for m in evicted)
+        prompt = [
+            {"role": "system", "content": self.SUMMARY_PROMPT},
+            {"role": "user", "content": (
+                f"【これまでの要約】\n{state.get('summary') or '（なし）'}\n\n"
+                f"【新しい会話】\n{conversation}"
+            )},
         ]
+        # 要約の出力はユーザーへの応答に混ぜない（INTERNAL_LLM_TAG でストリーミング対象外にする）
+        result = await self.llm_limiter.call(
+            lambda: self.llm.ainvoke(prompt, config={"tags": [INTERNAL_LLM_TAG]}),
+            deadline=get_llm_deadline(config),
+        )
+        return {"summary": content_text(result.content), "summarized_count": window_start}
+
+    def _bind_llm(self, llm, state: AgentState):
+        """LLM に呼び出し時の設定を付ける（ツールを使うエージェントはここで bind_tools する）"""
+        return llm
+
+    async def _chat_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """チャットノード: ユーザー入力に対してLLMで応答"""
+        trimmed_messages, new_counts, _ = self._history_window(state)
+
+        model_name = await self._select_model(state)
+        llm = self._get_llm(model_name)
+
+        cache_id = await self._get_prefix_cache_id(model_name, llm)
+        if cache_id:
+            # システムプロンプトはキャッシュ済み: 送るのは要約・参考資料と履歴だけ
+            context_messages = [
+                {"role": "user", "content": block} for block in self._context_blocks(state)
+            ]
+            messages = [*context_messages, *trimmed_messages]
+            invoke_kwargs = {"cached_content": cache_id}
+        else:
+            messages = [
+                {"role": "system", "content": self._system_prompt(state)},
+                *trimmed_messages
+            ]
+            invoke_kwargs = {}
+        # クォータ超過・一時的な障害は、締め切りまでの範囲で再試行する
+        response = await self.llm_limiter.call(
+            lambda: self._bind_llm(llm, state).ainvoke(messages, **invoke_kwargs),
+            deadline=get_llm_deadline(config),
+        )
 
-        response = await self.llm.ainvoke(full_messages)
-        return {"messages": [response]}
+        # 応答のトークン数もここで計算して保存（次のターンで再計算しない）
+        if response.id is None:
+            response.id = str(uuid.uuid4())
+        new_counts[response.id] = estimate_message_tokens(response)
+        await self._store_answer(state, response)
+        return {"messages": [response], "token_counts": new_counts}
@@ -3,10 +3,15 @@
 
 LangGraphで管理する状態の型を定義します。
 """
-from typing import Annotated, TypedDict
+from typing import Annotated, NotRequired, TypedDict
 from langgraph.graph.message import add_messages
 
 
+def merge_dicts(left: dict, right: dict) -> dict:
+    """辞書をマージするリデューサー（新しい値で上書き）"""
+    return {**(left or {}), **(right or {})}
+
+
 class AgentState(TypedDict):
     """
     エージェントの状態
@@ -14,5 +19,19 @@ class AgentState(TypedDict):
     Attributes:
         messages: 会話履歴。add_messagesアノテーションにより
                   新しいメッセージが自動的に追加される
+        token_counts: 各メッセージの推定トークン数 {message_id: tokens}
+                      一度計算した値を保存し、毎ターン再計算しないようにする
+        summary: 履歴から外れた古い会話の要約（ENABLE_SUMMARY = True の場合）
+        summarized_count: 要約に含めたメッセージ数（messages の先頭から何件目までか）
+        retrieved: 今回の質問で検索した参考資料 [{"text": ..., "source": ..., "score": ...}]
+                   （ENABLE_RETRIEVAL = True の場合、毎ターン上書き）
+
+    【注意】
+    summary / summarized_count / retrieved は get_initial_state() に含めないこと。
+    入力に含めると、毎ターン保存済みの値を上書きしてしまう。
     """
     messages: Annotated[list, add_messages]
+    token_counts: Annotated[dict, merge_dicts]
+    summary: NotRequired[str]
+    summarized_count: NotRequired[int]
+    retrieved: NotRequired[list[dict]]
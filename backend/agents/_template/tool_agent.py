@@ -0,0 +1,151 @@
+"""
+ツールを使うエージェント（TemplateAgent のツール対応版）
+
+データベースの検索や社内 API の呼び出しなど、
+AI が必要に応じて「ツール」を呼び出して回答するエージェントです。
+
+【処理の流れ】
+    START → chat ─┬─→ END                （ツール呼び出しがなければ回答して終了）
+                  └─→ tools → chat → …   （ツールの結果を見て再度回答）
+
+AI が1回の応答で複数のツールを要求した場合は、同時に実行します。
+（順番に実行する場合の「合計時間」ではなく、「一番遅いツールの時間」で済む）
+
+ツールを MAX_TOOL_ROUNDS 回使ったターンでは、ツールを呼べない状態で LLM を呼び、
+それまでの結果で回答させます（結果のないツール呼び出しを会話に残さないため）。
+
+【使い方】
+1. 下の TOOLS にツールを追加（@tool を付けた関数）
+2. main.py の AGENTS 辞書に登録
+    AGENTS = {"template-tools": ToolTemplateAgent}
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+from langgraph.graph import StateGraph, END
+
+from .._base.parallel_tools import ParallelToolExecutor
+from .._base.token_budget import content_text, estimate_message_tokens
+from .agent import TemplateAgent
+from .state import AgentState
+
+logger = logging.getLogger(__name__)
+
+
+# ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+# ┃  🔧 ツールの定義                                                      ┃
+# ┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+# ┃  @tool を付けた関数がツールになります                                 ┃
+# ┃  docstring が AI への説明になるので、いつ使うかを具体的に書く         ┃
+# ┃  時間のかかる処理は async def で定義する                              ┃
+# ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+@tool
+def get_current_time() -> str:
+    """現在の日本時間を返す。日付や時刻に関する質問に答えるときに使う。"""
+    return datetime.now(timezone(timedelta(hours=9))).strftime("%Y-%m-%d %H:%M")
+
+
+class ToolTemplateAgent(TemplateAgent):
+    """
+    ツールを使うテンプレートエージェント
+
+    顧客別にコピーしてカスタマイズしてください。
+    """
+
+    SYSTEM_PROMPT = """あなたは親切で丁寧なAIアシスタントです。
+必要に応じてツールを使い、正確な情報に基づいて回答してください。
+日本語で回答してください。"""
+
+    # AI が使えるツール
+    TOOLS = [get_current_time]
+
+    # ツールの実行設定
+    MAX_PARALLEL_TOOLS = 4        # 1ターンで同時に実行するツールの上限
+    TOOL_TIMEOUT_SECONDS = 10     # ツールのタイムアウト（秒）
+    TOOL_TIMEOUTS = {}            # ツールごとのタイムアウト 例: {"search_orders": 30}
+    TOOL_CACHE_SECONDS = {}       # 結果をキャッシュするツール 例: {"get_product_info": 300}
+                                  # ※ 書き込みなど副作用のあるツールは指定しないこと
+    MAX_TOOL_ROUNDS = 5           # 1ターンでツールを呼ぶ回数の上限（無限ループ防止）
+
+    # 上限に達してもツールを要求し、本文もなかった場合の回答
+    TOOL_LIMIT_MESSAGE = "申し訳ありません。必要な情報を取得しきれなかったため、回答できませんでした。質問を分けて再度お試しください。"
+
+    # ツール定義はコンテキストキャッシュに含められないため、プレフィックスキャッシュは使わない
+    ENABLE_PREFIX_CACHE = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tool_executor = ParallelToolExecutor(
+            self.TOOLS,
+            max_concurrency=self.MAX_PARALLEL_TOOLS,
+            timeout_seconds=self.TOOL_TIMEOUT_SECONDS,
+            timeouts=self.TOOL_TIMEOUTS,
+            cache_seconds=self.TOOL_CACHE_SECONDS,
+        )
+
+    def create_graph(self) -> StateGraph:
+        """
+        LangGraphのグラフを作成
+
+        chat ノードの応答にツール呼び出しが含まれていれば tools ノードで実行し、
+        結果を持って chat ノードに戻る。
+        """
+        graph = StateGraph(AgentState)
+        graph.add_node("chat", self._chat_node)
+        graph.add_node("tools", self._tools_node)
+        graph.add_conditional_edges("chat", self._route_after_chat, ["tools", END])
+        graph.add_edge("tools", "chat")
+        self._add_entry_edges(graph)
+        return graph
+
+    def _tool_rounds(self, state: AgentState) -> int:
+        """今回のユーザー発言以降にツールを実行した回数"""
+        rounds = 0
+        for message in reversed(state["messages"]):
+            if message.type == "human":
+                break
+            if message.type == "ai" and message.tool_calls:
+                rounds += 1
+        return rounds
+
+    def _bind_llm(self, llm, state: AgentState):
+        """
+        ツールを使えるようにした LLM を返す
+
+        上限に達したターンでは、ツールの定義は渡したまま呼び出しだけを禁止する
+        （履歴にあるツールの呼び出しと結果を LLM が解釈できるように、定義は残す）。
+        """
+        if self._tool_rounds(state) >= self.MAX_TOOL_ROUNDS:
+            return llm.bind_tools(self.TOOLS, tool_choice="none")
+        return llm.bind_tools(self.TOOLS)
+
+    async def _chat_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """
+        チャットノード（上限に達したターンでは、残ったツール呼び出しを取り除く）
+
+        tool_choice="none" を守らないモデルもあるため、念のため保存前にも確認する。
+        結果のないツール呼び出しがチェックポイントに残ると、以降のターンが失敗し続ける。
+        """
+        result = await super()._chat_node(state, config)
+        response = result["messages"][-1]
+        if not response.tool_calls or self._tool_rounds(state) < self.MAX_TOOL_ROUNDS:
+            return result
+
+        logger.warning(f"ツールの呼び出し回数が上限に達しました: customer_id={self.customer_id}")
+        answer = AIMessage(content=content_text(response.content) or self.TOOL_LIMIT_MESSAGE, id=response.id)
+        result["token_counts"][answer.id] = estimate_message_tokens(answer)
+        return {"messages": [answer], "token_counts": result["token_counts"]}
+
+    def _route_after_chat(self, state: AgentState) -> str:
+        """ツール呼び出しがあれば tools へ、なければ終了（上限の処理は _chat_node で行う）"""
+        return "tools" if getattr(state["messages"][-1], "tool_calls", None) else END
+
+    async def _tools_node(self, state: AgentState) -> dict:
+        """ツールノード: 直前の AI の応答が要求したツールを並列に実行"""
+        tool_messages = await self.tool_executor.run(state["messages"][-1].tool_calls)
+        _, new_counts = self._count_tokens(tool_messages, {})
+        return {"messages": tool_messages, "token_counts": new_counts}
@@ -0,0 +1,168 @@
+"""
+顧客別の同時実行数制限（バルクヘッド）
+
+共通バックエンドでは、1つの顧客が長い質問を大量に送ると全ワーカーが LLM の応答待ちで埋まり、
+他の顧客のリクエストが AI_TIMEOUT_SECONDS まで待たされてしまいます。
+顧客ごとに LLM 呼び出しの枠（区画）を分け、1つの顧客の負荷が他の顧客に波及しないようにします。
+
+【仕組み】
+- 顧客ごとに同時に実行できる LLM 呼び出しの数（max_concurrent）を決める
+- 枠が空いていなければ待ち行列に並ぶ（到着順。最大 max_queue 件、最大 queue_timeout 秒）
+- 待ち行列も満杯なら、待たせずにすぐ BulkheadFull（→ 503 + Retry-After）
+- 待ち時間の上限を過ぎたら BulkheadTimeout（→ 503 + Retry-After）
+
+【顧客ごとの設定】
+Firestore の customers/{customer_id} ドキュメントで上書きできます。
+    bulkhead: {max_concurrent: 4, max_queue: 8}
+
+【注意】
+インスタンス内でのみ有効（インスタンスごとに max_concurrent まで実行できる）。
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Hashable
+
+# Retry-After の上限（秒）
+_MAX_RETRY_AFTER_SECONDS = 60
+
+# LLM 呼び出し時間の移動平均の重み（Retry-After の見積もりに使う）
+_SERVICE_TIME_ALPHA = 0.2
+
+
+class BulkheadRejected(Exception):
+    """枠が空かず受け付けられなかった"""
+
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(retry_after)
+
+
+class BulkheadFull(BulkheadRejected):
+    """待ち行列が満杯"""
+
+
+class BulkheadTimeout(BulkheadRejected):
+    """待ち時間の上限を過ぎた"""
+
+
+@dataclass
+class _Compartment:
+    """1顧客分の区画（Bulkhead._lock を取った状態で操作する）"""
+    in_flight: int = 0
+    waiters: deque = field(default_factory=deque)   # 到着順の threading.Event
+    service_seconds: float = 0.0                    # LLM 呼び出し時間の移動平均
+    admitted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    waited: int = 0                                 # 待ち行列に並んでから実行できた件数
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+class Bulkhead:
+    """
+    顧客ごとの同時実行数制限（スレッドセーフ）
+
+    使い方:
+        with bulkhead.acquire(customer_id):
+            ...  # LLM を呼ぶ処理
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 16, queue_timeout: float = 10):
+        """
+        Args:
+            max_concurrent: 顧客ごとの同時実行数のデフォルト
+            max_queue: 顧客ごとの待ち行列の長さのデフォルト
+            queue_timeout: 待ち行列で待つ最大秒数
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._compartments: dict[Hashable, _Compartment] = {}
+        self._lock = threading.Lock()
+
+    def _retry_after(self, compartment: _Compartment, limit: int) -> int:
+        """待ち行列が空くまでのおおよその秒数（self._lock を取った状態で呼ぶ）"""
+        estimate = compartment.service_seconds * (len(compartment.waiters) + 1) / limit
+        return min(_MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(estimate)))
+
+    @contextmanager
+    def acquire(self, key: Hashable, max_concurrent: int = None, max_queue: int = None, timeout: float = None):
+        """
+        枠を1つ確保する（ブロックを抜けると解放）
+
+        Args:
+            key: 顧客ID
+            max_concurrent: この顧客の同時実行数（省略時はデフォルト）
+            max_queue: この顧客の待ち行列の長さ（省略時はデフォルト）
+            timeout: 待ち行列で待つ最大秒数（省略時はデフォルト）
+
+        Raises:
+            BulkheadFull: 待ち行列が満杯
+            BulkheadTimeout: timeout 秒以内に枠が空かなかった
+        """
+        limit = max(1, max_concurrent or self.max_concurrent)
+        queue_limit = self.max_queue if max_queue is None else max_queue
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self._lock:
+            compartment = self._compartments.setdefault(key, _Compartment())
+            if compartment.in_flight < limit and not compartment.waiters:
+                compartment.in_flight += 1
+                compartment.admitted += 1
+                waiter = None
+            elif len(compartment.waiters) >= queue_limit:
+                compartment.rejected += 1
+                raise BulkheadFull(self._retry_after(compartment, limit))
+            else:
+                waiter = threading.Event()
+                compartment.waiters.append(waiter)
+
+        if waiter is not None:
+            queued_at = time.monotonic()
+            waiter.wait(timeout)
+            wait_seconds = time.monotonic() - queued_at
+            with self._lock:
+                # 時間切れと同時に枠を譲られた場合は、譲られた枠を使う
+                if not waiter.is_set():
+                    compartment.waiters.remove(waiter)
+                    compartment.timed_out += 1
+                    raise BulkheadTimeout(self._retry_after(compartment, limit))
+                compartment.waited += 1
+                compartment.wait_seconds_total += wait_seconds
+                compartment.wait_seconds_max = max(compartment.wait_seconds_max, wait_seconds)
+                compartment.admitted += 1
+
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started_at
+            with self._lock:
+                compartment.service_seconds += _SERVICE_TIME_ALPHA * (elapsed - compartment.service_seconds)
+                # 待っている人がいれば枠をそのまま譲る（in_flight は変えない）
+                if compartment.waiters and compartment.in_flight <= limit:
+                    compartment.waiters.popleft().set()
+                else:
+                    compartment.in_flight -= 1
+
+    def stats(self) -> dict:
+        """顧客ごとの実行中・待ち行列の件数と待ち時間"""
+        with self._lock:
+            return {
+                str(key): {
+                    "in_flight": c.in_flight,
+                    "queue_depth": len(c.waiters),
+                    "admitted": c.admitted,
+                    "rejected": c.rejected,
+                    "timed_out": c.timed_out,
+                    "wait_seconds_avg": c.wait_seconds_total / c.waited if c.waited else 0.0,
+                    "wait_seconds_max": c.wait_seconds_max,
+                    "service_seconds_avg": c.service_seconds,
+                }
+                for key, c in self._compartments.items()
+            }
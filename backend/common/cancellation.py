@@ -0,0 +1,110 @@
+"""
+実行中のリクエストの取り消し
+
+クライアントが切断した場合、Gateway が POST /chat/cancel で Backend に知らせます。
+Backend は該当するリクエストのエージェントの実行（asyncio のタスク）を取り消し、
+誰も受け取らない応答の生成（Vertex AI の課金）を止めます。
+
+【リクエストID】
+Gateway が転送ごとに X-Request-Id ヘッダーを付ける。
+取り消しは同じ顧客のリクエストに限る（他の顧客のリクエストは取り消せない）。
+1つのリクエストIDに複数のタスク（/chat/batch の各項目）を登録でき、まとめて取り消す。
+
+【取り消しが先に届いた場合】
+認証や順番待ちの間に取り消しが届くこともあるため、
+取り消されたリクエストIDをしばらく覚えておき、後から登録されたタスクは実行を始める前に打ち切る。
+
+【注意】
+インスタンス内でのみ有効。Gateway が揃えるのは転送先のエンドポイント（Cloud Run のサービス）までで、
+取り消しが処理中のリクエストとは別のインスタンスに届くこともある。
+その場合は取り消されず、締め切りで打ち切られる。
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Hashable
+
+# 取り消したリクエストIDを覚えておく秒数・件数
+_CANCELLED_KEY_TTL_SECONDS = 120
+_CANCELLED_KEY_MAX_ENTRIES = 10000
+
+
+class CancellationRegistry:
+    """
+    実行中のタスクの登録・取り消し（スレッドセーフ）
+
+    Attributes:
+        cancelled: 実行中に取り消した件数
+        cancelled_before_start: 実行を始める前に取り消した件数
+    """
+
+    def __init__(self):
+        self._tasks: dict[Hashable, list[tuple[asyncio.AbstractEventLoop, asyncio.Task]]] = {}
+        self._cancelled_keys: OrderedDict[Hashable, float] = OrderedDict()   # {キー: 取り消しを受けた時刻}
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.cancelled_before_start = 0
+
+    @contextmanager
+    def register(self, key: Hashable, task: asyncio.Task):
+        """
+        タスクを取り消し可能として登録（ブロックを抜けると登録を解除）
+
+        既に取り消しが届いていた場合は、すぐにタスクを取り消す。
+        """
+        entry = (task.get_loop(), task)
+        with self._lock:
+            if key in self._cancelled_keys:
+                self.cancelled_before_start += 1
+                task.cancel()
+                entry = None
+            else:
+                self._tasks.setdefault(key, []).append(entry)
+        try:
+            yield
+        finally:
+            if entry is not None:
+                with self._lock:
+                    entries = self._tasks.get(key, [])
+                    if entry in entries:
+                        entries.remove(entry)
+                    if not entries:
+                        self._tasks.pop(key, None)
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        キーに登録されたタスクをすべて取り消す（後から登録されるタスクも始まる前に打ち切る）
+
+        Returns:
+            True: 実行中のタスクを取り消した / False: まだ始まっていない
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self._tasks.pop(key, [])
+            self.cancelled += len(entries)
+            self._cancelled_keys[key] = now
+            self._cancelled_keys.move_to_end(key)
+            while self._cancelled_keys and (
+                len(self._cancelled_keys) > _CANCELLED_KEY_MAX_ENTRIES
+                or now - next(iter(self._cancelled_keys.values())) > _CANCELLED_KEY_TTL_SECONDS
+            ):
+                self._cancelled_keys.popitem(last=False)
+
+        for loop, task in entries:
+            try:
+                # タスクは別スレッドのイベントループで動いているため、そのループ上で取り消す
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # イベントループが既に閉じている（処理は終わっている）
+                pass
+        return bool(entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": sum(len(entries) for entries in self._tasks.values()),
+                "cancelled": self.cancelled,
+                "cancelled_before_start": self.cancelled_before_start,
+            }
@@ -0,0 +1,135 @@
+"""
+レスポンス圧縮モジュール
+
+クライアントの Accept-Encoding に応じて、レスポンスを gzip / brotli で圧縮します。
+
+【なぜ Backend で圧縮するのか？】
+圧縮は「1か所だけ」で行う。Gateway で圧縮すると
+Backend → Gateway 間は非圧縮のまま、さらに Gateway の CPU を消費する。
+Backend で圧縮し、Gateway は圧縮済みのバイト列をそのまま中継する（展開しない）。
+
+【仕組み】
+- 通常のレスポンス: 閾値（COMPRESSION_MIN_BYTES）以上なら一括で圧縮
+- ストリーミングレスポンス（SSE など）: チャンクごとに圧縮してフラッシュ
+  → イベントが圧縮器の中に溜まらず、すぐにクライアントへ届く
+
+【brotli について】
+brotli パッケージがインストールされている場合のみ使用します（任意）。
+なければ gzip だけを使います。
+"""
+import zlib
+from typing import Iterable, Iterator
+from flask import Flask, request
+from .config import config
+
+try:
+    import brotli
+except ImportError:  # 任意の依存関係
+    brotli = None
+
+# 圧縮する Content-Type（画像などの圧縮済みデータは対象外）
+_COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson")
+
+# 優先する順番（brotli の方が圧縮率が高い）
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# brotli の品質（0〜11）: 動的なレスポンスでは速度を優先して中程度にする
+_BROTLI_QUALITY = 5
+
+
+class StreamCompressor:
+    """チャンクごとにフラッシュできる圧縮器"""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=_BROTLI_QUALITY)
+        else:
+            # wbits=31: gzip 形式（ヘッダー・フッター付き）で出力
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        """data を圧縮し、ここまでの内容をすべて出力する（フラッシュ）"""
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """圧縮を終了し、残りのデータを出力する"""
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def compress_stream(chunks: Iterable[bytes], encoding: str, level: int) -> Iterator[bytes]:
+    """ストリーミングレスポンスをチャンクごとに圧縮"""
+    compressor = StreamCompressor(encoding, level)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def compress_bytes(data: bytes, encoding: str, level: int) -> bytes:
+    """レスポンス全体を一括で圧縮"""
+    if encoding == "br":
+        return brotli.compress(data, quality=_BROTLI_QUALITY)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _is_compressible(response) -> bool:
+    """圧縮対象のレスポンスか"""
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return False
+    return (response.mimetype or "").startswith(_COMPRESSIBLE_TYPES)
+
+
+def compress_response(response):
+    """
+    レスポンスを圧縮（after_request フック）
+
+    Args:
+        response: Flask のレスポンス
+
+    Returns:
+        圧縮済み（または元のままの）レスポンス
+    """
+    if not _is_compressible(response):
+        return response
+
+    # 同じ URL でも Accept-Encoding によって中身が変わることをキャッシュに伝える
+    response.vary.add("Accept-Encoding")
+
+    encoding = request.accept_encodings.best_match(SUPPORTED_ENCODINGS)
+    if not encoding:
+        return response
+
+    level = config.COMPRESSION_LEVEL
+    if response.is_streamed:
+        original = response.response
+        response.response = compress_stream(response.iter_encoded(), encoding, level)
+        # 元のイテレータの後始末（ジェネレータの finally など）が実行されるようにする
+        if hasattr(original, "close"):
+            response.call_on_close(original.close)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config.COMPRESSION_MIN_BYTES:
+            return response
+        response.set_data(compress_bytes(data, encoding, level))
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def setup_compression(app: Flask) -> None:
+    """
+    Flaskアプリにレスポンス圧縮を適用
+
+    Args:
+        app: Flaskアプリケーションインスタンス
+    """
+    app.after_request(compress_response)
@@ -29,6 +29,58 @@ class Config:
     # レート制限のデフォルト値（Firestoreの設定で上書き可能）
     DEFAULT_RATE_LIMIT = 10  # 1分あたりの最大リクエスト数
 
+    # レスポンス圧縮（Accept-Encoding に応じて gzip / brotli）
+    COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))  # これ未満は圧縮しない
+    COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))  # gzip の圧縮レベル（1〜9）
+
+    # エージェントキャッシュ（共通バックエンドで多数の顧客を扱う場合のメモリ上限）
+    AGENT_CACHE_MAX_SIZE = int(os.getenv("AGENT_CACHE_MAX_SIZE", "256"))  # 保持するエージェント数の上限
+    AGENT_CACHE_IDLE_TTL_SECONDS = int(os.getenv("AGENT_CACHE_IDLE_TTL_SECONDS", "0"))  # 未使用で削除するまでの秒数（0: 無期限）
+
+    # 再送の重複処理防止（Idempotency-Key の結果を保存する秒数）
+    IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "300"))
+
+    # 顧客別の同時実行数制限（Firestore の customers/{customer_id}.bulkhead で上書き可能）
+    BULKHEAD_MAX_CONCURRENT = int(os.getenv("BULKHEAD_MAX_CONCURRENT", "8"))  # 顧客ごとの同時 LLM 呼び出し数
+    BULKHEAD_MAX_QUEUE = int(os.getenv("BULKHEAD_MAX_QUEUE", "16"))  # 顧客ごとの待ち行列の長さ（超えたら 503）
+    BULKHEAD_QUEUE_TIMEOUT_SECONDS = float(os.getenv("BULKHEAD_QUEUE_TIMEOUT_SECONDS", "10"))  # 待ち行列で待つ最大秒数
+
+    # 全顧客で共有する実行枠（混雑時は顧客の重み・優先度に応じた順番で実行）
+    SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "32"))
+
+    # Vertex AI のクォータに合わせた同時呼び出し数の自動調整（クォータ超過で半分、成功で少しずつ増やす）
+    LLM_CONCURRENCY_INITIAL = float(os.getenv("LLM_CONCURRENCY_INITIAL", "16"))  # 起動時の同時呼び出し数
+    LLM_CONCURRENCY_MIN = float(os.getenv("LLM_CONCURRENCY_MIN", "1"))  # 下限
+    LLM_CONCURRENCY_MAX = float(os.getenv("LLM_CONCURRENCY_MAX", "64"))  # 上限
+    LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))  # クォータ超過時の最大試行回数
+
+    # 一括チャット（POST /chat/batch。評価・回帰テスト用）
+    BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))  # 1回の一括チャットの最大件数
+    BATCH_MAX_CONCURRENT = int(os.getenv("BATCH_MAX_CONCURRENT", "4"))  # 同時に実行する項目数の上限（顧客の max_concurrent 以下になる）
+    BATCH_ITEMS_PER_MINUTE = int(os.getenv("BATCH_ITEMS_PER_MINUTE", "1000"))  # 顧客ごとの1分あたりの項目数の上限（customers/{id}.batch_items_per_minute で上書き可能）
+
+    # 非同期ジョブ（POST /jobs。/chat の制限時間に収まらない長い処理）
+    JOB_STORE = os.getenv("JOB_STORE", "firestore")  # ジョブの保存先（firestore / memory）
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # ジョブを実行するワーカースレッドの数
+    JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "100"))  # 待ち行列の最大件数（超えたら 503）
+    JOB_MAX_PENDING_PER_CUSTOMER = int(os.getenv("JOB_MAX_PENDING_PER_CUSTOMER", "20"))  # 顧客ごとの未完了のジョブの上限
+    JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "900"))  # 1件のジョブの締め切り（待ち時間を含む）
+    JOB_LONG_POLL_MAX_SECONDS = float(os.getenv("JOB_LONG_POLL_MAX_SECONDS", "25"))  # GET /jobs/{id}?wait= の上限
+
+    # 応答を返した後の処理（会話の要約の更新など。応答の待ち時間に含めない）
+    AFTER_TURN_WORKERS = int(os.getenv("AFTER_TURN_WORKERS", "4"))  # 実行するスレッドの数
+    AFTER_TURN_TIMEOUT_SECONDS = float(os.getenv("AFTER_TURN_TIMEOUT_SECONDS", "60"))  # 1回の締め切り（スレッドのロック待ちを含む）
+
+    # 運用メトリクス（GET /metrics）のアクセストークン（未設定の場合は無効）
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+    # 段階ごとの処理時間を Server-Timing レスポンスヘッダーで返すか（false: ログとメトリクスのみ）
+    SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+
+    # 文書検索（顧客別のベクトルインデックス）
+    RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "./indexes")  # インデックスの保存先
+    RETRIEVAL_MAX_INDEXES = int(os.getenv("RETRIEVAL_MAX_INDEXES", "32"))  # 同時に読み込むインデックス数の上限
+
     # =============================================
     # 顧客別設定（Cloud Functions デプロイ時に設定）
     # =============================================
@@ -20,6 +20,7 @@ def setup_cors(app: Flask) -> None:
         app,
         origins=config.ALLOWED_ORIGINS,
         supports_credentials=True,
-        allow_headers=["Content-Type", "Authorization"],
+        allow_headers=["Content-Type", "Authorization", "Idempotency-Key"],
+        expose_headers=["X-Thread-Id", "Idempotent-Replayed", "Retry-After", "Location"],
         methods=["GET", "POST", "OPTIONS"]
     )
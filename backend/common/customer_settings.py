@@ -0,0 +1,48 @@
+"""
+顧客設定モジュール
+
+Firestore の customers/{customer_id} ドキュメントを読み込み、
+顧客ごとの設定（モデルの振り分けルールなど）を提供します。
+
+【キャッシュ】
+毎回 Firestore を読むと遅いので、60秒間キャッシュします。
+設定を変更してから反映されるまで最大60秒かかります。
+"""
+import logging
+import time
+from .firebase_init import db
+
+logger = logging.getLogger(__name__)
+
+# 顧客設定のキャッシュ
+# 形式: {customer_id: (settings, cached_at)}
+_cache: dict[str, tuple[dict, float]] = {}
+_CACHE_TTL_SECONDS = 60
+
+
+def get_customer_settings(customer_id: str) -> dict:
+    """
+    顧客設定を取得（60秒キャッシュ）
+
+    Args:
+        customer_id: 顧客ID
+
+    Returns:
+        customers/{customer_id} ドキュメントの内容（存在しない場合は空の辞書）
+    """
+    current_time = time.time()
+
+    cached = _cache.get(customer_id)
+    if cached and current_time - cached[1] < _CACHE_TTL_SECONDS:
+        return cached[0]
+
+    try:
+        doc = db.collection("customers").document(customer_id).get()
+        settings = doc.to_dict() if doc.exists else {}
+    except Exception as e:
+        # 読み込みに失敗した場合は、古いキャッシュがあればそれを使う（サービス継続を優先）
+        logger.warning(f"顧客設定の取得に失敗しました（customer_id={customer_id}）: {e}")
+        settings = cached[0] if cached else {}
+
+    _cache[customer_id] = (settings, current_time)
+    return settings
@@ -0,0 +1,66 @@
+"""
+リクエストの締め切り（デッドライン）
+
+Gateway はクライアントを待たせる上限から、Backend に残り時間を
+X-Request-Deadline-Ms ヘッダー（ミリ秒）で伝えます。
+Backend はその残り時間を、認証・チェックポイントの読み書き・LLM の呼び出しに割り振り、
+締め切りを過ぎた処理は途中で打ち切ります（誰も受け取らない応答を生成し続けない）。
+
+【残り時間（相対値）で渡す理由】
+絶対時刻で渡すと、Gateway と Backend の時計のずれがそのまま誤差になるため。
+
+【使い方】
+    deadline = Deadline.from_headers(request.headers, default_seconds=55)
+    deadline.check("認証")              # 締め切りを過ぎていたら DeadlineExceeded
+    lock.acquire(timeout=deadline.remaining())
+"""
+import time
+
+# Gateway から残り時間を受け取るヘッダー（ミリ秒）
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+
+class DeadlineExceeded(Exception):
+    """締め切りを過ぎた"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(stage)
+
+
+class Deadline:
+    """締め切り（time.monotonic() の値で保持する）"""
+
+    def __init__(self, timeout_seconds: float):
+        self.at = time.monotonic() + timeout_seconds
+
+    @classmethod
+    def from_headers(cls, headers, default_seconds: float) -> "Deadline":
+        """
+        ヘッダーの残り時間から締め切りを作成
+
+        ヘッダーがない・不正な場合、または default_seconds より長い場合は default_seconds を使う
+        （Backend 自身の実行時間の上限を超えないように）。
+        """
+        try:
+            timeout_seconds = float(headers.get(DEADLINE_HEADER)) / 1000
+        except (TypeError, ValueError):
+            timeout_seconds = default_seconds
+        return cls(min(max(timeout_seconds, 0.0), default_seconds))
+
+    def remaining(self) -> float:
+        """残り秒数（過ぎていれば 0）"""
+        return max(0.0, self.at - time.monotonic())
+
+    def check(self, stage: str) -> None:
+        """
+        締め切りを過ぎていないか確認
+
+        Args:
+            stage: 処理の段階（ログ・メトリクス用）
+
+        Raises:
+            DeadlineExceeded: 締め切りを過ぎている
+        """
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
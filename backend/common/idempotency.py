@@ -0,0 +1,192 @@
+"""
+冪等性キーとスレッド単位の直列化
+
+ネットワークの瞬断などでフロントエンドや Gateway が /chat を再送すると、
+同じ質問で LLM がもう一度呼ばれ、会話履歴にも同じターンが重複して保存されてしまいます。
+
+【冪等性キー（Idempotency-Key ヘッダー）】
+- 同じキーのリクエストが処理中に届いた場合: 新しく処理せず、処理中のリクエストの完了を待って同じ結果を返す
+- 処理済みのキーの場合: 保存した結果をそのまま返す（ttl_seconds の間）
+- 処理に失敗した場合は結果を保存しない（再送で改めて処理できるように）
+- 処理中のリクエストが取り消された場合（元のリクエストのクライアントが切断した）は、
+  完了を待っていた再送が処理を引き継いで実行し直す（再送にまで取り消しのエラーを返さない）
+- 同じキーで内容の違うリクエストが届いた場合は IdempotencyConflict
+
+【スレッド単位の直列化】
+同じ会話スレッド（thread_id）への複数のメッセージが同時に処理されると、
+チェックポイントの読み書きが競合して履歴が欠ける。
+KeyedLocks で同じスレッドのターンを1つずつ処理する。
+
+【注意: インスタンス内でのみ有効（ベストエフォート）】
+どちらもインスタンスのメモリで管理する。Gateway の thread_id による振り分けは
+転送先のエンドポイント（Cloud Run のサービス）を揃えるだけで、サービス内のどのインスタンスが
+受けるかは Cloud Run が決める。そのため複数インスタンスで動かしている場合は:
+- 再送が別のインスタンスに届くと重複を検出できず、LLM がもう一度呼ばれる
+- 同じスレッドへの同時のメッセージが別のインスタンスに届くと、1つずつにはならない
+（どちらもよくある「同じインスタンスへの素早い再送・連打」を防ぐためのもの）
+インスタンスをまたいで保証したい場合は、処理済みの結果と、スレッドごとのリース
+（存在しなければ作成するトランザクション）を Firestore に保存する実装に差し替えること。
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable
+
+
+class IdempotencyConflict(Exception):
+    """同じ冪等性キーで、内容の違うリクエストが送られた"""
+
+
+class LockTimeout(Exception):
+    """キーのロックを時間内に取れなかった"""
+
+
+def request_fingerprint(*parts: str) -> str:
+    """リクエスト内容の指紋（同じキーで内容が違うリクエストの検出に使う）"""
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    future: Future = field(default_factory=Future)
+    completed_at: float | None = None
+
+
+class IdempotencyStore:
+    """
+    冪等性キーごとの処理結果（スレッドセーフ）
+
+    Attributes:
+        replays: 処理中・処理済みの結果を返した回数
+    """
+
+    def __init__(self, ttl_seconds: float = 300, max_entries: int = 10000):
+        """
+        Args:
+            ttl_seconds: 処理済みの結果を保存しておく秒数
+            max_entries: 保存する結果の最大件数（超えたら古いものから削除）
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.replays = 0
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> None:
+        """期限切れ・上限超過の処理済み結果を削除（self._lock を取った状態で呼ぶ）"""
+        # 処理済みの結果は完了順に並んでいる（処理中のものは飛ばす）
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if entry.completed_at is None:
+                continue
+            if now - entry.completed_at <= self.ttl_seconds and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def run(
+        self,
+        key: Hashable,
+        fingerprint: str,
+        func: Callable[[], Any],
+        wait_timeout: float,
+        retry_if: Callable[[BaseException], bool] | None = None,
+    ) -> tuple[Any, bool]:
+        """
+        キーごとに1回だけ func() を実行
+
+        Args:
+            key: 冪等性キー（ユーザーごとに分けること）
+            fingerprint: リクエスト内容の指紋
+            func: 実際の処理
+            wait_timeout: 処理中の同じリクエストの完了を待つ最大秒数
+            retry_if: 処理中のリクエストの例外のうち、待っていた再送が引き継いで
+                      自分の func() を実行し直すものを判定する（例: 取り消し）
+
+        Returns:
+            tuple: (結果, 再送に対して保存済みの結果を返したか)
+
+        Raises:
+            IdempotencyConflict: 同じキーで内容が違う
+            TimeoutError: 処理中の同じリクエストが wait_timeout 内に終わらなかった
+            その他: func() の例外（処理中に待っていた再送にも同じ例外を送る。retry_if に当たるものを除く）
+        """
+        wait_until = time.monotonic() + wait_timeout
+        while True:
+            with self._lock:
+                self._purge(time.monotonic())
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if entry.fingerprint != fingerprint:
+                        raise IdempotencyConflict()
+                    owner = False
+                else:
+                    entry = _Entry(fingerprint)
+                    self._entries[key] = entry
+                    owner = True
+
+            if owner:
+                break
+            try:
+                result = entry.future.result(timeout=max(0.0, wait_until - time.monotonic()))
+            except FutureTimeoutError:
+                raise TimeoutError() from None
+            except BaseException as e:
+                if retry_if is not None and retry_if(e):
+                    # 失敗したエントリは削除済み: 次の周回でこのリクエストが処理を引き継ぐ
+                    continue
+                raise
+            with self._lock:
+                self.replays += 1
+            return result, True
+
+        try:
+            result = func()
+        except BaseException as e:
+            # 失敗した結果は保存しない（再送で改めて処理できるようにする）
+            with self._lock:
+                self._entries.pop(key, None)
+            entry.future.set_exception(e)
+            raise
+
+        with self._lock:
+            entry.completed_at = time.monotonic()
+            self._entries.move_to_end(key)
+        entry.future.set_result(result)
+        return result, False
+
+
+class KeyedLocks:
+    """キーごとのロック（使われていないキーのロックは自動で削除）"""
+
+    def __init__(self):
+        self._locks: dict[Hashable, list] = {}   # {key: [Lock, 使用中の数]}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: Hashable, timeout: float):
+        """
+        キーのロックを取る
+
+        Raises:
+            LockTimeout: timeout 秒以内にロックを取れなかった
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(timeout=timeout):
+                raise LockTimeout()
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
@@ -0,0 +1,361 @@
+"""
+非同期ジョブ（時間のかかるエージェントの実行）
+
+/chat は Cloud Run の60秒制限に収めるため AI_TIMEOUT_SECONDS（55秒）で打ち切ります。
+何段階も考える・ツールを何度も呼ぶエージェントはこの時間に収まらないため、
+HTTP リクエストとは切り離して実行するジョブ API を用意します。
+
+    POST /jobs              → 202 {"job_id": ..., "status": "queued"}
+    GET  /jobs/{job_id}     → 状態と結果（?wait=20 で完了まで最大20秒待つ = ロングポーリング）
+
+【仕組み】
+- 受け付けたジョブは保存してから待ち行列に入れ、すぐに job_id を返す
+- ワーカースレッド（JOB_WORKERS 個）が順に取り出して実行する（締め切りは JOB_TIMEOUT_SECONDS）
+- 処理能力はワーカー数に比例し、HTTP のタイムアウトには左右されない
+- ワーカーはエージェントを一括処理（PRIORITY_BATCH）として実行し、画面で待っているチャットを優先する
+
+【保存先】
+- FirestoreJobStore: customers/{customer_id}/checkpoints/{thread_id}/jobs/{job_id}
+  （会話のチェックポイントの隣に保存する。expires_at に Firestore の TTL ポリシーを設定すると自動で削除される）
+- InMemoryJobStore: ローカル開発・テスト用（インスタンス内のメモリ）
+
+【注意】
+- ワーカーはインスタンス内のスレッドで動く。Cloud Run では「CPU を常に割り当てる」設定にすること
+  （応答を返した後の CPU が絞られると、ジョブの実行が止まる）
+- インスタンスが停止すると、実行中・待ち行列のジョブは失われる。
+  expires_at を過ぎても終わっていないジョブは、取得時に失敗として返す
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+_DONE_STATUSES = frozenset({JOB_SUCCEEDED, JOB_FAILED})
+
+# 保存先にジョブがない場合に、ロングポーリング中に読み直す間隔（秒）
+_POLL_INTERVAL_SECONDS = 1.0
+
+
+class JobQueueFull(Exception):
+    """待ち行列が満杯（または顧客ごとの上限に達した）"""
+
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(retry_after)
+
+
+class JobFailed(Exception):
+    """ジョブの実行に失敗した（message はそのままユーザーに返す）"""
+
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(message)
+
+
+@dataclass
+class Job:
+    """ジョブ1件（時刻は UNIX 時間の秒）"""
+    job_id: str
+    customer_id: str
+    user_id: str
+    thread_id: str
+    agent: str
+    message: str
+    status: str = JOB_QUEUED
+    result: str | None = None
+    error: str | None = None
+    created_at: float = 0.0
+    started_at: float | None = None
+    finished_at: float | None = None
+    expires_at: float = 0.0    # これを過ぎても終わっていなければ失われたとみなす
+
+    @classmethod
+    def create(cls, customer_id: str, user_id: str, thread_id: str, agent: str, message: str,
+               timeout_seconds: float) -> "Job":
+        """新しいジョブを作成（job_id は thread_id を含み、保存先のパスを決められる）"""
+        now = time.time()
+        return cls(
+            job_id=f"{thread_id}.{uuid.uuid4().hex}",
+            customer_id=customer_id,
+            user_id=user_id,
+            thread_id=thread_id,
+            agent=agent,
+            message=message,
+            created_at=now,
+            expires_at=now + timeout_seconds,
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.status in _DONE_STATUSES
+
+    def to_response(self) -> dict:
+        """API のレスポンス用（入力のメッセージは返さない）"""
+        def iso(timestamp):
+            return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "thread_id": self.thread_id,
+            "agent": self.agent,
+            "result": self.result,
+            "error": self.error,
+            "created_at": iso(self.created_at),
+            "started_at": iso(self.started_at),
+            "finished_at": iso(self.finished_at),
+        }
+
+
+def thread_id_of(job_id: str) -> str:
+    """job_id から thread_id を取り出す"""
+    return job_id.rsplit(".", 1)[0]
+
+
+class InMemoryJobStore:
+    """
+    メモリ上のジョブの保存先（ローカル開発・テスト用、スレッドセーフ）
+
+    FirestoreJobStore に差し替える場合も、save() / get() と同じ引数・戻り値にすること。
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._jobs: OrderedDict[tuple, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            # 呼び出し元が後から書き換えても影響しないようにコピーを保存
+            self._jobs[(job.customer_id, job.job_id)] = Job(**asdict(job))
+            self._jobs.move_to_end((job.customer_id, job.job_id))
+            while len(self._jobs) > self.max_entries:
+                self._jobs.popitem(last=False)
+
+    def get(self, customer_id: str, job_id: str) -> Job | None:
+        with self._lock:
+            job = self._jobs.get((customer_id, job_id))
+            return Job(**asdict(job)) if job else None
+
+
+class FirestoreJobStore:
+    """Firestore のジョブの保存先（会話のチェックポイントの隣に保存）"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def _ref(self, customer_id: str, job_id: str):
+        return (
+            self.db.collection("customers")
+            .document(customer_id)
+            .collection("checkpoints")
+            .document(thread_id_of(job_id))
+            .collection("jobs")
+            .document(job_id)
+        )
+
+    def save(self, job: Job) -> None:
+        data = asdict(job)
+        # Firestore の TTL ポリシーは Timestamp 型のフィールドが対象
+        data["expires_at"] = datetime.fromtimestamp(job.expires_at, timezone.utc)
+        self._ref(job.customer_id, job.job_id).set(data)
+
+    def get(self, customer_id: str, job_id: str) -> Job | None:
+        doc = self._ref(customer_id, job_id).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if isinstance(expires_at, datetime):
+            data["expires_at"] = expires_at.timestamp()
+        return Job(**{key: data.get(key) for key in Job.__dataclass_fields__ if key in data})
+
+
+class JobRunner:
+    """
+    ジョブのワーカープール（スレッドセーフ）
+
+    使い方:
+        runner = JobRunner(store, execute=run_job, workers=4)
+        runner.submit(job)
+        job = runner.wait(customer_id, job_id, timeout=20)
+    """
+
+    def __init__(
+        self,
+        store,
+        execute: Callable[[Job], str],
+        workers: int = 4,
+        max_queue: int = 100,
+        max_pending_per_customer: int = 20,
+    ):
+        """
+        Args:
+            store: ジョブの保存先（InMemoryJobStore / FirestoreJobStore）
+            execute: ジョブを実行して結果のテキストを返す関数（失敗は JobFailed）
+            workers: ワーカースレッドの数
+            max_queue: 待ち行列の最大件数（全顧客の合計）
+            max_pending_per_customer: 顧客ごとの未完了のジョブの最大件数
+        """
+        self.store = store
+        self.execute = execute
+        self.workers = workers
+        self.max_pending_per_customer = max_pending_per_customer
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._pending: dict[str, int] = {}                  # {customer_id: 未完了の件数}
+        self._events: dict[str, threading.Event] = {}       # {job_id: 完了の通知}（このインスタンスのジョブのみ）
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.running = 0
+        self._run_seconds_total = 0.0
+
+    def _start(self) -> None:
+        """ワーカースレッドを起動（最初のジョブの受け付け時。self._lock を取った状態で呼ぶ）"""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"job-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job: Job) -> None:
+        """
+        ジョブを保存して待ち行列に入れる
+
+        Raises:
+            JobQueueFull: 待ち行列が満杯・顧客ごとの上限に達した
+        """
+        with self._lock:
+            if self._pending.get(job.customer_id, 0) >= self.max_pending_per_customer or self._queue.full():
+                self.rejected += 1
+                raise JobQueueFull(self._retry_after())
+            self._pending[job.customer_id] = self._pending.get(job.customer_id, 0) + 1
+            self._events[job.job_id] = threading.Event()
+            self._start()
+
+        try:
+            self.store.save(job)
+            self._queue.put_nowait(job)
+        except Exception as e:
+            self._finish(job)
+            if isinstance(e, queue.Full):
+                with self._lock:
+                    self.rejected += 1
+                raise JobQueueFull(self._retry_after()) from None
+            raise
+        with self._lock:
+            self.submitted += 1
+
+    def _retry_after(self) -> int:
+        """待ち行列が空くまでのおおよその秒数"""
+        average = self._run_seconds_total / max(1, self.succeeded + self.failed) or 30
+        return max(1, min(300, int(average * (self._queue.qsize() + 1) / self.workers)))
+
+    def _finish(self, job: Job) -> None:
+        """未完了の件数を減らし、待っている人に知らせる"""
+        with self._lock:
+            self._pending[job.customer_id] -= 1
+            if self._pending[job.customer_id] == 0:
+                del self._pending[job.customer_id]
+            event = self._events.pop(job.job_id, None)
+        if event is not None:
+            event.set()
+
+    def _work(self) -> None:
+        """ワーカースレッドの本体"""
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            except Exception:
+                # 保存先への書き込みに失敗した場合など（ワーカーは止めない）
+                logger.exception(f"ジョブの処理中にエラーが発生: job_id={job.job_id}")
+            finally:
+                self._finish(job)
+
+    def _run(self, job: Job) -> None:
+        """1件のジョブを実行して結果を保存"""
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self.store.save(job)
+        with self._lock:
+            self.running += 1
+
+        try:
+            job.result = self.execute(job)
+            job.status = JOB_SUCCEEDED
+        except JobFailed as e:
+            job.status, job.error = JOB_FAILED, e.message
+        except Exception:
+            logger.exception(f"ジョブの実行に失敗: job_id={job.job_id}")
+            job.status, job.error = JOB_FAILED, "エラーが発生しました。しばらく待ってから再度お試しください。"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self.running -= 1
+                self._run_seconds_total += job.finished_at - job.started_at
+                if job.status == JOB_SUCCEEDED:
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+
+        self.store.save(job)
+
+    def get(self, customer_id: str, job_id: str) -> Job | None:
+        """ジョブを取得（期限を過ぎても終わっていないジョブは失敗として返す）"""
+        job = self.store.get(customer_id, job_id)
+        if job and not job.done and time.time() > job.expires_at:
+            job.status = JOB_FAILED
+            job.error = "ジョブが中断されました。再度お試しください。"
+        return job
+
+    def wait(self, customer_id: str, job_id: str, timeout: float) -> Job | None:
+        """
+        ジョブが終わるまで最大 timeout 秒待って取得（ロングポーリング）
+
+        このインスタンスで実行中のジョブは完了の通知を待ち、
+        別のインスタンスのジョブは保存先を定期的に読み直す。
+        """
+        deadline = time.monotonic() + timeout
+        job = self.get(customer_id, job_id)
+        while job and not job.done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self._lock:
+                event = self._events.get(job_id)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(_POLL_INTERVAL_SECONDS, remaining))
+            job = self.get(customer_id, job_id)
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self._queue.qsize(),
+                "running": self.running,
+                "pending_by_customer": dict(self._pending),
+                "submitted": self.submitted,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
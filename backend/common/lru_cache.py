@@ -0,0 +1,141 @@
+"""
+上限付き LRU キャッシュ
+
+エージェントのように「作るのが重く、メモリも大きい」オブジェクトを
+上限付きでキャッシュします。
+
+【仕組み】
+- 上限（max_size）を超えたら、最も長く使われていないものから削除（LRU）
+- idle_ttl_seconds を指定すると、その秒数使われなかったものも削除
+- 同じキーに同時にアクセスがあっても、作成は1回だけ（後から来た側は完成を待つ）
+
+【統計】
+stats() でサイズ・ヒット率・削除件数を取得できる。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedCache:
+    """
+    上限付き LRU キャッシュ（スレッドセーフ）
+
+    Attributes:
+        hits: キャッシュから返した回数
+        misses: 新しく作成した回数
+        evictions: 上限超過で削除した件数
+        expirations: 一定時間使われず削除した件数
+    """
+
+    def __init__(self, max_size: int, idle_ttl_seconds: float = 0, name: str = "cache"):
+        """
+        Args:
+            max_size: 保持する最大件数
+            idle_ttl_seconds: この秒数使われなかったら削除（0 の場合は無期限）
+            name: ログに出す名前
+        """
+        self.max_size = max_size
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 形式: {key: (value, last_used)}（古く使われた順）
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        # 作成中のキーごとのロック（同時アクセスでの二重作成を防ぐ）
+        self._building: dict[Hashable, threading.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _is_expired(self, last_used: float, now: float) -> bool:
+        return self.idle_ttl_seconds > 0 and now - last_used > self.idle_ttl_seconds
+
+    def _lookup(self, key: Hashable, now: float) -> tuple[bool, Any]:
+        """キーを探し、見つかれば最近使った扱いにする（self._lock を取った状態で呼ぶ）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if self._is_expired(entry[1], now):
+            del self._entries[key]
+            self.expirations += 1
+            return False, None
+        self._entries[key] = (entry[0], now)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def _evict(self, now: float) -> None:
+        """期限切れと上限超過の分を古い順に削除（self._lock を取った状態で呼ぶ）"""
+        while self._entries:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if self._is_expired(last_used, now):
+                self.expirations += 1
+            elif len(self._entries) > self.max_size:
+                self.evictions += 1
+            else:
+                break
+            del self._entries[key]
+            logger.info(f"{self.name} から削除: key={key}")
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        キャッシュから取得（なければ factory() で作成して保存）
+
+        Args:
+            key: キャッシュのキー
+            factory: 値を作成する関数（キャッシュにない場合のみ呼ばれる）
+
+        Returns:
+            キャッシュ済み、または新しく作成した値
+        """
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                return value
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            # 待っている間に他のスレッドが作成していればそれを使う
+            with self._lock:
+                found, value = self._lookup(key, time.monotonic())
+                if found:
+                    return value
+                self.misses += 1
+
+            try:
+                value = factory()
+                with self._lock:
+                    now = time.monotonic()
+                    self._entries[key] = (value, now)
+                    self._evict(now)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+            return value
+
+    def invalidate(self, key: Hashable) -> None:
+        """キーを削除（次回の get_or_create で作り直す）"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """キャッシュの統計を取得"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,467 @@
+"""
+応答の後処理パイプライン
+
+AI の回答を画面に表示する前に加工する処理（ステージ）を、顧客ごとに組み合わせて実行します。
+
+【顧客ごとの設定】
+Firestore の customers/{customer_id} ドキュメントで、ステージを順番に並べます。
+    post_process: [
+      {"type": "replace", "replacements": {"製品A": "製品A（旧名: ProductX）"}},
+      {"type": "regex", "pattern": "\\d{3}-\\d{4}-\\d{4}", "replacement": "***-****-****"},
+      {"type": "markdown_table"}
+    ]
+
+【コンパイル】
+正規表現・キーワード表は、設定を読み込んだときに1回だけコンパイルする（応答ごとには作り直さない）。
+- replace: 多数のキーワードを Aho–Corasick 法で1回の走査でまとめて置換する
+  （str.replace をキーワードの数だけ繰り返すと、応答の長さ × キーワード数の時間がかかる）
+- regex: re.compile 済みのパターンで置換する
+
+【ストリーミング】
+各ステージは、トークンが届くたびに feed() で少しずつ処理できる。
+置換の途中かもしれない末尾の数文字（先読み）だけを保留し、残りはすぐに次に渡すため、
+応答全体が揃うまで待つ必要はない。先読みの長さはステージごとに上限がある。
+- replace: 最長のキーワードの長さ - 1 文字
+- regex: max_match_length 文字（マッチ・先読みはこの長さに収まること）
+- markdown_table: 表の途中の行（max_table_lines 行まで）
+
+【ステージの追加】
+    @register_stage("my_stage")
+    class MyStage(Stage):
+        def stream(self) -> StageStream: ...
+"""
+import html
+import json
+import logging
+import re
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator
+
+from .lru_cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# ステージの種類: {"replace": KeywordReplaceStage, ...}
+_STAGE_TYPES: dict[str, type] = {}
+
+# 正規表現のマッチの長さの上限（ストリーミング時の先読みの長さ）のデフォルト
+_DEFAULT_MAX_MATCH_LENGTH = 256
+
+# 表として保留する最大行数（超えたら表に変換せずそのまま流す）
+_DEFAULT_MAX_TABLE_LINES = 200
+
+
+def register_stage(name: str) -> Callable[[type], type]:
+    """ステージの種類を登録するデコレーター（設定の "type" で指定する名前）"""
+    def decorator(cls: type) -> type:
+        _STAGE_TYPES[name] = cls
+        return cls
+    return decorator
+
+
+class StageStream(ABC):
+    """
+    1回の応答分のステージの状態
+
+    feed() は受け取ったテキストのうち、確定した部分を返す（未確定の末尾は保留する）。
+    finish() は保留していた残りを返す。
+    """
+
+    @abstractmethod
+    def feed(self, text: str) -> str:
+        """テキストを受け取り、確定した部分を返す"""
+        pass
+
+    def finish(self) -> str:
+        """保留していた残りを返す"""
+        return ""
+
+
+class Stage(ABC):
+    """コンパイル済みのステージ（スレッドセーフ。応答ごとの状態は stream() で作る）"""
+
+    @abstractmethod
+    def stream(self) -> StageStream:
+        """1回の応答分の状態を作成"""
+        pass
+
+
+# ===== キーワード置換（Aho–Corasick） =====
+
+class AhoCorasick:
+    """
+    複数のキーワードを1回の走査で探すオートマトン
+
+    重なる候補がある場合は、左から順に、同じ位置からは最も長いキーワードを選ぶ。
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        keywords = [keyword for keyword in keywords if keyword]
+        self.max_length = max((len(keyword) for keyword in keywords), default=0)
+
+        # トライ木: ノードごとの遷移・失敗時の戻り先・そこで終わるキーワードの長さ（長い順）
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._lengths: list[tuple[int, ...]] = [()]
+        for keyword in keywords:
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._lengths.append(())
+                node = next_node
+            self._lengths[node] = (len(keyword),)
+
+        # 幅優先で失敗時の戻り先を求め、戻り先で終わるキーワードも合わせておく
+        # （深さ1のノードの戻り先は根）
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._lengths[child] = tuple(sorted(
+                    set(self._lengths[child]) | set(self._lengths[self._fail[child]]), reverse=True
+                ))
+                queue.append(child)
+
+    def find(self, text: str) -> list[tuple[int, int]]:
+        """
+        重ならないマッチを左から順に返す
+
+        Returns:
+            [(開始位置, 終了位置)]
+        """
+        longest: dict[int, int] = {}   # {開始位置: その位置から始まる最長のマッチの終了位置}
+        goto, fail, lengths = self._goto, self._fail, self._lengths
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            end = index + 1
+            for length in lengths[node]:
+                start = end - length
+                if longest.get(start, 0) < end:
+                    longest[start] = end
+
+        matches = []
+        position = 0
+        for start in sorted(longest):
+            if start >= position:
+                matches.append((start, longest[start]))
+                position = longest[start]
+        return matches
+
+
+@register_stage("replace")
+class KeywordReplaceStage(Stage):
+    """
+    キーワード置換（顧客ごとの用語の補足・言い換えなど）
+
+    設定: {"type": "replace", "replacements": {"置換前": "置換後", ...}}
+    """
+
+    def __init__(self, replacements: dict[str, str]):
+        self.replacements = {str(key): str(value) for key, value in replacements.items() if key}
+        self.automaton = AhoCorasick(self.replacements)
+
+    def apply(self, text: str, final: bool) -> tuple[str, str]:
+        """
+        text を置換し、(確定した出力, 保留する末尾) を返す
+
+        まだ続きが届く場合（final=False）、最長のキーワード - 1 文字より手前から始まるマッチだけ確定する
+        （それ以降から始まるキーワードは、続きの文字で長いキーワードに変わる可能性がある）。
+        """
+        boundary = len(text) if final else len(text) - (self.automaton.max_length - 1)
+        output = []
+        position = 0
+        for start, end in self.automaton.find(text):
+            if start >= boundary:
+                break
+            output.append(text[position:start])
+            output.append(self.replacements[text[start:end]])
+            position = end
+        committed = max(position, boundary)
+        output.append(text[position:committed])
+        return "".join(output), text[committed:]
+
+    def stream(self) -> StageStream:
+        return _BufferedStream(self.apply)
+
+
+class _BufferedStream(StageStream):
+    """未確定の末尾を保留しながら apply(text, final) を繰り返すストリーム"""
+
+    def __init__(self, apply: Callable[[str, bool], tuple[str, str]]):
+        self._apply = apply
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ""
+        output, self._pending = self._apply(self._pending + text, False)
+        return output
+
+    def finish(self) -> str:
+        output, self._pending = self._apply(self._pending, True)
+        return output
+
+
+# ===== 正規表現による置換 =====
+
+@register_stage("regex")
+class RegexReplaceStage(Stage):
+    """
+    正規表現による置換（電話番号のマスクなど）
+
+    設定: {"type": "regex", "pattern": "...", "replacement": "...",
+           "ignore_case": false, "max_match_length": 256}
+    replacement では \\1 や \\g<name> でグループを参照できる。
+    """
+
+    def __init__(self, pattern: str, replacement: str = "", ignore_case: bool = False,
+                 max_match_length: int = _DEFAULT_MAX_MATCH_LENGTH):
+        self.pattern = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        self.replacement = replacement
+        self.max_match_length = max(1, int(max_match_length))
+
+    def apply(self, text: str, final: bool) -> tuple[str, str]:
+        """
+        text を置換し、(確定した出力, 保留する末尾) を返す
+
+        まだ続きが届く場合（final=False）、末尾 max_match_length 文字より手前から始まり、
+        かつ text の末尾に届いていないマッチだけ確定する（末尾に届くマッチは続きの文字で伸びる可能性がある）。
+        """
+        boundary = len(text) if final else len(text) - self.max_match_length
+        output = []
+        position = 0
+        committed = None
+        for match in self.pattern.finditer(text):
+            start, end = match.span()
+            if start >= boundary:
+                break
+            if not final and end >= len(text):
+                committed = start
+                break
+            output.append(text[position:start])
+            output.append(match.expand(self.replacement))
+            position = end
+        if committed is None:
+            committed = max(position, boundary)
+        output.append(text[position:committed])
+        return "".join(output), text[committed:]
+
+    def stream(self) -> StageStream:
+        return _BufferedStream(self.apply)
+
+
+# ===== Markdown の表 → HTML =====
+
+_TABLE_SEPARATOR = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+
+def _split_row(line: str) -> list[str]:
+    """| a | b | を ["a", "b"] に分割"""
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [cell.strip() for cell in line.split("|")]
+
+
+def _alignment(cell: str) -> str | None:
+    if cell.startswith(":") and cell.endswith(":"):
+        return "center"
+    if cell.endswith(":"):
+        return "right"
+    if cell.startswith(":"):
+        return "left"
+    return None
+
+
+def markdown_table_to_html(lines: list[str]) -> str:
+    """Markdown の表（見出し行・区切り行・本文の行）を HTML の表に変換"""
+    header = _split_row(lines[0])
+    aligns = [_alignment(cell) for cell in _split_row(lines[1])]
+
+    def row(cells: list[str], tag: str) -> str:
+        parts = []
+        for index, cell in enumerate(cells):
+            align = aligns[index] if index < len(aligns) else None
+            style = f' style="text-align: {align}"' if align else ""
+            parts.append(f"<{tag}{style}>{html.escape(cell)}</{tag}>")
+        return "<tr>" + "".join(parts) + "</tr>"
+
+    body = [row(_split_row(line), "td") for line in lines[2:]]
+    return (
+        "<table><thead>" + row(header, "th") + "</thead>"
+        + "<tbody>" + "".join(body) + "</tbody></table>\n"
+    )
+
+
+@register_stage("markdown_table")
+class MarkdownTableStage(Stage):
+    """
+    Markdown の表を HTML の表に変換
+
+    設定: {"type": "markdown_table", "max_table_lines": 200}
+    """
+
+    def __init__(self, max_table_lines: int = _DEFAULT_MAX_TABLE_LINES):
+        self.max_table_lines = max(3, int(max_table_lines))
+
+    def stream(self) -> StageStream:
+        return _MarkdownTableStream(self.max_table_lines)
+
+
+class _MarkdownTableStream(StageStream):
+    """
+    行単位で処理し、表の行（| で始まる行）が続く間だけ保留する
+
+    表以外の行は、表の行でないと分かった時点で（行の途中でも）次に渡す。
+    """
+
+    def __init__(self, max_table_lines: int):
+        self.max_table_lines = max_table_lines
+        self._partial = ""            # 表の行かどうかまだ分からない行の途中
+        self._passing = False         # 行の途中だが、表の行ではないと分かってそのまま渡している
+        self._table: list[str] = []   # 保留中の表の行
+
+    def _flush_table(self) -> str:
+        lines, self._table = self._table, []
+        if len(lines) >= 2 and _TABLE_SEPARATOR.match(lines[1]):
+            return markdown_table_to_html(lines)
+        return "".join(line + "\n" for line in lines)
+
+    def _line(self, line: str) -> str:
+        """改行まで届いた1行を処理"""
+        if not line.lstrip().startswith("|"):
+            return self._flush_table() + line + "\n"
+        self._table.append(line)
+        if len(self._table) >= self.max_table_lines:
+            # 保留しすぎないよう、表に変換せずそのまま流す
+            lines, self._table = self._table, []
+            return "".join(table_line + "\n" for table_line in lines)
+        return ""
+
+    def feed(self, text: str) -> str:
+        output = []
+        while text:
+            segment, newline, text = text.partition("\n")
+            if self._passing:
+                output.append(segment + newline)
+                self._passing = not newline
+                continue
+            self._partial += segment
+            if newline:
+                line, self._partial = self._partial, ""
+                output.append(self._line(line))
+            elif self._partial.strip() and not self._partial.lstrip().startswith("|"):
+                output.append(self._flush_table() + self._partial)
+                self._partial, self._passing = "", True
+        return "".join(output)
+
+    def finish(self) -> str:
+        if not self._partial:
+            return self._flush_table()
+        output = self._line(self._partial) + self._flush_table()
+        self._partial = ""
+        # 最後の行には改行がなかったので、付け足した改行を外す
+        return output[:-1] if output.endswith("\n") else output
+
+
+# ===== パイプライン =====
+
+class PipelineStream:
+    """1回の応答分のパイプラインの状態"""
+
+    def __init__(self, streams: list[StageStream]):
+        self._streams = streams
+
+    def feed(self, text: str) -> str:
+        for stream in self._streams:
+            text = stream.feed(text)
+        return text
+
+    def finish(self) -> str:
+        text = ""
+        for stream in self._streams:
+            text = stream.feed(text) + stream.finish()
+        return text
+
+
+class Pipeline:
+    """コンパイル済みのステージの並び"""
+
+    def __init__(self, stages: list[Stage]):
+        self.stages = stages
+
+    def stream(self) -> PipelineStream:
+        return PipelineStream([stage.stream() for stage in self.stages])
+
+    def run(self, text: str) -> str:
+        """テキスト全体を処理"""
+        if not self.stages:
+            return text
+        stream = self.stream()
+        return stream.feed(text) + stream.finish()
+
+    def iter(self, chunks: Iterable[str]) -> Iterator[str]:
+        """トークンのストリームを処理（確定した分から順に返す）"""
+        stream = self.stream()
+        for chunk in chunks:
+            output = stream.feed(chunk)
+            if output:
+                yield output
+        output = stream.finish()
+        if output:
+            yield output
+
+
+def compile_pipeline(specs: list[dict]) -> Pipeline:
+    """
+    設定からパイプラインを作成（不正なステージはログに残して読み飛ばす）
+
+    Args:
+        specs: [{"type": "replace", ...}, ...]
+    """
+    if not isinstance(specs, list):
+        logger.warning(f"後処理の設定はリストで指定してください（後処理なしで続行）: {specs!r}")
+        return Pipeline([])
+
+    stages = []
+    for spec in specs:
+        # 設定は Firestore から来るため、どんな値でもステージ1つを読み飛ばすだけにする
+        # （例外の種類はステージの実装次第: {"replacements": ["a"]} は AttributeError など）
+        try:
+            options = dict(spec)
+            stage_type = _STAGE_TYPES[options.pop("type")]
+            stages.append(stage_type(**options))
+        except Exception as e:
+            logger.warning(f"後処理のステージの設定が不正なため読み飛ばします: {spec!r}: {e!r}")
+    return Pipeline(stages)
+
+
+# コンパイル済みのパイプライン: {(customer_id, 設定のJSON): Pipeline}
+# 顧客設定が変わるとキーも変わるため、古いものは LRU で自然に消える
+_pipelines = BoundedCache(max_size=256, name="後処理パイプライン")
+
+
+def get_pipeline(customer_id: str, specs: list[dict] | None) -> Pipeline:
+    """顧客のパイプラインを取得（設定が変わるまではコンパイル済みのものを使う）"""
+    if not specs:
+        return Pipeline([])
+    key = (customer_id, json.dumps(specs, sort_keys=True, ensure_ascii=False, default=str))
+    return _pipelines.get_or_create(key, lambda: compile_pipeline(specs))
+
+
+def get_pipeline_stats() -> dict:
+    """コンパイル済みのパイプラインのキャッシュの件数・ヒット率"""
+    return _pipelines.stats()
@@ -8,12 +8,22 @@
 - Firestoreにユーザーごとのリクエスト履歴を保存
 - 過去1分間のリクエスト数をカウント
 - 制限を超えた場合はエラーを返す
+
+【一括チャットの項目数の上限】
+一括チャット（/chat/batch）の項目は、ユーザーごとの制限とは別に、
+顧客ごとの1分あたりの項目数（check_batch_quota）で制限する。
+- 顧客の全ユーザーの一括チャットの合計で数える
+- 1分ごとの件数だけを1つのドキュメントに記録する（項目ごとのタイムスタンプは保存しない）
+- 上限は customers/{customer_id}.batch_items_per_minute で顧客ごとに上書き可能
 """
 import logging
+import math
+import time
 from datetime import datetime, timedelta, timezone
 from .firebase_init import db
 from .auth import get_access_control_settings
 from .config import config
+from .customer_settings import get_customer_settings
 
 logger = logging.getLogger(__name__)
 
@@ -89,3 +99,64 @@ def check_rate_limit(user_id: str) -> bool:
             exc_info=True  # スタックトレースも記録
         )
         return True
+
+
+def get_batch_items_per_minute(customer_id: str) -> int:
+    """顧客の一括チャットの1分あたりの項目数の上限（不正な設定はデフォルトを使う）"""
+    value = get_customer_settings(customer_id).get("batch_items_per_minute")
+    if value is None:
+        return config.BATCH_ITEMS_PER_MINUTE
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 1:
+        logger.warning(
+            f"batch_items_per_minute が不正なためデフォルトを使います: customer_id={customer_id}, value={value!r}"
+        )
+        return config.BATCH_ITEMS_PER_MINUTE
+    return int(value)
+
+
+def check_batch_quota(customer_id: str, items: int) -> int:
+    """
+    一括チャットの項目数を、顧客ごとの1分あたりの上限から消費する
+
+    Args:
+        customer_id: 顧客ID
+        items: 項目数（残りが足りなければ1件も消費せずに拒否）
+
+    Returns:
+        0: 許可（項目数ぶん消費した）
+        正の整数: 拒否（Retry-After に設定する秒数）
+
+    副作用:
+        Firestore の batch_quotas/{customer_id} に今の1分間の項目数を記録
+    """
+    limit = get_batch_items_per_minute(customer_id)
+    now = time.time()
+    window = int(now // 60)
+    retry_after = max(1, math.ceil((window + 1) * 60 - now))
+    if items > limit:
+        # 1分間の上限より多い一括チャットは、待っても実行できない
+        return retry_after
+
+    quota_ref = db.collection("batch_quotas").document(customer_id)
+
+    @db.transaction
+    def check_and_record(transaction):
+        doc = quota_ref.get(transaction=transaction)
+        data = doc.to_dict() if doc.exists else {}
+        used = data.get("items", 0) if data.get("window") == window else 0
+
+        if used + items > limit:
+            return retry_after
+
+        transaction.set(quota_ref, {"window": window, "items": used + items})
+        return 0
+
+    try:
+        return check_and_record(db.transaction())
+    except Exception as e:
+        # check_rate_limit と同じく、エラー時は許可（サービス継続を優先）
+        logger.warning(
+            f"一括チャットの項目数の確認中にエラーが発生しました（customer_id={customer_id}）: {e}",
+            exc_info=True
+        )
+        return 0
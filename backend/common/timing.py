@@ -0,0 +1,326 @@
+"""
+リクエストの段階ごとの処理時間の計測
+
+/chat が遅かったとき、どこで時間を使ったのか（認証・レート制限・順番待ち・
+チェックポイントの読み書き・LLM・後処理）を見分けるためのモジュールです。
+
+【計測の方法】
+リクエストごとに RequestTimer を作り、各段階を time.monotonic() で計測して合計する。
+同じ段階が何度も実行される場合（LLM の呼び出し・チェックポイントの書き込みなど）は合計時間になる。
+タイマーは contextvars で受け渡すため、エージェントの中（asyncio のタスク・asyncio.to_thread）からも
+引数を増やさずに計測できる。
+    with timed("llm"):
+        response = await llm.ainvoke(messages)
+
+【出力先】
+- Server-Timing レスポンスヘッダー: ブラウザの開発者ツールで段階ごとの時間を確認できる
+  例: Server-Timing: auth;dur=12.1, rate_limit;dur=8.4, llm;dur=2310.5, total;dur=2402.3
+- ログ: リクエストの終了時に「処理時間: path=/chat status=200 auth=12.1ms ...」を出力する
+  （Cloud Logging の構造化ログには json_fields として同じ内容を渡す）
+- ヒストグラム: 顧客・段階ごとの p50 / p95 / p99（GET /metrics の "timing"）
+
+【ヒストグラム】
+時間を対数で区切ったバケット（隣のバケットとの比 約 1.09 倍）の件数だけを保持する。
+メモリは件数によらず一定で、パーセンタイルの誤差は約 9% 以内。
+値はインスタンスの起動からの累計（インスタンスごとに独立）。
+
+【注意】
+ストリーミングのレスポンス（/chat/batch）は、ヘッダーを先に送るため
+Server-Timing には認証までの時間しか含まれない。一括チャット・非同期ジョブの各項目は
+ヒストグラムにだけ記録する（track() を参照）。
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from flask import Flask, request
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+# ヒストグラムのバケット: 0.1ms から約 1 時間まで、隣との比 2 ** (1/8)
+_BUCKET_MIN_MS = 0.1
+_BUCKET_GROWTH = 2 ** 0.125
+_BUCKET_BOUNDS = [_BUCKET_MIN_MS * _BUCKET_GROWTH ** i for i in range(202)]
+
+# 記録する顧客数の上限（超えたら最も長く記録のない顧客から消す）
+_MAX_CUSTOMERS = 1000
+
+# 全顧客の合計を記録するキー
+ALL_CUSTOMERS = "*"
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """処理時間（ミリ秒）の対数バケットのヒストグラム（スレッドセーフではない。TimingStats のロックの中で使う）"""
+
+    def __init__(self):
+        self._buckets: dict[int, int] = {}   # {バケットの番号: 件数}（使われたバケットだけ）
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float) -> None:
+        index = min(bisect.bisect_left(_BUCKET_BOUNDS, ms), len(_BUCKET_BOUNDS) - 1)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        """p パーセンタイル（そのバケットの上限。最大値は超えない）"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(_BUCKET_BOUNDS[index], self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        result = {"count": self.count}
+        for p in PERCENTILES:
+            result[f"p{p}_ms"] = round(self.percentile(p), 1)
+        result["avg_ms"] = round(self.sum_ms / self.count, 1) if self.count else 0.0
+        result["max_ms"] = round(self.max_ms, 1)
+        return result
+
+
+class TimingStats:
+    """顧客・段階ごとのヒストグラム（スレッドセーフ）"""
+
+    def __init__(self, max_customers: int = _MAX_CUSTOMERS):
+        self.max_customers = max_customers
+        self._histograms: OrderedDict[str, dict[str, Histogram]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, customer_id: str, durations: dict[str, float]) -> None:
+        """
+        1リクエスト分の段階ごとの時間を記録
+
+        Args:
+            customer_id: 顧客ID
+            durations: {段階: 時間（ミリ秒）}
+        """
+        with self._lock:
+            for key in (customer_id, ALL_CUSTOMERS):
+                stages = self._histograms.get(key)
+                if stages is None:
+                    stages = self._histograms[key] = {}
+                self._histograms.move_to_end(key)
+                for stage, ms in durations.items():
+                    histogram = stages.get(stage)
+                    if histogram is None:
+                        histogram = stages[stage] = Histogram()
+                    histogram.record(ms)
+            while len(self._histograms) > self.max_customers + 1:
+                oldest = next(key for key in self._histograms if key != ALL_CUSTOMERS)
+                del self._histograms[oldest]
+
+    def stats(self) -> dict:
+        """{顧客ID: {段階: {"count", "p50_ms", "p95_ms", "p99_ms", "avg_ms", "max_ms"}}}（"*" は全顧客）"""
+        with self._lock:
+            return {
+                customer_id: {stage: histogram.summary() for stage, histogram in sorted(stages.items())}
+                for customer_id, stages in self._histograms.items()
+            }
+
+
+_stats = TimingStats()
+
+
+def get_timing_stats() -> dict:
+    """顧客・段階ごとの処理時間のパーセンタイル"""
+    return _stats.stats()
+
+
+class RequestTimer:
+    """
+    1リクエストの段階ごとの処理時間（ミリ秒）
+
+    エージェントの中では asyncio.to_thread のスレッドからも記録されるため、ロックで守る。
+    """
+
+    def __init__(self, customer_id: str | None = None):
+        self.customer_id = customer_id
+        self.started_at = time.monotonic()
+        self._durations: dict[str, float] = {}   # 記録した順
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._durations[stage] = self._durations.get(stage, 0.0) + seconds * 1000
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ブロックの実行時間を name の段階に加える（例外で抜けた場合も記録する）"""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started_at)
+
+    def durations(self) -> dict[str, float]:
+        """{段階: 時間（ミリ秒）}"""
+        with self._lock:
+            return dict(self._durations)
+
+    def elapsed_ms(self) -> float:
+        """開始からの経過時間（ミリ秒）"""
+        return (time.monotonic() - self.started_at) * 1000
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダーの値（最後に開始からの経過時間を total として付ける）"""
+        entries = [f"{stage};dur={ms:.1f}" for stage, ms in self.durations().items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+    def finish(self, total_stage: str | None = "total") -> dict[str, float]:
+        """
+        計測を終えてヒストグラムに記録（2回目以降は何もしない）
+
+        Args:
+            total_stage: 開始からの経過時間を記録する段階の名前（None なら記録しない）
+
+        Returns:
+            {段階: 時間（ミリ秒）}（total_stage を含む）
+        """
+        durations = self.durations()
+        if total_stage:
+            durations[total_stage] = self.elapsed_ms()
+        with self._lock:
+            if self._finished:
+                return durations
+            self._finished = True
+        if self.customer_id:
+            _stats.record(self.customer_id, durations)
+        return durations
+
+
+_current: ContextVar[RequestTimer | None] = ContextVar("request_timer", default=None)
+
+
+def current_timer() -> RequestTimer | None:
+    """実行中のリクエストのタイマー（リクエストの外では None）"""
+    return _current.get()
+
+
+def set_customer_id(customer_id: str) -> None:
+    """認証で分かった顧客IDを、実行中のリクエストのタイマーに設定"""
+    timer = _current.get()
+    if timer is not None:
+        timer.customer_id = customer_id
+
+
+def add_duration(stage: str, seconds: float) -> None:
+    """
+    計測済みの時間を、実行中のリクエストの stage の段階に加える
+
+    ロックの確保など、with ブロックで囲みにくい待ち時間に使う。
+    """
+    timer = _current.get()
+    if timer is not None:
+        timer.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    ブロックの実行時間を、実行中のリクエストの stage の段階に加える
+
+    リクエストの外（起動時・テストなど）では何もしない。
+    """
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(stage):
+        yield
+
+
+@contextmanager
+def track(customer_id: str) -> Iterator[RequestTimer]:
+    """
+    HTTP リクエストとは別に、1件分の処理時間を計測してヒストグラムに記録する
+
+    一括チャットの各項目・非同期ジョブのように、ワーカースレッドで実行する処理に使う。
+    開始からの経過時間は記録しない（HTTP リクエストの total と混ざらないように）。
+    """
+    timer = RequestTimer(customer_id)
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+        timer.finish(total_stage=None)
+
+
+# ===== Flask への組み込み =====
+
+def _start_request_timer() -> None:
+    """リクエストごとのタイマーを作成（before_request フック）"""
+    _current.set(RequestTimer())
+
+
+def _finish_request_timer(response):
+    """
+    Server-Timing ヘッダーを付け、レスポンスを送り終えたら記録する（after_request フック）
+
+    ヒストグラムの total は、同じ顧客でもエンドポイントごとに分ける
+    （GET /jobs/{id}?wait= の長い待ち時間が /chat の total に混ざらないように）。
+    """
+    timer = _current.get()
+    if timer is None:
+        return response
+
+    if config.SERVER_TIMING_ENABLED:
+        response.headers["Server-Timing"] = timer.server_timing()
+
+    rule = request.url_rule.rule if request.url_rule else "other"
+    method, path, status = request.method, request.path, response.status_code
+
+    def log_timing() -> None:
+        durations = timer.finish(total_stage=f"total {rule}")
+        if timer.customer_id is None:
+            # 認証前に終わったリクエスト（/health・認証エラーなど）はログに出さない
+            return
+        total_ms = durations.pop(f"total {rule}")
+        fields = " ".join(f"{stage}={ms:.1f}ms" for stage, ms in durations.items())
+        logger.info(
+            f"処理時間: method={method} path={path} status={status} "
+            f"customer_id={timer.customer_id} total={total_ms:.1f}ms {fields}".rstrip(),
+            extra={"json_fields": {
+                "method": method,
+                "path": path,
+                "status": status,
+                "customer_id": timer.customer_id,
+                "total_ms": round(total_ms, 1),
+                "timing_ms": {stage: round(ms, 1) for stage, ms in durations.items()},
+            }},
+        )
+
+    # ストリーミングのレスポンスは、送り終えた時点（close）で記録する
+    response.call_on_close(log_timing)
+    return response
+
+
+def setup_timing(app: Flask) -> None:
+    """
+    Flaskアプリに処理時間の計測を適用
+
+    Args:
+        app: Flaskアプリケーションインスタンス
+    """
+    app.before_request(_start_request_timer)
+    app.after_request(_finish_request_timer)
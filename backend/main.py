@@ -9,6 +9,8 @@
 ║                                                                              ║
 ║  📡 エンドポイント:                                                          ║
 ║     POST /chat      → チャットメッセージを処理（同期）                       ║
+║     POST /jobs      → 長い処理を非同期ジョブとして登録                       ║
+║     GET  /jobs/{id} → ジョブの状態と結果（?wait= で完了まで待つ）            ║
 ║     GET  /health    → ヘルスチェック（死活監視用）                           ║
 ║     GET  /agents    → 利用可能なエージェント一覧                             ║
 ║                                                                              ║
@@ -40,10 +42,19 @@ Cloud Run IAM で Backend へのアクセスを Gateway のみに制限するこ
 """
 import os
 import asyncio
+import functools
+import hmac
+import json
+import queue
 import re
+import threading
+import time
 import uuid
 import logging
-from flask import Flask, request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator
+from flask import Flask, Response, request
 import functions_framework
 
 # ロギング設定
@@ -53,13 +64,40 @@ logger = logging.getLogger(__name__)
 # 共通モジュール
 from common.config import config
 from common.cors import setup_cors
+from common.compression import setup_compression
 from common.auth import authenticate_request
-from common.rate_limiter import check_rate_limit
+from common.rate_limiter import check_batch_quota, check_rate_limit
 from common.errors import error_response, success_response
 from common.firebase_init import db
+from common.customer_settings import get_customer_settings
+from common.lru_cache import BoundedCache
+from common.post_process import get_pipeline, get_pipeline_stats
+from common.timing import add_duration, get_timing_stats, set_customer_id, setup_timing, timed, track
+from common.bulkhead import Bulkhead, BulkheadFull, BulkheadRejected
+from common.cancellation import CancellationRegistry
+from common.deadline import Deadline, DeadlineExceeded
+from common.jobs import (
+    FirestoreJobStore,
+    InMemoryJobStore,
+    Job,
+    JobFailed,
+    JobQueueFull,
+    JobRunner,
+)
+from common.idempotency import (
+    IdempotencyConflict,
+    IdempotencyStore,
+    KeyedLocks,
+    LockTimeout,
+    request_fingerprint,
+)
 
 # エージェント
 from agents._base.firestore_checkpointer import FirestoreCheckpointer
+from agents._base.adaptive_limiter import LimiterTimeout, get_llm_limiter, is_quota_error
+from agents._base.llm_pool import get_pool_stats
+from agents._base.model_router import get_route_counts
+from agents._base.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, get_scheduler
 from agents._template import TemplateAgent
 
 
@@ -85,42 +123,89 @@ else:
 # セキュリティ設定
 MAX_MESSAGE_LENGTH = 10000  # メッセージの最大文字数（DoS/コスト攻撃対策）
 THREAD_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')  # thread_idの許可パターン
-AI_TIMEOUT_SECONDS = 55  # AI処理のタイムアウト（Cloud Run の60秒制限より短く設定）
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_.:-]{1,200}$')  # 冪等性キーの許可パターン
+REQUEST_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')  # X-Request-Id の許可パターン
+JOB_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,100}\.[0-9a-f]{32}$')  # job_id の許可パターン（thread_id.ランダム値）
+AI_TIMEOUT_SECONDS = 55  # AI処理のタイムアウト（Cloud Run の60秒制限より短く設定。Gateway の締め切りが短ければそちらを使う）
+LLM_QUOTA_RETRY_AFTER_SECONDS = 10  # Vertex AI のクォータ超過時にクライアントへ返す Retry-After
+BATCH_TIMEOUT_SECONDS = 290  # /chat/batch 全体のタイムアウト（デプロイ時の --timeout=300s より短く設定）
 
 
 # ===== アプリケーション初期化 =====
 
 app = Flask(__name__)
 setup_cors(app)
+setup_compression(app)
+setup_timing(app)
 
 # エージェントキャッシュ: {(agent_name, customer_id): agent_instance}
-_agent_cache = {}
+# 顧客が増えてもメモリを使い切らないよう、上限付きの LRU にする
+_agent_cache = BoundedCache(
+    max_size=config.AGENT_CACHE_MAX_SIZE,
+    idle_ttl_seconds=config.AGENT_CACHE_IDLE_TTL_SECONDS,
+    name="エージェントキャッシュ",
+)
+
+# 再送の重複処理防止: {(customer_id, user_id, 冪等性キー): 結果}
+# インスタンスごとのベストエフォート（別のインスタンスに届いた再送は検出できない。common/idempotency.py 参照）
+_idempotency = IdempotencyStore(ttl_seconds=config.IDEMPOTENCY_TTL_SECONDS)
+
+# 同じスレッドのターンを1つずつ処理するためのロック: {(customer_id, thread_id): Lock}（インスタンスごと）
+_thread_locks = KeyedLocks()
+
+# 実行中のリクエスト（クライアントが切断したら Gateway からの通知で取り消す）
+# 形式: {(customer_id, user_id, request_id): (イベントループ, タスク)}
+_cancellations = CancellationRegistry()
+
+# 顧客別の同時実行数制限（1つの顧客の負荷で他の顧客が待たされないように）
+_bulkhead = Bulkhead(
+    max_concurrent=config.BULKHEAD_MAX_CONCURRENT,
+    max_queue=config.BULKHEAD_MAX_QUEUE,
+    queue_timeout=config.BULKHEAD_QUEUE_TIMEOUT_SECONDS,
+)
+
+# 応答を返した後の処理（会話の要約の更新など）を実行するスレッドプール
+_after_turn_executor = ThreadPoolExecutor(max_workers=config.AFTER_TURN_WORKERS, thread_name_prefix="after-turn")
 
 
 # ===== ヘルパー関数 =====
 
 def get_agent(agent_name: str, customer_id: str):
     """エージェントを取得（顧客別にキャッシュ）"""
-    cache_key = (agent_name, customer_id)
-    if cache_key not in _agent_cache:
+    def create_agent():
         checkpointer = FirestoreCheckpointer(db, customer_id)
         agent_class = AGENTS[agent_name]
-        _agent_cache[cache_key] = agent_class(
+        return agent_class(
             checkpointer=checkpointer,
             project_id=config.PROJECT_ID,
-            location=config.VERTEX_AI_LOCATION
+            location=config.VERTEX_AI_LOCATION,
+            customer_id=customer_id,
+            settings_loader=functools.partial(get_customer_settings, customer_id),
         )
-    return _agent_cache[cache_key]
+
+    return _agent_cache.get_or_create((agent_name, customer_id), create_agent)
 
 
 class ChatRequestError(Exception):
     """チャットリクエストのエラー"""
-    def __init__(self, message: str, status_code: int = 400):
+    def __init__(self, message: str, status_code: int = 400, retry_after: int = None):
         self.message = message
         self.status_code = status_code
+        self.retry_after = retry_after
         super().__init__(message)
 
 
+def chat_error_response(e: ChatRequestError):
+    """ChatRequestError からエラーレスポンスを生成（過負荷の場合は Retry-After 付き）"""
+    response, status_code = error_response(e.message, e.status_code)
+    if e.retry_after:
+        response.headers["Retry-After"] = str(e.retry_after)
+    if e.status_code == 503 and e.retry_after:
+        # Gateway が Backend の障害と区別するためのヘッダー（サーキットブレーカーを開かない）
+        response.headers["X-Load-Shed"] = "customer"
+    return response, status_code
+
+
 def authenticate_request_with_gateway(request) -> dict:
     """
     Gateway 経由のリクエストを認証
@@ -140,35 +225,73 @@ def authenticate_request_with_gateway(request) -> dict:
     Raises:
         ValueError: 認証失敗時
     """
-    # Gateway 経由かどうかを確認
-    gateway_verified = request.headers.get("X-Gateway-Verified")
-
-    if gateway_verified == "true":
-        # Gateway からの内部ヘッダーを取得
-        user_id = request.headers.get("X-User-Id")
-        customer_id = request.headers.get("X-Customer-Id")
-
-        if not user_id or not customer_id:
-            raise ValueError("Gateway からの内部ヘッダーが不足しています")
-
-        logger.info(f"Gateway 経由の認証成功: user_id={user_id}, customer_id={customer_id}")
-        return {
-            "uid": user_id,
-            "email": None,  # Gateway 経由の場合は不明
-            "customer_id": customer_id,
-        }
-
-    # Gateway 経由でない場合は従来の認証
-    return authenticate_request(request)
-
-
-def prepare_chat_request():
+    with timed("auth"):
+        # Gateway 経由かどうかを確認
+        gateway_verified = request.headers.get("X-Gateway-Verified")
+
+        if gateway_verified == "true":
+            # Gateway からの内部ヘッダーを取得
+            user_id = request.headers.get("X-User-Id")
+            customer_id = request.headers.get("X-Customer-Id")
+
+            if not user_id or not customer_id:
+                raise ValueError("Gateway からの内部ヘッダーが不足しています")
+
+            logger.info(f"Gateway 経由の認証成功: user_id={user_id}, customer_id={customer_id}")
+            user_info = {
+                "uid": user_id,
+                "email": None,  # Gateway 経由の場合は不明
+                "customer_id": customer_id,
+            }
+        else:
+            # Gateway 経由でない場合は従来の認証
+            user_info = authenticate_request(request)
+
+    # 処理時間のヒストグラムを顧客ごとに分ける
+    set_customer_id(user_info["customer_id"])
+    return user_info
+
+
+@dataclass
+class ChatRequest:
+    """前処理済みのチャットリクエスト"""
+    agent: object
+    agent_name: str
+    message: str
+    thread_id: str
+    user_id: str
+    customer_id: str
+    deadline: Deadline
+    request_id: str
+    idempotency: tuple | None = None   # 冪等性キーがある場合のみ (キー, リクエストの指紋)
+    priority: str = PRIORITY_INTERACTIVE
+
+
+@dataclass
+class ChatCaller:
+    """認証済みの呼び出し元（/chat・/jobs・/chat/batch 共通）"""
+    user_id: str
+    customer_id: str
+    deadline: Deadline
+    request_id: str
+
+
+def authenticate_chat_request(timeout_seconds: float = AI_TIMEOUT_SECONDS) -> ChatCaller:
     """
-    チャットリクエストの共通前処理
+    チャット系リクエストの認証・レート制限
+
+    Args:
+        timeout_seconds: 締め切りの上限（Gateway から残り時間が届いていれば短い方を使う）
 
     Returns:
-        tuple: (agent, message, thread_id, user_id, customer_id)
+        ChatCaller: 認証済みの呼び出し元
     """
+    deadline = Deadline.from_headers(request.headers, timeout_seconds)
+    # 取り消し用のリクエストID（Gateway が付ける。直接アクセスの場合は生成）
+    request_id = request.headers.get("X-Request-Id", "")
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+
     # 認証チェック（Gateway 経由の場合は内部ヘッダーを使用）
     try:
         user_info = authenticate_request_with_gateway(request)
@@ -188,18 +311,36 @@ def prepare_chat_request():
         )
 
     # レート制限チェック
-    if not check_rate_limit(user_id):
+    with timed("rate_limit"):
+        allowed = check_rate_limit(user_id)
+    if not allowed:
         raise ChatRequestError(
             "リクエスト制限を超えました。1分後に再度お試しください。",
             429
         )
 
-    # リクエストボディを取得
-    data = request.get_json()
-    if not data:
-        raise ChatRequestError("リクエストボディが必要です")
+    # 認証・レート制限（Firestore の読み書き）で締め切りを過ぎていたら、ここで打ち切る
+    try:
+        deadline.check("認証")
+    except DeadlineExceeded as e:
+        raise deadline_error(e, user_id)
+
+    return ChatCaller(user_id, customer_id, deadline, request_id)
 
-    message = data.get("message", "").strip()
+
+def parse_chat_item(data: dict, caller: ChatCaller, idempotency_key: str = None) -> ChatRequest:
+    """
+    メッセージ・スレッドID・エージェントを検証して ChatRequest を作成
+
+    Args:
+        data: {"message": ..., "thread_id": ..., "agent": ...}
+        caller: 認証済みの呼び出し元
+        idempotency_key: 冪等性キー（再送の検出用）
+
+    Raises:
+        ChatRequestError: 入力が不正
+    """
+    message = str(data.get("message") or "").strip()
     if not message:
         raise ChatRequestError("メッセージを入力してください")
 
@@ -209,8 +350,19 @@ def prepare_chat_request():
             f"メッセージが長すぎます。{MAX_MESSAGE_LENGTH}文字以内で入力してください。"
         )
 
+    if idempotency_key and not IDEMPOTENCY_KEY_PATTERN.match(str(idempotency_key)):
+        raise ChatRequestError(
+            "Idempotency-Keyの形式が不正です。英数字と _ . : - のみ、200文字以内で指定してください。"
+        )
+
     # スレッドID生成・検証
     thread_id = data.get("thread_id")
+    agent_name = data.get("agent", DEFAULT_AGENT)
+    idempotency = None
+    if idempotency_key:
+        # 指紋は生成前の thread_id で作る（新規スレッドの再送も同じリクエストとみなす）
+        fingerprint = request_fingerprint(agent_name, thread_id or "", message)
+        idempotency = ((caller.customer_id, caller.user_id, idempotency_key), fingerprint)
     if thread_id:
         # 既存のthread_idはフォーマット検証
         if not THREAD_ID_PATTERN.match(thread_id):
@@ -219,16 +371,373 @@ def prepare_chat_request():
             )
     else:
         # 新規生成
-        thread_id = f"{user_id}_{uuid.uuid4().hex[:12]}"
-    agent_name = data.get("agent", DEFAULT_AGENT)
+        thread_id = f"{caller.user_id}_{uuid.uuid4().hex[:12]}"
 
     if agent_name not in AGENTS:
         raise ChatRequestError(f"エージェント '{agent_name}' は存在しません")
 
     # 顧客別エージェントを取得
-    agent = get_agent(agent_name, customer_id)
+    agent = get_agent(agent_name, caller.customer_id)
+
+    return ChatRequest(
+        agent=agent,
+        agent_name=agent_name,
+        message=message,
+        thread_id=thread_id,
+        user_id=caller.user_id,
+        customer_id=caller.customer_id,
+        deadline=caller.deadline,
+        request_id=caller.request_id,
+        idempotency=idempotency,
+    )
+
+
+def prepare_chat_request() -> ChatRequest:
+    """
+    チャットリクエストの共通前処理
+
+    Returns:
+        ChatRequest: 前処理済みのリクエスト
+    """
+    caller = authenticate_chat_request()
+
+    # リクエストボディを取得
+    data = request.get_json()
+    if not data:
+        raise ChatRequestError("リクエストボディが必要です")
+
+    # 冪等性キー（再送の検出用。ヘッダーまたは client_message_id で指定）
+    idempotency_key = request.headers.get("Idempotency-Key") or data.get("client_message_id")
+    return parse_chat_item(data, caller, idempotency_key)
+
+
+def deadline_error(e: DeadlineExceeded, user_id: str) -> ChatRequestError:
+    """締め切り超過のエラー（どの段階で時間を使い切ったかをログに残す）"""
+    logger.warning(f"締め切りを過ぎたため中止（{e.stage}）: user_id={user_id}")
+    return ChatRequestError("AI処理がタイムアウトしました。シンプルな質問を試してください。", 504)
+
+
+def _limit_setting(customer_id: str, name: str, value, minimum: int) -> int | None:
+    """顧客設定の bulkhead.{name} を整数にする（未設定・不正な値は None = デフォルトを使う）"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        number = int(value)
+        if number != value and str(number) != str(value).strip():
+            raise ValueError
+    except (TypeError, ValueError):
+        number = None
+    if number is None or number < minimum:
+        logger.warning(f"bulkhead.{name} が不正なためデフォルトを使います: customer_id={customer_id}, value={value!r}")
+        return None
+    return number
+
+
+def get_bulkhead_limits(customer_id: str) -> tuple[int | None, int | None]:
+    """
+    顧客ごとの同時実行数・待ち行列の長さ（Firestore の customers/{customer_id}.bulkhead）
+
+    Returns:
+        tuple: (max_concurrent, max_queue)（未設定・不正な値は None = デフォルト）
+    """
+    limits = get_customer_settings(customer_id).get("bulkhead") or {}
+    if not isinstance(limits, dict):
+        logger.warning(f"bulkhead が辞書ではないためデフォルトを使います: customer_id={customer_id}, value={limits!r}")
+        return None, None
+    return (
+        _limit_setting(customer_id, "max_concurrent", limits.get("max_concurrent"), 1),
+        _limit_setting(customer_id, "max_queue", limits.get("max_queue"), 0),
+    )
+
+
+def run_chat_turn(req: ChatRequest) -> str:
+    """
+    1ターン分の AI 処理を実行（同じスレッドのターンは1つずつ処理する）
+
+    【締め切りの割り振り】
+    スレッドのロック・顧客別の順番待ちは締め切りまでの残り時間しか待たない。
+    エージェントには締め切りを渡し、チェックポイントの読み書きと LLM の呼び出しを
+    その範囲に収める（LLM は保存の時間を残して少し早めに打ち切る）。
+
+    Returns:
+        str: 後処理済みの応答
+
+    Raises:
+        ChatRequestError: タイムアウト・過負荷・取り消し・処理中のエラー
+    """
+    customer_id, user_id, thread_id = req.customer_id, req.user_id, req.thread_id
+    deadline = req.deadline
+    queued_at = time.monotonic()
+    try:
+        # 顧客ごとの同時実行数（Firestore の customers/{customer_id}.bulkhead で上書き可能）
+        max_concurrent, max_queue = get_bulkhead_limits(customer_id)
+        with _thread_locks.hold((customer_id, thread_id), timeout=deadline.remaining()), \
+                _bulkhead.acquire(
+                    customer_id,
+                    max_concurrent,
+                    max_queue,
+                    timeout=min(config.BULKHEAD_QUEUE_TIMEOUT_SECONDS, deadline.remaining()),
+                ):
+            add_duration("queue", time.monotonic() - queued_at)
+            deadline.check("順番待ち")
+            # 【asyncio イベントループの仕組み】
+            # Cloud Functions は各リクエストで独立したスレッドで実行されるため、
+            # リクエストごとに新しいイベントループを作成する必要がある。
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                # クライアントが切断したら Gateway からの通知で取り消せるよう、タスクとして登録
+                task = loop.create_task(
+                    req.agent.run_sync(req.message, thread_id, priority=req.priority, deadline=deadline.at)
+                )
+                with _cancellations.register((customer_id, user_id, req.request_id), task):
+                    # 締め切り付きで実行（Cloud Run の60秒制限対策）
+                    response_text = loop.run_until_complete(
+                        asyncio.wait_for(task, timeout=deadline.remaining())
+                    )
+            finally:
+                loop.close()
+        schedule_after_turn(req.agent, customer_id, thread_id)
+        # 後処理パイプライン（拡張ポイント）
+        # スレッドのロック・同時実行数の枠は返してから実行する（失敗した場合も下でエラー応答にする）
+        return post_process(response_text, customer_id)
+    except DeadlineExceeded as e:
+        raise deadline_error(e, user_id)
+    except asyncio.CancelledError:
+        logger.info(f"クライアントの切断により取り消し: user_id={user_id}, thread_id={thread_id}")
+        # 499: クライアントが切断した（nginx の慣習。応答は誰にも届かない）
+        raise ChatRequestError("リクエストは取り消されました。", 499)
+    except LockTimeout:
+        raise ChatRequestError(
+            "同じ会話の前のメッセージを処理中です。しばらく待ってから再度お試しください。",
+            409
+        )
+    except BulkheadRejected as e:
+        reason = "待ち行列が満杯" if isinstance(e, BulkheadFull) else "待ち時間の上限"
+        logger.warning(f"同時実行数の上限により拒否（{reason}）: customer_id={customer_id}, retry_after={e.retry_after}")
+        raise ChatRequestError(
+            "混み合っています。しばらく待ってから再度お試しください。",
+            503,
+            retry_after=e.retry_after,
+        )
+    except (asyncio.TimeoutError, LimiterTimeout):
+        logger.warning(f"AI処理タイムアウト: user_id={user_id}, thread_id={thread_id}")
+        raise ChatRequestError("AI処理がタイムアウトしました。シンプルな質問を試してください。", 504)
+    except Exception as e:
+        if is_quota_error(e):
+            # 再試行してもクォータ超過が続いた（同時呼び出し数は自動で下がっている）
+            logger.warning(f"Vertex AI のクォータ超過: user_id={user_id}, thread_id={thread_id}")
+            raise ChatRequestError(
+                "現在混み合っています。しばらく待ってから再度お試しください。",
+                429,
+                retry_after=LLM_QUOTA_RETRY_AFTER_SECONDS,
+            )
+        logger.exception(f"チャット処理中にエラーが発生: user_id={user_id}, thread_id={thread_id}")
+        raise ChatRequestError("エラーが発生しました。しばらく待ってから再度お試しください。", 500)
+
+
+def schedule_after_turn(agent, customer_id: str, thread_id: str) -> None:
+    """
+    エージェントの応答後の処理（要約の更新など）をバックグラウンドで実行
+
+    応答の待ち時間に含めないよう、ターンを終えてから別スレッドで実行する。
+    同じスレッドの次のターンとは、スレッドのロックで1つずつ実行する。
+    """
+    if agent.has_after_turn():
+        _after_turn_executor.submit(_run_after_turn, agent, customer_id, thread_id)
+
+
+def _run_after_turn(agent, customer_id: str, thread_id: str) -> None:
+    """schedule_after_turn の本体（失敗しても次のターンの後に改めて実行されるため、ログだけ残す）"""
+    deadline = Deadline(config.AFTER_TURN_TIMEOUT_SECONDS)
+    try:
+        with _thread_locks.hold((customer_id, thread_id), timeout=deadline.remaining()):
+            asyncio.run(asyncio.wait_for(
+                agent.after_turn(thread_id, deadline=deadline.at), timeout=deadline.remaining()
+            ))
+    except Exception:
+        logger.warning(f"応答後の処理に失敗: customer_id={customer_id}, thread_id={thread_id}", exc_info=True)
+
+
+def execute_chat(req: ChatRequest) -> tuple[dict, bool]:
+    """
+    1ターン分の AI 処理を実行（冪等性キーがあれば再送を検出する）
+
+    Returns:
+        tuple: ({"response": ..., "thread_id": ...}, 再送に保存済みの結果を返したか)
+
+    Raises:
+        ChatRequestError: タイムアウト・過負荷・取り消し・処理中のエラー・冪等性キーの競合
+    """
+    def run_turn() -> dict:
+        processed_response = run_chat_turn(req)
+        return {"response": processed_response, "thread_id": req.thread_id}
+
+    if not req.idempotency:
+        return run_turn(), False
+    # 再送の場合は処理中・処理済みの結果を返す（LLM を再度呼ばない）
+    key, fingerprint = req.idempotency
+    try:
+        # 処理中の元のリクエストが取り消された（クライアントが切断した）場合は、再送が引き継いで処理する
+        return _idempotency.run(
+            key, fingerprint, run_turn,
+            wait_timeout=req.deadline.remaining(),
+            retry_if=lambda e: isinstance(e, ChatRequestError) and e.status_code == 499,
+        )
+    except IdempotencyConflict:
+        raise ChatRequestError("同じIdempotency-Keyで異なる内容のリクエストが送信されました。", 422)
+    except TimeoutError:
+        raise ChatRequestError("同じリクエストを処理中です。しばらく待ってから再度お試しください。", 409)
+
+
+# ===== 一括チャット =====
 
-    return agent, message, thread_id, user_id, customer_id
+def batch_line(index: int, req: ChatRequest) -> dict:
+    """一括チャットの1項目を実行し、NDJSON の1行分の結果を返す（エラーも結果として返す）"""
+    try:
+        result, replayed = execute_chat(req)
+    except ChatRequestError as e:
+        line = {"index": index, "thread_id": req.thread_id, "error": e.message, "status": e.status_code}
+        if e.retry_after:
+            line["retry_after"] = e.retry_after
+        return line
+    except Exception:
+        logger.exception(f"一括チャットの項目でエラーが発生: index={index}, thread_id={req.thread_id}")
+        return {"index": index, "thread_id": req.thread_id, "error": "エラーが発生しました。", "status": 500}
+
+    line = {"index": index, **result}
+    if replayed:
+        line["replayed"] = True
+    return line
+
+
+def stream_batch(items: list, caller: ChatCaller, concurrency: int) -> Iterator[str]:
+    """
+    一括チャットを並行して実行し、終わった順に NDJSON で返す
+
+    同じ thread_id の項目は送られた順に1つずつ処理する（会話の続きとして実行する）。
+    最後に {"done": true, "succeeded": 成功数, "failed": 失敗数} を返す。
+
+    Args:
+        items: [(index, ChatRequest または 入力エラーの ChatRequestError)]
+        caller: 認証済みの呼び出し元
+        concurrency: 同時に実行する項目数
+
+    Yields:
+        str: NDJSON の1行
+    """
+    counts = {"succeeded": 0, "failed": 0}
+
+    def encode(line: dict) -> str:
+        counts["failed" if "error" in line else "succeeded"] += 1
+        return json.dumps(line, ensure_ascii=False) + "\n"
+
+    # 入力エラーの項目はすぐに返し、残りをスレッドごとにまとめる
+    groups: dict[str, list] = {}
+    invalid = []
+    for index, item in items:
+        if isinstance(item, ChatRequestError):
+            invalid.append({"index": index, "error": item.message, "status": item.status_code})
+        else:
+            groups.setdefault(item.thread_id, []).append((index, item))
+
+    results: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def run_group(group: list) -> None:
+        for index, req in group:
+            if stop.is_set():
+                return
+            # 各項目の処理時間はヒストグラムにだけ記録する（ヘッダーは送信済み）
+            with track(req.customer_id):
+                line = batch_line(index, req)
+            results.put(line)
+
+    remaining = sum(len(group) for group in groups.values())
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    try:
+        for group in groups.values():
+            executor.submit(run_group, group)
+        for line in invalid:
+            yield encode(line)
+        while remaining:
+            line = results.get()
+            remaining -= 1
+            yield encode(line)
+        yield json.dumps({"done": True, **counts}) + "\n"
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if remaining:
+            # クライアントが途中で切断した: 未実行の項目は始めず、実行中の項目は取り消す
+            stop.set()
+            _cancellations.cancel((caller.customer_id, caller.user_id, caller.request_id))
+            logger.info(f"一括チャットを中断: user_id={caller.user_id}, 未完了={remaining}")
+
+
+# ===== 非同期ジョブ =====
+
+def run_job(job: Job) -> str:
+    """
+    ジョブ1件分の AI 処理を実行（ワーカースレッドから呼ばれる）
+
+    /chat と同じく同じスレッドのターンは1つずつ処理する。
+    エージェントは一括処理（PRIORITY_BATCH）として実行し、画面で待っているチャットを優先する。
+    締め切りは受け付けた時刻から JOB_TIMEOUT_SECONDS（待ち行列で待った時間を含む）。
+
+    Returns:
+        str: 後処理済みの応答
+
+    Raises:
+        JobFailed: タイムアウト・クォータ超過（ユーザーに返すメッセージ付き）
+    """
+    with track(job.customer_id):
+        return _run_job(job)
+
+
+def _run_job(job: Job) -> str:
+    """run_job の本体（処理時間の計測の中で呼ばれる）"""
+    deadline = Deadline(job.expires_at - time.time())
+    agent = get_agent(job.agent, job.customer_id)
+    queued_at = time.monotonic()
+    try:
+        with _thread_locks.hold((job.customer_id, job.thread_id), timeout=deadline.remaining()):
+            add_duration("queue", time.monotonic() - queued_at)
+            deadline.check("順番待ち")
+            # ワーカースレッドにはイベントループがないため、ジョブごとに作成する
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                response_text = loop.run_until_complete(
+                    asyncio.wait_for(
+                        agent.run_sync(job.message, job.thread_id, priority=PRIORITY_BATCH, deadline=deadline.at),
+                        timeout=deadline.remaining(),
+                    )
+                )
+            finally:
+                loop.close()
+        schedule_after_turn(agent, job.customer_id, job.thread_id)
+    except (LockTimeout, DeadlineExceeded, asyncio.TimeoutError, LimiterTimeout):
+        logger.warning(f"ジョブがタイムアウト: job_id={job.job_id}")
+        raise JobFailed("ジョブがタイムアウトしました。処理を分けて再度お試しください。")
+    except Exception as e:
+        if is_quota_error(e):
+            logger.warning(f"Vertex AI のクォータ超過: job_id={job.job_id}")
+            raise JobFailed("現在混み合っています。しばらく待ってから再度お試しください。")
+        raise
+
+    return post_process(response_text, job.customer_id)
+
+
+# ジョブのワーカープール（保存先は JOB_STORE。ローカル開発・テストでは memory）
+_jobs = JobRunner(
+    FirestoreJobStore(db) if config.JOB_STORE == "firestore" else InMemoryJobStore(),
+    execute=run_job,
+    workers=config.JOB_WORKERS,
+    max_queue=config.JOB_MAX_QUEUE,
+    max_pending_per_customer=config.JOB_MAX_PENDING_PER_CUSTOMER,
+)
 
 
 # ===== APIエンドポイント =====
@@ -245,43 +754,39 @@ def post_process(response_text: str, customer_id: str) -> str:
 
     【この関数は何をするのか？】
     AIからの生の回答テキストを、画面に表示する前に加工するための関数です。
-    現在は「何もせずそのまま返す」だけですが、将来の拡張ポイントとして用意されています。
-
-    【なぜ必要か？】
-    ストリーミングを廃止し同期方式にしたことで、AIの完全なレスポンスを
-    一括で受け取れるようになりました。これにより、以下のような処理が可能です：
-    - 表形式データの検出・変換（Markdownテーブル → HTML）
-    - グラフ用データの抽出（数値データ → Chart.js用JSON）
-    - Gemini による要約や再フォーマット
-    - 顧客別のキーワード置換（専門用語の補足など）
-
-    【現在の状態】
-    何も処理せず、AIの回答をそのまま返しています。
-    カスタマイズしたい場合は、この関数の中身を編集してください。
-
-    【拡張例】
-    ```python
-    def post_process(response_text: str, customer_id: str) -> str:
-        # 例1: 特定顧客のみ処理を追加
-        if customer_id == "acme-corp":
-            response_text = response_text.replace("製品A", "製品A（旧名: ProductX）")
-
-        # 例2: Markdownの表を検出してHTMLに変換
-        if "| --- |" in response_text:
-            response_text = convert_markdown_table_to_html(response_text)
-
-        return response_text
+    顧客ごとに設定したステージ（common/post_process.py）を順番に適用します。
+    設定がない顧客には何もせず、AIの回答をそのまま返します。
+
+    【顧客ごとの設定】
+    Firestore の customers/{customer_id} ドキュメントの post_process に、ステージを並べます。
+    ```json
+    {"post_process": [
+      {"type": "replace", "replacements": {"製品A": "製品A（旧名: ProductX）"}},
+      {"type": "regex", "pattern": "\\d{3}-\\d{4}-\\d{4}", "replacement": "***-****-****"},
+      {"type": "markdown_table"}
+    ]}
     ```
+    - replace: キーワード置換（多数のキーワードも1回の走査でまとめて置換）
+    - regex: 正規表現による置換
+    - markdown_table: Markdownの表をHTMLの表に変換
+
+    正規表現・キーワード表は設定を読み込んだときに1回だけコンパイルされます。
+    新しい種類のステージは common/post_process.py の register_stage で追加できます。
+
+    【ストリーミングの場合】
+    各ステージはトークンが届くたびに少しずつ処理できるため、応答全体を溜める必要はありません。
+    get_pipeline(customer_id, specs).iter(chunks) を使ってください。
 
     Args:
         response_text: AI からの生レスポンス（加工前のテキスト）
-        customer_id: 顧客ID（顧客別処理の分岐に使用）
+        customer_id: 顧客ID（顧客別の設定の読み込みに使用）
 
     Returns:
         処理済みのレスポンス（加工後のテキスト）
     """
-    # 現時点ではそのまま返す（将来の拡張ポイント）
-    return response_text
+    with timed("post_process"):
+        specs = get_customer_settings(customer_id).get("post_process")
+        return get_pipeline(customer_id, specs).run(response_text)
 
 
 @app.route("/chat", methods=["POST"])
@@ -293,40 +798,209 @@ def chat():
     レスポンスは JSON 形式で、後処理パイプラインを通過可能。
     """
     try:
-        agent, message, thread_id, user_id, customer_id = prepare_chat_request()
+        req = prepare_chat_request()
+        # 同期実行
+        result, replayed = execute_chat(req)
     except ChatRequestError as e:
-        return error_response(e.message, e.status_code)
-
-    # 同期実行
-    # 【asyncio イベントループの仕組み】
-    # Cloud Functions は各リクエストで独立したスレッドで実行されるため、
-    # リクエストごとに新しいイベントループを作成する必要がある。
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+        return chat_error_response(e)
+
+    response = success_response(result)
+    # Gateway が同じスレッドを同じエンドポイントに振り分けるためのヘッダー
+    response.headers["X-Thread-Id"] = result["thread_id"]
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@app.route("/chat/cancel", methods=["POST"])
+def cancel_chat():
+    """
+    実行中のチャットを取り消す（Gateway がクライアントの切断を検知したときに呼ぶ）
+
+    X-Request-Id ヘッダーで、取り消すリクエストを指定する。
+    取り消せるのは同じユーザーのリクエストだけ。
+    """
     try:
-        # タイムアウト付きで実行（Cloud Run の60秒制限対策）
-        response_text = loop.run_until_complete(
-            asyncio.wait_for(agent.run_sync(message, thread_id), timeout=AI_TIMEOUT_SECONDS)
-        )
+        user_info = authenticate_request_with_gateway(request)
+    except ValueError as e:
+        return error_response(str(e), 401)
 
-        # 後処理パイプライン（拡張ポイント）
-        processed_response = post_process(response_text, customer_id)
-    except asyncio.TimeoutError:
-        logger.warning(f"AI処理タイムアウト: user_id={user_id}, thread_id={thread_id}")
-        return error_response(
-            "AI処理がタイムアウトしました。シンプルな質問を試してください。",
-            504
+    request_id = request.headers.get("X-Request-Id", "")
+    if not REQUEST_ID_PATTERN.match(request_id):
+        return error_response("X-Request-Idの形式が不正です。")
+
+    cancelled = _cancellations.cancel((user_info["customer_id"], user_info["uid"], request_id))
+    return success_response({"cancelled": cancelled})
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    一括チャット（評価・回帰テスト・オフライン処理用）
+
+    リクエストボディ:
+        {
+          "items": [{"message": "...", "thread_id": "...", "client_message_id": "..."}, ...],
+          "agent": "template",      # 省略時は DEFAULT_AGENT（項目ごとにも指定可能）
+          "concurrency": 4          # 省略時・上限は BATCH_MAX_CONCURRENT
+        }
+
+    レスポンス: NDJSON（application/x-ndjson）。終わった順に1行ずつ返す。
+        {"index": 0, "response": "...", "thread_id": "..."}
+        {"index": 1, "error": "...", "status": 504}
+        {"done": true, "succeeded": 1, "failed": 1}
+
+    【顧客ごとの制限】
+    - ユーザーごとのレート制限は一括チャット1回につき1回分
+    - 項目数は顧客ごとの1分あたりの上限（BATCH_ITEMS_PER_MINUTE）から消費する
+      （顧客の全ユーザーの合計。残りが足りなければ、1件も実行せずに 429 を返す）
+    - 各項目は /chat と同じ顧客別の同時実行数制限（バルクヘッド）の枠で実行する
+      （同じ顧客の一括チャット・チャットを合わせて max_concurrent を超えない）
+    - 同時実行数は顧客の max_concurrent 以下に抑え、一括処理（PRIORITY_BATCH）として実行する
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        raw_items = data.get("items")
+        caller = authenticate_chat_request(BATCH_TIMEOUT_SECONDS)
+        if not isinstance(raw_items, list) or not raw_items:
+            raise ChatRequestError("itemsに1件以上の項目を指定してください")
+        if len(raw_items) > config.BATCH_MAX_ITEMS:
+            raise ChatRequestError(f"itemsは{config.BATCH_MAX_ITEMS}件以内で指定してください")
+        try:
+            requested = int(data.get("concurrency") or config.BATCH_MAX_CONCURRENT)
+        except (TypeError, ValueError):
+            raise ChatRequestError("concurrencyは整数で指定してください")
+
+        # 顧客ごとの項目数の上限（ユーザーごとのレート制限とは別）
+        with timed("rate_limit"):
+            retry_after = check_batch_quota(caller.customer_id, len(raw_items))
+        if retry_after:
+            raise ChatRequestError(
+                f"一括チャットの項目数の上限（1分あたり）を超えました（{len(raw_items)}件）。"
+                "件数を減らすか、しばらく待ってから再度お試しください。",
+                429,
+                retry_after=retry_after,
+            )
+    except ChatRequestError as e:
+        return chat_error_response(e)
+
+    # 同時実行数: 指定値・BATCH_MAX_CONCURRENT・顧客の同時実行数の最小
+    customer_limit = get_bulkhead_limits(caller.customer_id)[0] or config.BULKHEAD_MAX_CONCURRENT
+    concurrency = max(1, min(requested, config.BATCH_MAX_CONCURRENT, customer_limit))
+
+    items = []
+    for index, raw in enumerate(raw_items):
+        try:
+            if not isinstance(raw, dict):
+                raise ChatRequestError("項目はオブジェクトで指定してください")
+            item = parse_chat_item(
+                {"agent": data.get("agent", DEFAULT_AGENT), **raw}, caller, raw.get("client_message_id")
+            )
+            item.priority = PRIORITY_BATCH
+            items.append((index, item))
+        except ChatRequestError as e:
+            items.append((index, e))
+
+    logger.info(f"一括チャット: user_id={caller.user_id}, 件数={len(items)}, 同時実行数={concurrency}")
+    return Response(
+        stream_batch(items, caller, concurrency),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    非同期ジョブを登録（すぐに 202 と job_id を返す）
+
+    リクエストボディは /chat と同じ。/chat の制限時間（55秒）に収まらない長い処理に使う。
+    結果は GET /jobs/{job_id} で取得する。
+    """
+    try:
+        req = prepare_chat_request()
+    except ChatRequestError as e:
+        return chat_error_response(e)
+
+    def submit() -> dict:
+        job = Job.create(
+            req.customer_id, req.user_id, req.thread_id, req.agent_name, req.message,
+            timeout_seconds=config.JOB_TIMEOUT_SECONDS,
         )
-    except Exception as e:
-        logger.exception(f"チャット処理中にエラーが発生: user_id={user_id}, thread_id={thread_id}")
+        _jobs.submit(job)
+        return job.to_response()
+
+    replayed = False
+    try:
+        if req.idempotency:
+            # 再送の場合は同じジョブを返す（ジョブを二重に登録しない）
+            key, fingerprint = req.idempotency
+            result, replayed = _idempotency.run(
+                ("jobs", *key), fingerprint, submit, wait_timeout=req.deadline.remaining()
+            )
+        else:
+            result = submit()
+    except JobQueueFull as e:
+        logger.warning(f"ジョブの待ち行列が満杯のため拒否: customer_id={req.customer_id}, retry_after={e.retry_after}")
+        return chat_error_response(ChatRequestError(
+            "混み合っています。しばらく待ってから再度お試しください。",
+            503,
+            retry_after=e.retry_after,
+        ))
+    except IdempotencyConflict:
+        return error_response("同じIdempotency-Keyで異なる内容のリクエストが送信されました。", 422)
+    except TimeoutError:
+        return error_response("同じリクエストを処理中です。しばらく待ってから再度お試しください。", 409)
+    except Exception:
+        logger.exception(f"ジョブの登録に失敗: user_id={req.user_id}")
         return error_response("エラーが発生しました。しばらく待ってから再度お試しください。", 500)
-    finally:
-        loop.close()
 
-    return success_response({
-        "response": processed_response,
-        "thread_id": thread_id
-    })
+    response = success_response(result)
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{result['job_id']}"
+    response.headers["X-Thread-Id"] = result["thread_id"]
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    ジョブの状態と結果を取得
+
+    ?wait=秒数 を指定すると、ジョブが終わるまで最大その秒数待ってから返す（ロングポーリング）。
+    上限は JOB_LONG_POLL_MAX_SECONDS（Gateway の締め切りが短ければそちら）。
+    """
+    try:
+        user_info = authenticate_request_with_gateway(request)
+    except ValueError as e:
+        return error_response(str(e), 401)
+
+    if not JOB_ID_PATTERN.match(job_id):
+        return error_response("job_idの形式が不正です。")
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return error_response("waitは秒数で指定してください。")
+    # Gateway の締め切りの少し手前で返す（待っている間に Gateway がタイムアウトしないように）
+    deadline = Deadline.from_headers(request.headers, config.JOB_LONG_POLL_MAX_SECONDS)
+    wait = max(0.0, min(wait, deadline.remaining() - 1))
+
+    customer_id = user_info["customer_id"]
+    try:
+        job = _jobs.get(customer_id, job_id)
+        if job is None or job.user_id != user_info["uid"]:
+            return error_response("ジョブが見つかりません", 404)
+        if not job.done and wait > 0:
+            job = _jobs.wait(customer_id, job_id, wait)
+    except Exception:
+        logger.exception(f"ジョブの取得に失敗: job_id={job_id}")
+        return error_response("エラーが発生しました。しばらく待ってから再度お試しください。", 500)
+
+    response = success_response(job.to_response())
+    response.headers["X-Thread-Id"] = job.thread_id
+    return response
 
 
 @app.route("/agents", methods=["GET"])
@@ -344,6 +1018,39 @@ def list_agents():
     })
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    運用メトリクス（顧客ごとの同時実行数・待ち行列の長さ・待ち時間、スケジューラーの順番待ち、
+    Vertex AI の同時呼び出し数の上限とクォータ超過の回数、クライアントの切断による取り消しの回数、
+    非同期ジョブの待ち行列と実行中の件数、後処理パイプラインのキャッシュ、
+    顧客・段階ごとの処理時間の p50 / p95 / p99、顧客ごとのモデルの振り分け先の件数、
+    エージェントのキャッシュ、LLM クライアントのプール）
+
+    全顧客の情報を含むため、ユーザーの認証ではなく
+    X-Metrics-Token ヘッダー（環境変数 METRICS_TOKEN）で認証する。
+    METRICS_TOKEN が未設定の場合は無効（404）。
+    """
+    if not config.METRICS_TOKEN:
+        return error_response("Not Found", 404)
+    token = request.headers.get("X-Metrics-Token", "")
+    if not hmac.compare_digest(token.encode(), config.METRICS_TOKEN.encode()):
+        return error_response("認証に失敗しました", 401)
+
+    return success_response({
+        "bulkheads": _bulkhead.stats(),
+        "scheduler": get_scheduler().stats(),
+        "llm_limiter": get_llm_limiter().stats(),
+        "cancellations": _cancellations.stats(),
+        "jobs": _jobs.stats(),
+        "post_process": get_pipeline_stats(),
+        "timing": get_timing_stats(),
+        "model_routes": get_route_counts(),
+        "agent_cache": _agent_cache.stats(),
+        "llm_pool": get_pool_stats(),
+    })
+
+
 # Cloud Functions エントリーポイント
 @functions_framework.http
 def main(req):
@@ -0,0 +1,124 @@
+"""
+顧客の文書をベクトルインデックスに一括登録する
+
+テキストファイル（.txt / .md）のフォルダ、または JSON Lines ファイルを読み込み、
+一定の長さに分割して埋め込みベクトルを計算し、顧客別のインデックスを作成します。
+既存のインデックスは置き換えます（実行中のバックエンドは次の検索時に自動で読み直します）。
+
+【実行方法】（backend/ ディレクトリで実行）
+    python scripts/ingest_documents.py --customer-id acme-corp --input ./acme-docs/
+    python scripts/ingest_documents.py --customer-id acme-corp --input ./faq.jsonl
+
+【JSON Lines の形式】
+    {"text": "返品は購入から30日以内...", "source": "FAQ/返品"}
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from agents._base.llm_pool import get_embeddings  # noqa: E402
+from agents._base.vector_index import build_index, index_directory  # noqa: E402
+from agents._template import TemplateAgent  # noqa: E402
+from common.config import config  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = (".txt", ".md")
+
+
+def split_text(text: str, chunk_chars: int, overlap_chars: int) -> list[str]:
+    """
+    テキストを一定の長さに分割（段落の区切りをできるだけ優先する）
+
+    Args:
+        chunk_chars: 1チャンクの最大文字数
+        overlap_chars: 前のチャンクと重ねる文字数（文脈の切れ目で情報を失わないため）
+    """
+    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
+    chunks = []
+    current = ""
+    for paragraph in paragraphs:
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = current[-overlap_chars:] if overlap_chars else ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        # 1段落が長すぎる場合は文字数で区切る
+        while len(current) > chunk_chars:
+            chunks.append(current[:chunk_chars])
+            current = current[chunk_chars - overlap_chars:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def load_documents(path: str, chunk_chars: int, overlap_chars: int) -> list[dict]:
+    """入力（フォルダまたは JSON Lines）から文書を読み込んで分割"""
+    documents = []
+    if os.path.isfile(path) and path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    for chunk in split_text(item["text"], chunk_chars, overlap_chars):
+                        documents.append({"text": chunk, "source": item.get("source", "")})
+        return documents
+
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if not name.endswith(TEXT_EXTENSIONS):
+                continue
+            file_path = os.path.join(root, name)
+            with open(file_path, encoding="utf-8") as f:
+                text = f.read()
+            source = os.path.relpath(file_path, path)
+            for chunk in split_text(text, chunk_chars, overlap_chars):
+                documents.append({"text": chunk, "source": source})
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="顧客の文書をベクトルインデックスに登録")
+    parser.add_argument("--customer-id", required=True, help="顧客ID")
+    parser.add_argument("--input", required=True, help="文書のフォルダ（.txt / .md）または .jsonl ファイル")
+    parser.add_argument("--index-dir", default=config.RETRIEVAL_INDEX_DIR, help="インデックスの保存先")
+    parser.add_argument("--model", default=TemplateAgent.EMBEDDING_MODEL, help="埋め込みモデル")
+    parser.add_argument("--chunk-chars", type=int, default=800, help="1チャンクの最大文字数")
+    parser.add_argument("--overlap-chars", type=int, default=100, help="チャンク間で重ねる文字数")
+    parser.add_argument("--batch-size", type=int, default=100, help="埋め込み API に一度に送る件数")
+    parser.add_argument("--ivf-lists", type=int, default=None, help="IVF のクラスタ数（省略時: 件数から自動 / 0: 使わない）")
+    args = parser.parse_args()
+    try:
+        directory = index_directory(args.index_dir, args.customer_id)
+    except ValueError as e:
+        parser.error(str(e))
+
+    documents = load_documents(args.input, args.chunk_chars, args.overlap_chars)
+    if not documents:
+        logger.error(f"文書が見つかりません: {args.input}")
+        sys.exit(1)
+    logger.info(f"{len(documents)} チャンクの埋め込みを計算します（model={args.model}）")
+
+    embeddings = get_embeddings(args.model, project=config.PROJECT_ID, location=config.VERTEX_AI_LOCATION)
+    vectors = []
+    for start in range(0, len(documents), args.batch_size):
+        batch = documents[start:start + args.batch_size]
+        vectors.extend(embeddings.embed_documents([d["text"] for d in batch]))
+        logger.info(f"  {min(start + args.batch_size, len(documents))} / {len(documents)}")
+
+    build_index(
+        directory,
+        documents,
+        np.asarray(vectors, dtype=np.float32),
+        model=args.model,
+        n_lists=args.ivf_lists,
+    )
+
+
+if __name__ == "__main__":
+    main()
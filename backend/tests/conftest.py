@@ -0,0 +1,11 @@
+"""
+Backend のテストの共通設定
+
+    cd backend
+    pip install -r requirements.txt pytest
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,61 @@
+"""
+会話履歴の制限（trim_messages_to_budget）の回帰テスト
+
+ツールの呼び出し中に予算を超えても、最新のユーザーの発言・ツールの呼び出し・結果の
+まとまりが崩れない（ツールの結果だけが LLM に渡らない）ことを確認する。
+"""
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from agents._base.fake_llm import FakeChatModel
+from agents._base.token_budget import estimate_message_tokens, trim_messages_to_budget
+from agents._template.tool_agent import ToolTemplateAgent
+
+
+def tool_call(call_id: str) -> AIMessage:
+    return AIMessage(content="", tool_calls=[{"name": "get_current_time", "args": {}, "id": call_id}])
+
+
+def trim(messages: list, budget: int, max_messages: int = None) -> list:
+    counts = [estimate_message_tokens(m) for m in messages]
+    return trim_messages_to_budget(messages, counts, budget, max_messages)
+
+
+def test_keeps_current_tool_round_over_budget():
+    """予算を超える質問でも、質問・ツール呼び出し・結果をまとめて残す"""
+    messages = [
+        HumanMessage(content="こんにちは"),
+        AIMessage(content="こんにちは！"),
+        HumanMessage(content="質問" * 4500),
+        tool_call("c1"),
+        ToolMessage(content="2025-01-01 09:00", tool_call_id="c1"),
+    ]
+    assert trim(messages, budget=100) == messages[2:]
+
+
+def test_drops_whole_turns_by_message_limit():
+    """件数の上限でも、ユーザーの発言の途中（ツールの結果など）から始めない"""
+    messages = [
+        HumanMessage(content="1つ目"),
+        tool_call("c1"),
+        ToolMessage(content="結果", tool_call_id="c1"),
+        AIMessage(content="回答"),
+        HumanMessage(content="2つ目"),
+        tool_call("c2"),
+        ToolMessage(content="結果", tool_call_id="c2"),
+    ]
+    assert trim(messages, budget=10000, max_messages=5) == messages[4:]
+    assert trim(messages, budget=10000, max_messages=7) == messages
+
+
+def test_tool_agent_sends_question_with_tool_result():
+    """ツールの結果を渡す2回目の呼び出しにも、ユーザーの質問とツールの呼び出しが含まれる"""
+    llm = FakeChatModel(responses=[tool_call("c1"), "回答です"])
+    agent = ToolTemplateAgent(checkpointer=MemorySaver(), llm=llm, settings_loader=lambda: {})
+
+    response = asyncio.run(agent.run_sync("質問" * 4500, "thread-1"))
+
+    assert response == "回答です"
+    assert [m.type for m in llm.calls[1]["messages"]] == ["system", "human", "ai", "tool"]
@@ -0,0 +1,96 @@
+"""
+会話履歴のトークン数ベンチマーク
+
+長い会話スレッドを模擬して、1ターンごとのプロンプトのトークン数を比較します。
+- 旧方式: 直近20件（MAX_HISTORY_MESSAGES）をそのまま送る
+- 新方式: トークン予算（MAX_HISTORY_TOKENS）に収まるよう古い会話から削る
+
+あわせて、トークン数を毎ターン再計算する場合と、
+状態に保存した値を再利用する場合の処理時間も比較します。
+
+【実行方法】
+    pip install -r backend/requirements.txt
+    python benchmarks/agent_history_tokens.py
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+from agents._base.token_budget import (  # noqa: E402
+    estimate_message_tokens,
+    estimate_tokens,
+    trim_messages_to_budget,
+)
+
+TURNS = 200
+MAX_HISTORY_MESSAGES = 20
+MAX_HISTORY_TOKENS = 8000
+SYSTEM_PROMPT = "あなたは親切で丁寧なAIアシスタントです。" * 4
+PASTE_TURN = 30  # このターンでユーザーが長文を貼り付ける
+
+
+def simulate_thread(seed: int = 0) -> list[dict]:
+    """短い挨拶・普通の質問・長文の貼り付けが混ざった会話を生成"""
+    rng = random.Random(seed)
+    messages = []
+    for turn in range(TURNS):
+        if turn == PASTE_TURN:
+            user = "以下のログを確認してください。\n" + "エラー: 接続がタイムアウトしました。" * 500
+        else:
+            user = rng.choice(["こんにちは", "ありがとう", "詳しく教えてください。" * rng.randint(1, 10)])
+        messages.append({"role": "user", "content": user})
+        messages.append({"role": "assistant", "content": "回答です。" * rng.randint(20, 160)})
+    return messages
+
+
+def prompt_tokens(history: list[dict]) -> int:
+    """システムプロンプト込みのトークン数"""
+    return estimate_tokens(SYSTEM_PROMPT) + sum(estimate_message_tokens(m) for m in history)
+
+
+def legacy_history(messages: list[dict]) -> list[dict]:
+    return messages[-MAX_HISTORY_MESSAGES:]
+
+
+def budget_history(messages: list[dict], counts: list[int]) -> list[dict]:
+    budget = MAX_HISTORY_TOKENS - estimate_tokens(SYSTEM_PROMPT)
+    return trim_messages_to_budget(messages, counts, budget, MAX_HISTORY_MESSAGES)
+
+
+def main():
+    thread = simulate_thread()
+
+    legacy, budgeted = [], []
+    counts: list[int] = []
+    recompute_seconds = cached_seconds = 0.0
+    for turn in range(TURNS):
+        # ユーザー発言の時点での履歴（最後がユーザー発言）
+        history = thread[: turn * 2 + 1]
+
+        started = time.perf_counter()
+        [estimate_message_tokens(m) for m in history]
+        recompute_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        counts.append(estimate_message_tokens(history[-1]))
+        budgeted.append(prompt_tokens(budget_history(history, counts)))
+        cached_seconds += time.perf_counter() - started
+        counts.append(estimate_message_tokens(thread[turn * 2 + 1]))
+
+        legacy.append(prompt_tokens(legacy_history(history)))
+
+    print(f"{'mode':<14} {'mean':>8} {'p95':>8} {'max':>8} {'total':>10}")
+    for name, values in (("last-20", legacy), ("token-budget", budgeted)):
+        p95 = statistics.quantiles(values, n=20)[-1]
+        print(f"{name:<14} {statistics.mean(values):>8.0f} {p95:>8.0f} {max(values):>8} {sum(values):>10}")
+
+    print()
+    print(f"token counting per thread: recompute every turn {recompute_seconds * 1000:.1f} ms, "
+          f"cached in state {cached_seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
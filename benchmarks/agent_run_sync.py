@@ -0,0 +1,70 @@
+"""
+run_sync の高速パスのベンチマーク
+
+偽の LLM（FakeChatModel）で長い応答を返し、1ターンあたりの CPU 時間を比較します。
+- 旧方式: astream_events でトークンごとのイベントを受け取り、つなげて全文にする
+- 新方式: ainvoke で実行し、最終状態の AI メッセージを読む
+
+LLM の待ち時間は含まないため、差はそのまま「イベントの作成・配信にかかる CPU 時間」になります。
+
+【実行方法】
+    pip install -r backend/requirements.txt
+    python benchmarks/agent_run_sync.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+from agents._base.fake_llm import FakeChatModel  # noqa: E402
+from agents._template import TemplateAgent  # noqa: E402
+
+TURNS = 50
+RESPONSE_WORDS = 400  # 応答のトークン数（単語数）
+
+
+async def streaming_turn(agent: TemplateAgent, message: str, thread_id: str) -> str:
+    """旧方式: run() のストリーミングを全部受け取る"""
+    chunks = []
+    async for chunk in agent.run(message, thread_id):
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+async def measure(turn, label: str) -> list[float]:
+    """1ターンごとの CPU 時間（ミリ秒）を計測"""
+    response = " ".join(f"word{i}" for i in range(RESPONSE_WORDS))
+    agent = TemplateAgent(llm=FakeChatModel(responses=[response]))
+
+    # グラフのコンパイルなど初回だけの処理を除く
+    assert await turn(agent, "ウォームアップ", "warmup") == response
+
+    timings = []
+    for i in range(TURNS):
+        start = time.process_time()
+        text = await turn(agent, f"質問 {i}", f"thread-{i}")
+        timings.append((time.process_time() - start) * 1000)
+        assert text == response, label
+    return timings
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<28} mean={statistics.mean(timings):7.2f} ms  p95={p95:7.2f} ms")
+
+
+async def main():
+    print(f"{TURNS} ターン / 応答 {RESPONSE_WORDS} トークン（1ターンあたりの CPU 時間）")
+    legacy = await measure(streaming_turn, "streaming")
+    fast = await measure(lambda agent, message, thread_id: agent.run_sync(message, thread_id), "ainvoke")
+    report("旧方式 (astream_events)", legacy)
+    report("新方式 (ainvoke)", fast)
+    saved = statistics.mean(legacy) - statistics.mean(fast)
+    print(f"削減: {saved:.2f} ms/ターン ({saved / statistics.mean(legacy):.0%})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
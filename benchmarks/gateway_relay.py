@@ -0,0 +1,138 @@
+"""
+Gateway レスポンス中継のベンチマーク
+
+ローカルのスタブ Upstream（http.server）に対して、
+- 旧方式: iter_content(chunk_size=1024)
+- 新方式: relay.iter_relay()
+の2つを比較します。
+
+【計測項目】
+- SSE: Upstream がイベントを送ってからクライアント側で受け取るまでの遅延
+- 大きなレスポンス: 中継のスループット（MB/s）
+
+【実行方法】
+    pip install -r gateway/requirements.txt
+    python benchmarks/gateway_relay.py
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gateway"))
+from relay import iter_relay  # noqa: E402
+
+SSE_EVENTS = 50
+SSE_INTERVAL_SECONDS = 0.01
+LARGE_BODY_BYTES = 64 * 1024 * 1024
+
+
+class StubUpstream(BaseHTTPRequestHandler):
+    """Backend の代わりに応答するスタブ"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/sse":
+            self._send_sse(chunked=True)
+        elif self.path == "/sse-close":
+            self._send_sse(chunked=False)
+        else:
+            self._send_large()
+
+    def _send_sse(self, chunked: bool):
+        """chunked=False の場合は接続終了までをボディとする（HTTP チャンクなし）"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        for _ in range(SSE_EVENTS):
+            # 送信時刻をイベントに埋め込み、受信側で遅延を計算する
+            event = f"data: {time.perf_counter()}\n\n".encode()
+            if chunked:
+                event = f"{len(event):x}\r\n".encode() + event + b"\r\n"
+            self.wfile.write(event)
+            self.wfile.flush()
+            time.sleep(SSE_INTERVAL_SECONDS)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.close_connection = True
+
+    def _send_large(self):
+        block = b"x" * (1024 * 1024)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(LARGE_BODY_BYTES))
+        self.end_headers()
+        for _ in range(LARGE_BODY_BYTES // len(block)):
+            self.wfile.write(block)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def legacy_relay(resp):
+    """旧方式: 1024バイト固定で中継"""
+    for chunk in resp.iter_content(chunk_size=1024):
+        if chunk:
+            yield chunk
+
+
+def measure_sse(base_url: str, path: str, relay) -> list[float]:
+    """SSE イベントの遅延（ミリ秒）を計測"""
+    latencies = []
+    buffer = b""
+    with requests.get(f"{base_url}{path}", stream=True) as resp:
+        for chunk in relay(resp):
+            received_at = time.perf_counter()
+            buffer += chunk
+            *events, buffer = buffer.split(b"\n\n")
+            for event in events:
+                sent_at = float(event.decode().removeprefix("data: "))
+                latencies.append((received_at - sent_at) * 1000)
+    return latencies
+
+
+def measure_throughput(base_url: str, relay) -> float:
+    """大きなレスポンスのスループット（MB/s）を計測"""
+    started = time.perf_counter()
+    total = 0
+    with requests.get(f"{base_url}/large", stream=True) as resp:
+        for chunk in relay(resp):
+            total += len(chunk)
+    elapsed = time.perf_counter() - started
+    return total / elapsed / (1024 * 1024)
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{'mode':<10} {'sse framing':<12} {'p50(ms)':>9} {'max(ms)':>9} {'events':>7}")
+    for name, relay in (("legacy", legacy_relay), ("adaptive", iter_relay)):
+        for path in ("/sse", "/sse-close"):
+            latencies = measure_sse(base_url, path, relay)
+            p50 = statistics.median(latencies) if latencies else float("nan")
+            worst = max(latencies) if latencies else float("nan")
+            framing = "chunked" if path == "/sse" else "close"
+            print(f"{name:<10} {framing:<12} {p50:>9.2f} {worst:>9.2f} {len(latencies):>7}")
+
+    print()
+    print(f"{'mode':<10} {'large body MB/s':>16}")
+    for name, relay in (("legacy", legacy_relay), ("adaptive", iter_relay)):
+        print(f"{name:<10} {measure_throughput(base_url, relay):>16.1f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
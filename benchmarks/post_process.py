@@ -0,0 +1,99 @@
+"""
+応答の後処理（キーワード置換）のベンチマーク
+
+キーワードの数を変えながら、1回の応答の置換にかかる時間を計測します。
+- str.replace: キーワードの数だけ応答全体を走査する（応答の長さ × キーワード数）
+- Aho–Corasick: コンパイル済みの表で応答を1回だけ走査する
+- Aho–Corasick（ストリーミング）: 32 文字ずつ feed() した場合（トークンごとの処理）
+
+キーワードが数十件までなら str.replace（C 実装）の方が速いが、
+数百件を超えると Aho–Corasick の方が速くなり、キーワードが増えても時間がほとんど変わらない。
+
+【実行方法】
+    pip install -r backend/requirements.txt
+    python benchmarks/post_process.py
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+from common.post_process import KeywordReplaceStage  # noqa: E402
+
+RESPONSE_CHARS = 4000     # 長めの回答1件の文字数
+CHUNK_CHARS = 32          # ストリーミング時の1回の feed() の文字数
+REPEAT = 50
+ALPHABET = "あいうえおかきくけこさしすせそたちつてとなにぬねのABCDEFG0123456789"
+
+
+def make_keywords(n: int, rng: random.Random) -> dict[str, str]:
+    keywords = {}
+    while len(keywords) < n:
+        word = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(3, 8)))
+        keywords[word] = f"<{word}>"
+    return keywords
+
+
+def make_response(keywords: list[str], rng: random.Random) -> str:
+    """ところどころにキーワードを含む回答"""
+    parts = []
+    length = 0
+    while length < RESPONSE_CHARS:
+        part = rng.choice(keywords) if rng.random() < 0.1 else "".join(rng.choice(ALPHABET) for _ in range(20))
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def naive_replace(text: str, replacements: dict[str, str]) -> str:
+    for keyword, replacement in replacements.items():
+        text = text.replace(keyword, replacement)
+    return text
+
+
+def whole(stage: KeywordReplaceStage, text: str) -> str:
+    stream = stage.stream()
+    return stream.feed(text) + stream.finish()
+
+
+def streamed(stage: KeywordReplaceStage, text: str) -> str:
+    stream = stage.stream()
+    out = [stream.feed(text[i:i + CHUNK_CHARS]) for i in range(0, len(text), CHUNK_CHARS)]
+    out.append(stream.finish())
+    return "".join(out)
+
+
+def measure(func) -> float:
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    rng = random.Random(0)
+    print(f"応答 {RESPONSE_CHARS} 文字あたりの置換時間（中央値）")
+    for n in (10, 100, 1000, 10000):
+        replacements = make_keywords(n, rng)
+        text = make_response(list(replacements), rng)
+
+        start = time.perf_counter()
+        stage = KeywordReplaceStage(replacements)
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        naive_ms = measure(lambda: naive_replace(text, replacements))
+        ac_ms = measure(lambda: whole(stage, text))
+        stream_ms = measure(lambda: streamed(stage, text))
+        print(
+            f"キーワード {n:>5} 件: str.replace={naive_ms:8.2f} ms  "
+            f"Aho–Corasick={ac_ms:6.2f} ms  ストリーミング={stream_ms:6.2f} ms  "
+            f"（コンパイル {compile_ms:7.1f} ms・設定の変更時に1回だけ）"
+        )
+
+
+if __name__ == "__main__":
+    main()
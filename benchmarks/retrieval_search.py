@@ -0,0 +1,75 @@
+"""
+文書検索（ベクトルインデックス）のベンチマーク
+
+ランダムな埋め込みでインデックスを作成し、1回の検索にかかる時間を計測します。
+- 全件検索: 件数に比例して遅くなる
+- IVF: 質問に近いクラスタだけを検索する（全件検索との一致率 recall@k もあわせて表示）
+
+埋め込み API の呼び出し時間は含みません（インデックスの検索時間のみ）。
+
+【実行方法】
+    pip install -r backend/requirements.txt
+    python benchmarks/retrieval_search.py
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+from agents._base.vector_index import VectorIndex, build_index, normalize  # noqa: E402
+
+DIM = 768          # text-embedding-004 の次元数
+QUERIES = 200
+TOP_K = 4
+TOPICS = 500       # 文書の話題の数（似た文書のまとまり）
+
+
+def make_corpus(n: int, rng: np.random.Generator) -> np.ndarray:
+    """話題ごとにまとまりのある埋め込みを生成（実際の文書の分布に近づける）"""
+    topics = normalize(rng.standard_normal((TOPICS, DIM)))
+    noise = normalize(rng.standard_normal((n, DIM)))
+    return normalize(topics[rng.integers(0, TOPICS, n)] + 0.7 * noise)
+
+
+def measure(label: str, directory: str, vectors: np.ndarray, n_lists: int, rng: np.random.Generator) -> None:
+    build_index(directory, [{"text": str(i)} for i in range(len(vectors))], vectors, model="bench", n_lists=n_lists)
+    index = VectorIndex(directory)
+
+    queries = normalize(vectors[rng.integers(0, len(vectors), QUERIES)] + 0.3 * normalize(rng.standard_normal((QUERIES, DIM))))
+    index.search(queries[0], k=TOP_K)  # ページキャッシュに載せる
+
+    timings = []
+    recall = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search(query, k=TOP_K)
+        timings.append((time.perf_counter() - start) * 1000)
+        exact = set(np.argsort(-(vectors @ query))[:TOP_K].tolist())
+        recall += len(exact & {int(r.text) for r in results}) / TOP_K
+
+    timings.sort()
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(
+        f"{label:<24} p50={statistics.median(timings):6.2f} ms  p99={p99:6.2f} ms  "
+        f"recall@{TOP_K}={recall / QUERIES:.2f}"
+    )
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"次元 {DIM} / 上位 {TOP_K} 件 / {QUERIES} 回の検索")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in (10_000, 50_000):
+            measure(f"全件検索 {n:,} 件", os.path.join(tmp, f"flat-{n}"), make_corpus(n, rng), 0, rng)
+        n = 200_000
+        vectors = make_corpus(n, rng)
+        measure(f"全件検索 {n:,} 件", os.path.join(tmp, "flat-big"), vectors, 0, rng)
+        measure(f"IVF {n:,} 件", os.path.join(tmp, "ivf-big"), vectors, None, rng)
+
+
+if __name__ == "__main__":
+    main()
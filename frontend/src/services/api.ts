@@ -41,17 +41,23 @@ export interface ChatResponse {
  *
  * @param message ユーザーのメッセージ
  * @param threadId スレッドID（省略可）
+ * @param idempotencyKey 冪等性キー（同じメッセージを再送する場合は同じ値を渡す。省略時は自動生成）
  * @returns レスポンスオブジェクト { response: string, threadId: string }
  */
 export async function sendChatMessage(
   message: string,
-  threadId: string | null
+  threadId: string | null,
+  idempotencyKey: string = crypto.randomUUID()
 ): Promise<ChatResponse> {
   const headers = await createAuthHeaders()
 
   const res = await fetch(`${API_BASE_URL}/chat`, {
     method: 'POST',
-    headers,
+    headers: {
+      ...headers,
+      // 再送時にサーバー側で同じメッセージを二重に処理しないためのキー
+      'Idempotency-Key': idempotencyKey,
+    },
     body: JSON.stringify({
       message,
       thread_id: threadId,
@@ -0,0 +1,176 @@
+"""
+アドミッション制御モジュール（Gateway でのレート制限）
+
+明らかに多すぎるリクエストを、Backend に転送する前に Gateway で拒否します。
+
+【なぜ必要か？】
+Backend のレート制限（common/rate_limiter.py）は Firestore のトランザクションで
+判定するため、拒否されるリクエストも
+- Backend のインスタンスを起動・占有する
+- Firestore のトランザクションを消費する
+大量のリクエスト（攻撃・バグによるループ）はその手前で止めたい。
+
+【仕組み】
+トークンバケット方式（ユーザー単位 + 顧客単位の2段階）
+- バケットには最大 burst 個のトークンが入る
+- トークンは1分あたり rate_per_minute 個のペースで補充される
+- リクエストごとに1個消費し、空なら 429 を返す（Retry-After 付き）
+- 一括チャット（/chat/batch）は、顧客単位のバケットから項目数ぶん消費する（容量を超える分は
+  容量までとし、大きな一括チャットはバケットを空にする）。ユーザー単位のバケットは1回分だけ
+- ユーザー・顧客の両方のバケットにトークンがある場合だけ、両方から消費する
+  （顧客の制限で拒否したリクエストで、ユーザーのトークンを減らさない）
+
+【Backend のレート制限との関係】
+Gateway の制限は「明らかな過剰」を止めるための緩い制限。
+正確な制限（Firestore で顧客ごとに設定可能）は引き続き Backend が行う。
+
+【複数インスタンスで共有したい場合】
+デフォルトではインスタンスごとのメモリで管理する。
+Redis などで共有したい場合は、TokenBucketStore と同じメソッドを持つクラスを作り、
+set_admission_store() で差し替える（take_all() は複数のバケットをまとめて判定すること）。
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# ===== 設定 =====
+
+def _positive_env(name: str, default: str) -> float:
+    """正の数の環境変数（0 以下は補充・許可ができなくなるため起動時にエラーにする）"""
+    value = float(os.environ.get(name, default))
+    if not value > 0:
+        raise ValueError(f"{name} には正の数を指定してください: {value}")
+    return value
+
+
+# ユーザー単位の制限: 1分あたりのリクエスト数と、連続して送れる最大数
+EDGE_UID_RATE_PER_MINUTE = _positive_env("EDGE_UID_RATE_PER_MINUTE", "30")
+EDGE_UID_BURST = _positive_env("EDGE_UID_BURST", "10")
+
+# 顧客単位の制限: 1分あたりのリクエスト数と、連続して送れる最大数
+EDGE_CUSTOMER_RATE_PER_MINUTE = _positive_env("EDGE_CUSTOMER_RATE_PER_MINUTE", "600")
+EDGE_CUSTOMER_BURST = _positive_env("EDGE_CUSTOMER_BURST", "100")
+
+# メモリ上に保持するバケットの最大数（超えたら最も古いものから削除）
+ADMISSION_MAX_KEYS = int(os.environ.get("ADMISSION_MAX_KEYS", "100000"))
+
+
+class TokenBucketStore:
+    """
+    メモリ上のトークンバケット（スレッドセーフ）
+
+    共有ストアに差し替える場合も、take() / take_all() と同じ引数・戻り値にすること。
+    """
+
+    def __init__(self, max_keys: int = ADMISSION_MAX_KEYS):
+        self.max_keys = max_keys
+        # 形式: {key: (残りトークン数, 最終更新時刻)}
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate_per_second: float, burst: float, cost: float = 1) -> float:
+        """
+        トークンを cost 個消費する
+
+        Args:
+            key: バケットのキー（例: "uid:abc123"）
+            rate_per_second: 1秒あたりの補充量
+            burst: バケットの容量
+            cost: 消費するトークン数（容量を超える分は容量まで）
+
+        Returns:
+            0.0: 許可（トークンを消費した）
+            正の数: 拒否（次のトークンが補充されるまでの秒数）
+        """
+        return self.take_all([(key, rate_per_second, burst)], cost)
+
+    def take_all(self, buckets: list[tuple[str, float, float]], cost: float = 1) -> float:
+        """
+        すべてのバケットにトークンが cost 個ある場合だけ、すべてから消費する
+
+        Args:
+            buckets: [(key, rate_per_second, burst)]
+            cost: 消費するトークン数（各バケットの容量を超える分は容量まで）
+
+        Returns:
+            0.0: 許可（すべてのバケットからトークンを消費した）
+            正の数: 拒否（どのバケットからも消費しない。すべてのバケットに補充されるまでの秒数）
+        """
+        for key, rate_per_second, burst in buckets:
+            if not (rate_per_second > 0 and burst > 0):
+                raise ValueError(f"rate_per_second と burst には正の数を指定してください: {key}")
+
+        now = time.monotonic()
+        with self._lock:
+            refilled = []
+            wait_seconds = 0.0
+            for key, rate_per_second, burst in buckets:
+                tokens, updated_at = self._buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated_at) * rate_per_second)
+                bucket_cost = min(cost, burst)
+                if tokens < bucket_cost:
+                    wait_seconds = max(wait_seconds, (bucket_cost - tokens) / rate_per_second)
+                refilled.append((key, tokens, bucket_cost))
+
+            for key, tokens, bucket_cost in refilled:
+                if wait_seconds == 0:
+                    tokens -= bucket_cost
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            # 古いバケットを削除（削除されたキーは満タンから再スタート）
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            return wait_seconds
+
+
+_store = TokenBucketStore()
+
+
+def set_admission_store(store) -> None:
+    """バケットの保存先を差し替える（Redis など、複数インスタンスで共有する場合）"""
+    global _store
+    _store = store
+
+
+def admit(uid: str, customer_id: str) -> int:
+    """
+    リクエストを受け付けてよいか判定
+
+    Args:
+        uid: ユーザーID
+        customer_id: 顧客ID
+
+    Returns:
+        0: 許可
+        正の整数: 拒否（Retry-After に設定する秒数）
+    """
+    wait_seconds = _store.take_all(
+        [
+            (f"uid:{uid}", EDGE_UID_RATE_PER_MINUTE / 60, EDGE_UID_BURST),
+            (f"customer:{customer_id}", EDGE_CUSTOMER_RATE_PER_MINUTE / 60, EDGE_CUSTOMER_BURST),
+        ],
+    )
+    return math.ceil(wait_seconds)
+
+
+def admit_batch_items(customer_id: str, items: int) -> int:
+    """
+    一括チャットの項目数ぶんのトークンを、顧客単位のバケットから消費する
+
+    ユーザー単位のバケットは消費しない（一括チャットで同じユーザーの通常のチャットを止めない）。
+
+    Args:
+        customer_id: 顧客ID
+        items: 追加で消費するトークン数（1回分は admit() で消費済み）
+
+    Returns:
+        0: 許可
+        正の整数: 拒否（Retry-After に設定する秒数）
+    """
+    wait_seconds = _store.take(
+        f"customer:{customer_id}", EDGE_CUSTOMER_RATE_PER_MINUTE / 60, EDGE_CUSTOMER_BURST, items
+    )
+    return math.ceil(wait_seconds)
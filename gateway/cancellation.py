@@ -0,0 +1,245 @@
+"""
+締め切りの伝達とクライアント切断時の取り消しモジュール
+
+【締め切り】
+Gateway がリクエストを受けた時点から REQUEST_DEADLINE_SECONDS 秒（/chat/batch は BATCH_REQUEST_DEADLINE_SECONDS 秒）を締め切りとし、
+残り時間を X-Request-Deadline-Ms ヘッダー（ミリ秒）で Backend に伝える。
+Backend は残り時間を認証・チェックポイントの読み書き・LLM の呼び出しに割り振る。
+（絶対時刻ではなく残り時間で渡すのは、Gateway と Backend の時計のずれを避けるため）
+
+【クライアント切断時の取り消し】
+ブラウザを閉じた・再読み込みしたなどでクライアントが切断しても、
+Backend は誰も受け取らない応答を生成し続け、Vertex AI の料金と枠を消費してしまう。
+切断を検知したら POST {Backend}/chat/cancel で、同じ X-Request-Id のリクエストを取り消す。
+
+切断は次の2か所で検知する:
+- 応答待ち: Backend の応答を待つ間、クライアントのソケットを定期的に確認する
+  （同期の /chat は応答全体ができるまで何も返さないため、中継開始後の検知だけでは遅い）
+  転送はリクエストのスレッドのまま行い、ソケットの確認は1つのスレッドでまとめて行う。
+  切断を見つけたらすぐに取り消しを通知し、Backend が打ち切って返した応答は捨てる。
+- 中継中: ストリーミングの中継中にクライアントが切断すると、ジェネレータに GeneratorExit が届く
+
+取り消しの通知は専用のスレッドプール（CANCEL_MAX_WORKERS）で送る。
+転送とは別のプールにすることで、応答待ちのリクエストが多くても通知が遅れない。
+"""
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# ===== 設定 =====
+
+# クライアントを待たせる上限（秒）。Backend にはこの残り時間を伝える
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "60"))
+
+# 一括チャット（/chat/batch）の締め切り（秒）: 結果を少しずつ返すため、1回のチャットより長く待つ
+BATCH_REQUEST_DEADLINE_SECONDS = float(os.environ.get("BATCH_REQUEST_DEADLINE_SECONDS", "300"))
+
+# 締め切りを長くするパス
+_LONG_RUNNING_PATHS = frozenset({"chat/batch"})
+
+# 応答待ちの間、クライアントの切断を確認する間隔（秒）
+DISCONNECT_POLL_INTERVAL_SECONDS = float(os.environ.get("DISCONNECT_POLL_INTERVAL_SECONDS", "0.5"))
+
+# 取り消しの通知のタイムアウト（秒）
+CANCEL_TIMEOUT_SECONDS = float(os.environ.get("CANCEL_TIMEOUT_SECONDS", "3"))
+
+# Backend に残り時間を伝えるヘッダー（ミリ秒）
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# 取り消しの通知用のスレッドプール（通知は短時間で終わるため、少なくてよい）
+_cancel_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CANCEL_MAX_WORKERS", "8")),
+    thread_name_prefix="cancel",
+)
+
+
+def deadline_seconds(path: str) -> float:
+    """パスごとの締め切り（秒）"""
+    return BATCH_REQUEST_DEADLINE_SECONDS if path.strip("/") in _LONG_RUNNING_PATHS else REQUEST_DEADLINE_SECONDS
+
+
+class ClientDisconnected(Exception):
+    """Backend の応答を待つ間にクライアントが切断した"""
+
+
+class CancellationStats:
+    """切断・取り消しの件数（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.disconnected_while_waiting = 0
+        self.disconnected_while_relaying = 0
+        self.cancel_sent = 0
+        self.cancel_failed = 0
+
+    def increment(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "disconnected_while_waiting": self.disconnected_while_waiting,
+                "disconnected_while_relaying": self.disconnected_while_relaying,
+                "cancel_sent": self.cancel_sent,
+                "cancel_failed": self.cancel_failed,
+            }
+
+
+_stats = CancellationStats()
+
+
+def get_cancellation_stats() -> dict:
+    """切断・取り消しの件数"""
+    return _stats.snapshot()
+
+
+def client_socket(environ: dict) -> socket.socket | None:
+    """
+    クライアントのソケットを取得（取得できない WSGI サーバーでは None）
+
+    gunicorn（Cloud Functions / Cloud Run）と werkzeug（ローカル開発）に対応。
+    """
+    return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
+def is_disconnected(sock: socket.socket) -> bool:
+    """
+    クライアントが切断したか（ブロックしない）
+
+    読み込み可能なのに1バイトも読めない = 相手が接続を閉じた。
+    MSG_PEEK で覗くだけなので、次のリクエスト（keep-alive）のデータは消費しない。
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        # 接続がリセットされた・ソケットが閉じている
+        return True
+
+
+class _Watch:
+    """応答待ちのリクエスト1件分の監視"""
+
+    def __init__(self, sock: socket.socket, on_disconnect: Callable[[], None]):
+        self.sock = sock
+        self.on_disconnect = on_disconnect
+        self.disconnected = threading.Event()
+
+
+class ClientWatcher:
+    """
+    応答待ちのクライアントのソケットを、1つのスレッドでまとめて確認する
+
+    監視スレッドは最初に使われたときに起動する（デーモンスレッド）。
+    """
+
+    def __init__(self, interval_seconds: float = DISCONNECT_POLL_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._watches: set[_Watch] = set()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def add(self, sock: socket.socket, on_disconnect: Callable[[], None]) -> _Watch:
+        watch = _Watch(sock, on_disconnect)
+        with self._lock:
+            self._watches.add(watch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="client-watcher", daemon=True)
+                self._thread.start()
+        return watch
+
+    def remove(self, watch: _Watch) -> None:
+        with self._lock:
+            self._watches.discard(watch)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval_seconds)
+            with self._lock:
+                watches = list(self._watches)
+            for watch in watches:
+                if watch.disconnected.is_set() or not is_disconnected(watch.sock):
+                    continue
+                watch.disconnected.set()
+                _stats.increment("disconnected_while_waiting")
+                try:
+                    watch.on_disconnect()
+                except Exception:
+                    logger.exception("切断時の処理でエラーが発生")
+
+
+_watcher = ClientWatcher()
+
+
+def send_watching_client(
+    send: Callable[[], requests.Response],
+    sock: socket.socket,
+    on_disconnect: Callable[[], None],
+) -> requests.Response:
+    """
+    Backend に転送し、応答を待つ間クライアントの切断を確認する
+
+    Args:
+        send: 1回分の転送（このスレッドで実行する）
+        sock: クライアントのソケット
+        on_disconnect: 応答待ちの間に切断したときに、監視スレッドから呼ぶ処理（取り消しの通知）
+
+    Returns:
+        Backend の応答
+
+    Raises:
+        ClientDisconnected: 応答を待つ間にクライアントが切断した（on_disconnect は呼び出し済み）
+    """
+    watch = _watcher.add(sock, on_disconnect)
+    try:
+        resp = send()
+    finally:
+        _watcher.remove(watch)
+    if watch.disconnected.is_set():
+        # 取り消されて返ってきた応答は誰も読まない
+        resp.close()
+        raise ClientDisconnected()
+    return resp
+
+
+def notify_disconnect_while_relaying() -> None:
+    """中継中にクライアントが切断したことを記録"""
+    _stats.increment("disconnected_while_relaying")
+
+
+def cancel_upstream(company_url: str, headers: dict) -> None:
+    """
+    Backend に取り消しを通知（バックグラウンドで送り、待たない）
+
+    Args:
+        company_url: Backend の URL
+        headers: 転送時のヘッダー（認証用の内部ヘッダーと X-Request-Id を含む）
+    """
+    cancel_headers = {
+        key: value for key, value in headers.items()
+        if key.startswith("X-") and key != DEADLINE_HEADER
+    }
+    _cancel_executor.submit(_send_cancel, f"{company_url}/chat/cancel", cancel_headers)
+
+
+def _send_cancel(url: str, headers: dict) -> None:
+    try:
+        resp = requests.post(url, headers=headers, timeout=CANCEL_TIMEOUT_SECONDS)
+        resp.close()
+        _stats.increment("cancel_sent")
+    except requests.RequestException as e:
+        # 取り消せなくても、Backend は締め切りで打ち切る
+        _stats.increment("cancel_failed")
+        logger.warning(f"取り消しの通知に失敗: {url}: {e}")
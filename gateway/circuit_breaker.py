@@ -0,0 +1,137 @@
+"""
+サーキットブレーカーモジュール
+
+顧客の Backend（company_url）ごとに障害を検知し、
+障害中は Backend に転送せず即座にエラーを返します。
+
+【なぜ必要か？】
+Backend がコールドスタート中・障害中でも、Gateway は1リクエストあたり
+最大300秒待ってから 502/504 を返していた。
+障害中の顧客へのリクエストが Gateway のワーカーを占有し、
+他の顧客まで遅くなってしまう。
+
+【状態遷移】
+    CLOSED（通常）
+      │ 連続失敗が BREAKER_FAILURE_THRESHOLD 回に達する
+      ▼
+    OPEN（遮断: 即座に 503 を返す）
+      │ BREAKER_OPEN_SECONDS 経過
+      ▼
+    HALF_OPEN（試行: 1リクエストだけ転送して様子を見る）
+      │ 成功 → CLOSED / 失敗 → OPEN
+"""
+import os
+import threading
+import time
+
+# ===== 設定 =====
+
+# 何回連続で失敗したら遮断するか
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+
+# 遮断してから試行（HALF_OPEN）に移るまでの秒数
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+
+# 失敗とみなすステータスコード（Backend に到達できない・過負荷）
+BREAKER_FAILURE_STATUSES = frozenset({502, 503})
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """1つの転送先（company_url）のサーキットブレーカー（スレッドセーフ）"""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 open_seconds: float = BREAKER_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        リクエストを転送してよいか判定
+
+        Returns:
+            True: 転送してよい（HALF_OPEN の場合は試行リクエストとして扱う）
+            False: 遮断中（すぐにエラーを返す）
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                # 遮断時間が過ぎた: 1リクエストだけ試行する
+                self.state = HALF_OPEN
+                self._probe_started_at = now
+                return True
+
+            # HALF_OPEN: 試行中のリクエストが応答しないまま時間が経った場合のみ、次の試行を許可
+            if now - self._probe_started_at >= self.open_seconds:
+                self._probe_started_at = now
+                return True
+            return False
+
+    def is_open(self) -> bool:
+        """
+        遮断中か（allow_request() が False を返す状態か。状態は変えない）
+
+        転送先を選ぶときに、遮断中のエンドポイントを候補から外すために使う。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                return now - self._opened_at < self.open_seconds
+            if self.state == HALF_OPEN:
+                return now - self._probe_started_at < self.open_seconds
+            return False
+
+    def record_success(self) -> None:
+        """転送成功を記録（遮断を解除）"""
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        """転送失敗を記録（閾値を超えたら遮断）"""
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def record_status(self, status_code: int) -> None:
+        """ステータスコードから成功/失敗を判定して記録"""
+        if status_code in BREAKER_FAILURE_STATUSES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def retry_after_seconds(self) -> int:
+        """遮断が解除されるまでの秒数（Retry-After ヘッダー用）"""
+        with self._lock:
+            remaining = self.open_seconds - (time.monotonic() - self._opened_at)
+        return max(1, int(remaining + 0.999))
+
+
+# 転送先ごとのサーキットブレーカー
+# 形式: {company_url: CircuitBreaker}
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(company_url: str) -> CircuitBreaker:
+    """転送先のサーキットブレーカーを取得（なければ作成）"""
+    breaker = _breakers.get(company_url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(company_url, CircuitBreaker())
+    return breaker
@@ -30,7 +30,10 @@
 - Cloud Run IAM で Backend へのアクセスを Gateway のみに制限（推奨）
 """
 import os
+import hmac
+import json
 import time
+import uuid
 import logging
 from flask import Flask, request, Response
 import requests
@@ -38,6 +41,24 @@ import functions_framework
 import firebase_admin
 from firebase_admin import auth, firestore
 
+from admission import admit, admit_batch_items
+from cancellation import (
+    DEADLINE_HEADER,
+    ClientDisconnected,
+    cancel_upstream,
+    client_socket,
+    deadline_seconds,
+    get_cancellation_stats,
+    notify_disconnect_while_relaying,
+    send_watching_client,
+)
+from circuit_breaker import BREAKER_FAILURE_STATUSES, HALF_OPEN, get_breaker
+from relay import iter_relay
+from request_body import RequestBodyTooLarge, prepare_upstream_body
+from retry import get_retry_budget, hedged_request, is_safe_request
+from routing import Endpoint, parse_endpoints, router
+from timing import get_timing_stats, request_timer, setup_timing
+
 # ===== ロギング設定 =====
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -52,12 +73,27 @@ ALLOWED_ORIGINS = os.environ.get(
 # キャッシュ TTL（秒）: 顧客設定の変更を反映するまでの時間
 CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", "300"))  # デフォルト5分
 
+# 転送のタイムアウト（秒）
+# 接続できない Backend は早めに諦め、応答待ちは AI 処理を考慮して長めに取る
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT_SECONDS", "10"))
+UPSTREAM_READ_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_READ_TIMEOUT_SECONDS", "300"))  # 5分
+
+# 安全なリクエスト（GET /agents）の応答待ちタイムアウト（秒）
+SAFE_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("SAFE_REQUEST_TIMEOUT_SECONDS", "10"))
+
+# 締め切りを過ぎてから Backend のエラー応答（504）を待つ猶予（秒）
+DEADLINE_GRACE_SECONDS = float(os.environ.get("DEADLINE_GRACE_SECONDS", "5"))
+
+# 運用メトリクス（GET /metrics）のアクセストークン（未設定の場合は無効）
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
 # ===== Firebase 初期化 =====
 firebase_admin.initialize_app()
 db = firestore.client()
 
 # ===== Flask アプリケーション =====
 app = Flask(__name__)
+setup_timing(app)
 
 
 # ===== ヘルパー関数 =====
@@ -75,7 +111,7 @@ def get_cors_origin() -> str:
     return ALLOWED_ORIGINS[0] if ALLOWED_ORIGINS else "*"
 
 
-def error_response(message: str, status_code: int, detail: str = None):
+def error_response(message: str, status_code: int, detail: str = None, headers: dict = None):
     """
     統一されたエラーレスポンス
 
@@ -83,11 +119,15 @@ def error_response(message: str, status_code: int, detail: str = None):
         message: エラーメッセージ
         status_code: HTTPステータスコード
         detail: 詳細メッセージ（オプション）
+        headers: 追加のレスポンスヘッダー（オプション、例: Retry-After）
     """
     body = {"error": message}
     if detail:
         body["message"] = detail
-    return body, status_code, {"Access-Control-Allow-Origin": get_cors_origin()}
+    response_headers = {"Access-Control-Allow-Origin": get_cors_origin()}
+    if headers:
+        response_headers.update(headers)
+    return body, status_code, response_headers
 
 
 # ===== 認証 =====
@@ -150,27 +190,31 @@ def verify_request():
 # ===== 転送先 URL の取得 =====
 
 # TTL付きキャッシュ
-# 形式: {customer_id: (url, cached_at)}
+# 形式: {customer_id: (endpoints, cached_at)}
 # - customer_id: 顧客ID（文字列）
-# - url: Cloud Functions の URL（文字列）
+# - endpoints: 転送先エンドポイントの一覧（list[Endpoint]）
 # - cached_at: キャッシュした時刻（UNIX時間、float）
-# 例: {"acme-corp": ("https://xxx.cloudfunctions.net/api", 1705600000.0)}
-_url_cache: dict[str, tuple[str, float]] = {}
+# 例: {"acme-corp": ([Endpoint("https://xxx.cloudfunctions.net/api")], 1705600000.0)}
+_endpoint_cache: dict[str, tuple[list[Endpoint], float]] = {}
 
 
-def get_company_url(customer_id: str) -> str | None:
+def get_company_endpoints(customer_id: str) -> list[Endpoint] | None:
     """
-    Firestore から顧客の Cloud Functions URL を取得（TTL付きキャッシュ）
+    Firestore から顧客の転送先エンドポイント一覧を取得（TTL付きキャッシュ）
 
     Args:
         customer_id: 顧客ID
 
     Returns:
-        Cloud Functions の URL または None
+        エンドポイントの一覧 または None（顧客が存在しない・無効・転送先が未設定）
+
+    Raises:
+        Exception: Firestore の読み込みに失敗した（顧客がいないわけではないため 404 にしない）
 
     Firestore 構造:
         customers/{customer_id}
         ├── cloud_functions_url: "https://xxx.cloudfunctions.net/..."
+        ├── endpoints: [{"url": "...", "weight": 1}, ...]  （任意: 複数リージョン等）
         └── enabled: true
 
     【キャッシュについて】
@@ -181,38 +225,89 @@ def get_company_url(customer_id: str) -> str | None:
     now = time.time()
 
     # キャッシュを確認（TTL内なら使用）
-    if customer_id in _url_cache:
-        cached_url, cached_time = _url_cache[customer_id]
+    if customer_id in _endpoint_cache:
+        cached_endpoints, cached_time = _endpoint_cache[customer_id]
         if now - cached_time < CACHE_TTL_SECONDS:
-            return cached_url
+            return cached_endpoints
         # TTL切れ: キャッシュを削除して再取得
-        del _url_cache[customer_id]
+        del _endpoint_cache[customer_id]
 
-    try:
-        doc = db.collection("customers").document(customer_id).get()
-        if not doc.exists:
-            logger.warning(f"顧客が見つかりません: {customer_id}")
-            return None
+    doc = db.collection("customers").document(customer_id).get()
+    if not doc.exists:
+        logger.warning(f"顧客が見つかりません: {customer_id}")
+        return None
+
+    data = doc.to_dict()
+
+    # 有効かどうか確認
+    if not data.get("enabled", True):
+        logger.warning(f"顧客が無効化されています: {customer_id}")
+        return None
+
+    # 不正なエンドポイントは読み飛ばす（警告は parse_endpoints が出す）
+    endpoints = parse_endpoints(data)
+    if endpoints:
+        # キャッシュに保存（タイムスタンプ付き）
+        _endpoint_cache[customer_id] = (endpoints, now)
+        return endpoints
+
+    logger.warning(f"cloud_functions_url / endpoints が未設定: {customer_id}")
+    return None
 
-        data = doc.to_dict()
 
-        # 有効かどうか確認
-        if not data.get("enabled", True):
-            logger.warning(f"顧客が無効化されています: {customer_id}")
+def get_thread_id(body) -> str | None:
+    """
+    リクエストから thread_id を取り出す（スティッキールーティング用）
+
+    確認する順番:
+    1. X-Thread-Id ヘッダー
+    2. クエリパラメータ thread_id
+    3. JSON ボディの thread_id（一括読み込みした小さなボディのみ）
+
+    ストリーミング転送するボディは読まない（転送前にメモリに溜め込まないため）
+    """
+    thread_id = request.headers.get("X-Thread-Id") or request.args.get("thread_id")
+    if thread_id:
+        return thread_id
+
+    if isinstance(body, bytes) and request.is_json:
+        try:
+            data = json.loads(body)
+        except ValueError:
             return None
+        if isinstance(data, dict) and isinstance(data.get("thread_id"), str):
+            return data["thread_id"]
+    return None
 
-        url = data.get("cloud_functions_url")
-        if url:
-            # キャッシュに保存（タイムスタンプ付き）
-            _url_cache[customer_id] = (url, now)
-            return url
 
-        logger.warning(f"cloud_functions_url が未設定: {customer_id}")
-        return None
+def get_batch_size(path: str, body) -> int:
+    """
+    一括チャット（POST /chat/batch）の項目数（アドミッション制御で項目数ぶん消費するため）
 
-    except Exception as e:
-        logger.exception(f"Firestore エラー: {e}")
-        return None
+    一括読み込みした小さなボディのみ数える。それ以外は 1 を返す
+    （ストリーミング転送する大きなボディは、Backend の顧客ごとの項目数の上限で制限する）
+    """
+    if request.method != "POST" or path.strip("/") != "chat/batch":
+        return 1
+    if not isinstance(body, bytes) or not request.is_json:
+        return 1
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return 1
+    items = data.get("items") if isinstance(data, dict) else None
+    return len(items) if isinstance(items, list) and items else 1
+
+
+def admission_error(retry_after: int, uid: str, customer_id: str):
+    """アドミッション制御で拒否した場合のレスポンス"""
+    logger.warning(f"Gateway のレート制限を超えました: uid={uid}, customer={customer_id}")
+    return error_response(
+        "リクエスト制限を超えました",
+        429,
+        f"{retry_after}秒後に再度お試しください",
+        headers={"Retry-After": str(retry_after)},
+    )
 
 
 # ===== エンドポイント =====
@@ -227,6 +322,28 @@ def health():
     return {"status": "healthy", "service": "gateway"}
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Gateway の運用メトリクス（顧客・段階ごとの処理時間の p50 / p95 / p99、クライアントの切断・取り消しの件数）
+
+    全顧客の情報を含むため、Firebase の認証ではなく
+    X-Metrics-Token ヘッダー（環境変数 METRICS_TOKEN）で認証する。
+    METRICS_TOKEN が未設定の場合は無効（404）。
+    Backend のメトリクスは Backend の GET /metrics を直接参照する。
+    """
+    if not METRICS_TOKEN:
+        return error_response("Not Found", 404)
+    token = request.headers.get("X-Metrics-Token", "")
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return error_response("認証に失敗しました", 401)
+
+    return {
+        "timing": get_timing_stats(),
+        "cancellations": get_cancellation_stats(),
+    }
+
+
 # ルートパス「/」と、それ以下の全てのパス「/xxx/yyy」の両方をこの関数で処理
 # defaults={"path": ""} により、「/」にアクセスした場合は path="" となる
 @app.route("/", defaults={"path": ""}, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
@@ -237,22 +354,31 @@ def proxy(path):
 
     処理の流れ:
     1. CORS プリフライトを処理
-    2. Firebase トークンを検証
-    3. customer_id から転送先 URL を取得
-    4. リクエストをそのまま転送（ストリーミング対応）
+    2. Firebase トークンを検証し、レート制限を確認
+    3. customer_id から転送先 URL を取得（複数あればルーティング）
+    4. サーキットブレーカーを確認（障害中の Backend には転送しない）
+    5. リクエストをそのまま転送（ストリーミング対応）
+       クライアントが切断したら Backend に取り消しを通知する
     """
+    # 締め切りは Gateway が受け付けた時点から数える（認証・Firestore の読み込みの時間も含む）
+    deadline = time.monotonic() + deadline_seconds(path)
+    # 段階ごとの処理時間（Server-Timing ヘッダー・ログ・GET /metrics）
+    timer = request_timer()
+
     # ----- CORS プリフライト -----
     # ブラウザが実際のリクエスト前に送る「確認リクエスト」
     if request.method == "OPTIONS":
         return "", 204, {
             "Access-Control-Allow-Origin": get_cors_origin(),
             "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-            "Access-Control-Allow-Headers": "Authorization, Content-Type",
+            "Access-Control-Allow-Headers": "Authorization, Content-Type, Idempotency-Key",
             "Access-Control-Max-Age": "3600",
         }
 
     # ----- 1. 認証 -----
-    uid, customer_id = verify_request()
+    with timer.stage("gateway_auth"):
+        uid, customer_id = verify_request()
+    timer.customer_id = customer_id
     if not uid:
         return error_response(
             "認証が必要です",
@@ -267,40 +393,164 @@ def proxy(path):
             "管理者に連絡してください"
         )
 
+    # ----- アドミッション制御 -----
+    # 明らかに多すぎるリクエストは Backend に転送せずここで拒否
+    # （Backend のインスタンスや Firestore のトランザクションを消費させない）
+    with timer.stage("gateway_admission"):
+        retry_after = admit(uid, customer_id)
+    if retry_after:
+        return admission_error(retry_after, uid, customer_id)
+
     # ----- 2. 転送先 URL を取得 -----
-    company_url = get_company_url(customer_id)
-    if not company_url:
+    try:
+        with timer.stage("gateway_routing"):
+            endpoints = get_company_endpoints(customer_id)
+    except Exception as e:
+        logger.exception(f"Firestore エラー: {e}")
+        return error_response(
+            "顧客の設定を取得できませんでした",
+            503,
+            "しばらく待ってから再度お試しください"
+        )
+    if not endpoints:
         return error_response(
             "顧客の設定が見つかりません",
             404,
             "管理者に連絡してください"
         )
 
-    # ----- 3. リクエストを転送 -----
+    # リクエストボディを準備
+    # 大きなボディはメモリに溜め込まず、読みながら転送する
+    try:
+        body = prepare_upstream_body(request)
+    except RequestBodyTooLarge as e:
+        logger.warning(f"リクエストボディが大きすぎます: customer={customer_id}, limit={e.limit}")
+        return error_response(
+            "リクエストが大きすぎます",
+            413,
+            f"{e.limit}バイト以内で送信してください"
+        )
+
+    # 一括チャットは顧客単位のバケットから項目数ぶんのトークンを消費する（1件分は上で消費済み）
+    batch_size = get_batch_size(path, body)
+    if batch_size > 1:
+        with timer.stage("gateway_admission"):
+            retry_after = admit_batch_items(customer_id, batch_size - 1)
+        if retry_after:
+            return admission_error(retry_after, uid, customer_id)
+
+    # ----- 3. 転送先の選択とサーキットブレーカー -----
+    # 複数エンドポイントがある場合は、レイテンシ・エラー率・thread_id から転送先を選ぶ
+    # 遮断中のエンドポイントは候補から外し、全エンドポイントが遮断中の場合だけ、すぐに 503 を返す
+    # （障害中の Backend に転送して Gateway のワーカーを占有しない）
+    thread_id = get_thread_id(body)
+    refused: set[str] = set()
+    while True:
+        endpoint = router.select(
+            endpoints, thread_id,
+            is_available=lambda url: url not in refused and not get_breaker(url).is_open(),
+        )
+        if endpoint is None:
+            logger.warning(f"全エンドポイントが遮断中のため転送しません: customer={customer_id}")
+            retry_after = min(get_breaker(e.url).retry_after_seconds() for e in endpoints)
+            return error_response(
+                "サービスが一時的に利用できません",
+                503,
+                "しばらく待ってから再度お試しください",
+                headers={"Retry-After": str(retry_after)},
+            )
+        breaker = get_breaker(endpoint.url)
+        # 選んだ後に他のリクエストが試行（HALF_OPEN）の枠を使った場合は、別のエンドポイントを選び直す
+        if breaker.allow_request():
+            break
+        refused.add(endpoint.url)
+    company_url = endpoint.url
+    retry_budget = get_retry_budget(company_url)
+    retry_budget.deposit()
+
+    # ----- 4. リクエストを転送 -----
     target_url = f"{company_url}/{path}" if path else company_url
+    method = request.method
 
-    logger.info(f"転送: {request.method} /{path} -> {target_url} (customer={customer_id})")
+    logger.info(f"転送: {method} /{path} -> {target_url} (customer={customer_id})")
 
+    started_at = time.monotonic()
     try:
-        # リクエストを転送
-        # stream=True: レスポンスを一度に全部メモリに読み込まず、少しずつ受信
-        # 大きなレスポンスや、AI のストリーミング応答に対応するため必須
-        resp = requests.request(
-            method=request.method,
-            url=target_url,
-            headers={
-                # Gateway が検証済みであることを示すヘッダー
-                "X-Gateway-Verified": "true",
-                "X-User-Id": uid,
-                "X-Customer-Id": customer_id,
-                # 元のリクエストのヘッダー
-                "Content-Type": request.content_type or "application/json",
-            },
-            data=request.get_data(),
-            stream=True,
-            timeout=300,  # 5分（AI 応答に時間がかかる場合がある）
+        upstream_headers = {
+            # Gateway が検証済みであることを示すヘッダー
+            "X-Gateway-Verified": "true",
+            "X-User-Id": uid,
+            "X-Customer-Id": customer_id,
+            # 元のリクエストのヘッダー
+            "Content-Type": request.content_type or "application/json",
+            # 圧縮は Backend で行う（Gateway は展開・再圧縮せずに中継する）
+            "Accept-Encoding": request.headers.get("Accept-Encoding", "identity"),
+        }
+        # 再送の重複処理防止（Backend が同じキーのリクエストを1回だけ処理する）
+        if "Idempotency-Key" in request.headers:
+            upstream_headers["Idempotency-Key"] = request.headers["Idempotency-Key"]
+
+        # 締め切りまでの残り時間と、取り消し用のリクエストID
+        remaining = max(0.0, deadline - time.monotonic())
+        upstream_headers[DEADLINE_HEADER] = str(int(remaining * 1000))
+        upstream_headers["X-Request-Id"] = uuid.uuid4().hex
+
+        # 副作用のない GET はリトライ・ヘッジ対象（短いタイムアウトで早めに見切る）
+        # ただし HALF_OPEN の試行中は1本だけ送る
+        safe = is_safe_request(method, path) and breaker.state != HALF_OPEN
+        if safe:
+            read_timeout = SAFE_REQUEST_TIMEOUT_SECONDS
+        else:
+            # Backend は締め切りで打ち切って 504 を返すので、それより少しだけ長く待つ
+            read_timeout = min(UPSTREAM_READ_TIMEOUT_SECONDS, remaining + DEADLINE_GRACE_SECONDS)
+
+        def send():
+            """
+            1回分の転送
+
+            ヘッジリクエストでは別スレッドから呼ばれるため、
+            Flask の request をここで参照してはいけない（必要な値は事前に取り出す）
+            """
+            # stream=True: レスポンスを一度に全部メモリに読み込まず、少しずつ受信
+            # 大きなレスポンスや、AI のストリーミング応答に対応するため必須
+            return requests.request(
+                method=method,
+                url=target_url,
+                headers=upstream_headers,
+                data=body,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT_SECONDS, read_timeout),
+            )
+
+        # 応答待ちの間にクライアントが切断したら、Backend の処理を取り消す
+        # （ボディを読みながら転送する場合は、そのソケットを覗けないので確認しない）
+        sock = client_socket(request.environ)
+        watch_client = sock is not None and (body is None or isinstance(body, bytes))
+
+        with timer.stage("gateway_upstream"):
+            if safe:
+                resp = hedged_request(send, retry_budget)
+            elif watch_client:
+                resp = send_watching_client(
+                    send, sock, on_disconnect=lambda: cancel_upstream(company_url, upstream_headers)
+                )
+            else:
+                resp = send()
+        # 顧客単位の同時実行数制限による 503 は Backend の障害ではない（遮断・振り分けの判断に含めない）
+        load_shed = resp.headers.get("X-Load-Shed") == "customer"
+        health_status = 200 if load_shed else resp.status_code
+        breaker.record_status(health_status)
+        router.record(
+            company_url,
+            time.monotonic() - started_at,
+            ok=health_status not in BREAKER_FAILURE_STATUSES,
         )
 
+        # 同じスレッドの次のリクエストも同じエンドポイントへ
+        response_thread_id = resp.headers.get("X-Thread-Id") or thread_id
+        if response_thread_id and len(endpoints) > 1:
+            router.remember_thread(response_thread_id, company_url)
+
         # レスポンスをそのまま返す（ストリーミング）
         def generate():
             """
@@ -308,15 +558,19 @@ def proxy(path):
             データを少しずつ返すことができる。
             これにより、大きなデータも少ないメモリで処理できる。
             """
+            relay_started_at = time.monotonic()
             try:
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        yield chunk  # 1024バイトずつクライアントに送信
+                # 届いた分をすぐ送信（SSE はイベント境界ごと、大きなレスポンスはまとめて）
+                for chunk in iter_relay(resp):
+                    yield chunk
             except GeneratorExit:
-                # クライアントが途中で切断した場合
-                pass
+                # クライアントが途中で切断した場合（ストリーミング中の Backend の処理を取り消す）
+                notify_disconnect_while_relaying()
+                if not safe:
+                    cancel_upstream(company_url, upstream_headers)
             finally:
                 resp.close()  # 接続を確実にクローズ
+                timer.add("gateway_relay", time.monotonic() - relay_started_at)
 
         # レスポンスヘッダーを透過
         response_headers = {
@@ -324,8 +578,12 @@ def proxy(path):
             "Cache-Control": "no-cache",
         }
 
-        # X-Thread-Id などの重要なヘッダーを透過
-        for header in ["X-Thread-Id"]:
+        # X-Thread-Id や圧縮関連などの重要なヘッダーを透過
+        # Server-Timing は Gateway の段階と合わせて返す（timing.py）
+        for header in [
+            "X-Thread-Id", "Content-Encoding", "Vary", "Idempotent-Replayed", "Retry-After", "Location",
+            "Server-Timing",
+        ]:
             if header in resp.headers:
                 response_headers[header] = resp.headers[header]
 
@@ -336,7 +594,23 @@ def proxy(path):
             headers=response_headers,
         )
 
+    except RequestBodyTooLarge as e:
+        # Content-Length なし（chunked）のボディが転送中に上限を超えた場合
+        logger.warning(f"リクエストボディが大きすぎます: customer={customer_id}, limit={e.limit}")
+        return error_response(
+            "リクエストが大きすぎます",
+            413,
+            f"{e.limit}バイト以内で送信してください"
+        )
+
+    except ClientDisconnected:
+        # 応答は誰にも届かない（取り消しは切断を見つけた時点で通知済み。遮断・振り分けの判断には含めない）
+        logger.info(f"クライアントが切断したため取り消し: customer={customer_id}")
+        return error_response("リクエストは取り消されました", 499)
+
     except requests.Timeout:
+        breaker.record_failure()
+        router.record(company_url, time.monotonic() - started_at, ok=False)
         logger.error(f"タイムアウト: {target_url}")
         return error_response(
             "リクエストがタイムアウトしました",
@@ -345,6 +619,8 @@ def proxy(path):
         )
 
     except requests.RequestException as e:
+        breaker.record_failure()
+        router.record(company_url, time.monotonic() - started_at, ok=False)
         logger.exception(f"転送エラー: {e}")
         return error_response(
             "サーバーへの接続に失敗しました",
@@ -0,0 +1,125 @@
+"""
+レスポンス中継モジュール
+
+Backend からのレスポンスボディを、内容に応じた方法でクライアントへ中継します。
+
+【なぜ必要か？】
+以前は iter_content(chunk_size=1024) で固定長ずつ中継していたため、
+- 1024バイト溜まるまで転送が止まる（SSE のイベントが遅れる・途中で分割される）
+- 大きなレスポンスではチャンクごとのオーバーヘッドが積み重なる
+という問題があった。
+
+【中継モード】
+- SSE（text/event-stream）: 届いた分をすぐ読み、イベント境界（空行）ごとに送信
+- 大きな非ストリーミング（Content-Length が閾値以上）: 大きなバッファでまとめて送信
+- それ以外: 届いた分をすぐ送信（チャンクが埋まるのを待たない）
+
+【圧縮について】
+圧縮は Backend だけで行う（backend/common/compression.py）。
+Gateway は圧縮済みのバイト列を展開せず、そのまま中継する。
+"""
+import os
+from typing import Iterator
+
+# ===== 設定 =====
+
+# 「届いた分をすぐ送る」モードで1回に読む最大サイズ（バイト）
+RELAY_READ_SIZE = int(os.environ.get("RELAY_READ_SIZE", str(64 * 1024)))
+
+# これ以上の Content-Length を持つレスポンスは大きなバッファで中継（バイト）
+RELAY_LARGE_BODY_THRESHOLD = int(os.environ.get("RELAY_LARGE_BODY_THRESHOLD", str(256 * 1024)))
+
+# 大きなレスポンスを中継するときのバッファサイズ（バイト）
+RELAY_LARGE_CHUNK_SIZE = int(os.environ.get("RELAY_LARGE_CHUNK_SIZE", str(256 * 1024)))
+
+# SSE のイベント区切り（LF / CRLF の両方に対応）
+_SSE_EVENT_DELIMITERS = (b"\r\n\r\n", b"\n\n")
+
+
+def iter_available(raw, max_size: int = RELAY_READ_SIZE) -> Iterator[bytes]:
+    """
+    届いた分のバイト列をすぐに返す（max_size が埋まるのを待たない）
+
+    Args:
+        raw: urllib3 のレスポンス（requests の resp.raw）
+        max_size: 1回に読む最大バイト数
+
+    Yields:
+        bytes: 受信済みのデータ（Content-Encoding は展開しない）
+    """
+    read1 = getattr(raw, "read1", None)
+    if read1 is None:
+        # 古い urllib3（read1 なし）: chunked なら HTTP チャンク単位で返される
+        yield from raw.stream(None, decode_content=False)
+        return
+
+    while True:
+        data = read1(max_size, decode_content=False)
+        if not data:
+            return
+        yield data
+
+
+def _last_event_boundary(buffer: bytearray) -> int:
+    """バッファ内の最後のイベント境界の直後の位置を返す（なければ -1）"""
+    end = -1
+    for delimiter in _SSE_EVENT_DELIMITERS:
+        index = buffer.rfind(delimiter)
+        if index != -1:
+            end = max(end, index + len(delimiter))
+    return end
+
+
+def iter_sse_events(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    受信データを SSE のイベント境界で区切って返す
+
+    完成したイベントはまとめてすぐに送信し、
+    途中までのイベントは次のデータが届くまで保持する。
+
+    Args:
+        chunks: 受信データ（任意の位置で分割されている）
+
+    Yields:
+        bytes: 1つ以上の完成したイベント
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        end = _last_event_boundary(buffer)
+        if end == -1:
+            continue
+        yield bytes(buffer[:end])
+        del buffer[:end]
+
+    # 接続終了時に残ったデータ（末尾に空行がないイベント）も送る
+    if buffer:
+        yield bytes(buffer)
+
+
+def iter_relay(resp) -> Iterator[bytes]:
+    """
+    レスポンスの種類に応じた中継モードでボディを返す
+
+    Args:
+        resp: requests のレスポンス（stream=True で取得したもの）
+
+    Yields:
+        bytes: クライアントへ送るデータ
+    """
+    content_type = resp.headers.get("Content-Type", "")
+    # 圧縮済みの SSE はイベント境界を探せないが、Backend がイベントごとにフラッシュしているので
+    # 届いた分をそのまま送ればよい（下の「それ以外」と同じ扱い）
+    encoded = "Content-Encoding" in resp.headers
+    if content_type.startswith("text/event-stream") and not encoded:
+        yield from iter_sse_events(iter_available(resp.raw))
+        return
+
+    content_length = resp.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) >= RELAY_LARGE_BODY_THRESHOLD:
+        for chunk in resp.raw.stream(RELAY_LARGE_CHUNK_SIZE, decode_content=False):
+            if chunk:
+                yield chunk
+        return
+
+    yield from iter_available(resp.raw)
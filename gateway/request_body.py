@@ -0,0 +1,120 @@
+"""
+リクエストボディ転送モジュール
+
+Gateway が受け取ったリクエストボディを、メモリに溜め込まずに Backend へ転送します。
+
+【なぜ必要か？】
+request.get_data() はボディ全体をメモリに読み込んでから転送を始めるため、
+ファイル添付などの大きなボディでは
+- リクエストごとのメモリ使用量が倍になる
+- Backend に最初の1バイトが届くまで待たされる
+という問題がある。
+
+【仕組み】
+- 小さなボディ（通常の JSON など）: 一度だけ読み込んでそのまま転送（コピーなし）
+- 大きなボディ / サイズ不明（chunked）: チャンク単位で読みながら転送
+- 最大サイズ（MAX_REQUEST_BODY_BYTES）は転送の途中でも検査し、超えたら中断
+"""
+import os
+from typing import Iterator
+
+# ===== 設定 =====
+
+# 受け付けるリクエストボディの最大サイズ（バイト）: デフォルト32MB（Cloud Run の上限）
+MAX_REQUEST_BODY_BYTES = int(os.environ.get("MAX_REQUEST_BODY_BYTES", str(32 * 1024 * 1024)))
+
+# これ以下のサイズなら一括で読み込んで転送する（バイト）: デフォルト64KB
+STREAM_BODY_THRESHOLD_BYTES = int(os.environ.get("STREAM_BODY_THRESHOLD_BYTES", str(64 * 1024)))
+
+# ストリーミング転送時に1回で読み込むサイズ（バイト）
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+class RequestBodyTooLarge(Exception):
+    """リクエストボディが上限サイズを超えた"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        super().__init__(f"リクエストボディが上限（{limit}バイト）を超えました")
+
+
+class SizedBody:
+    """
+    サイズが分かっているストリーミングボディ
+
+    requests は __len__ を持つイテラブルを受け取ると、
+    Transfer-Encoding: chunked ではなく Content-Length 付きで送信する。
+    （Backend 側で request.get_json() がそのまま使えるようにするため）
+    """
+
+    def __init__(self, chunks: Iterator[bytes], length: int):
+        self._chunks = chunks
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._chunks
+
+
+def iter_body_chunks(stream, max_bytes: int, chunk_size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    入力ストリームをチャンク単位で読み出す（上限サイズを転送中に検査）
+
+    Args:
+        stream: 入力ストリーム（request.stream）
+        max_bytes: 許可する最大バイト数
+        chunk_size: 1回で読み込むバイト数
+
+    Yields:
+        bytes: ボディのチャンク
+
+    Raises:
+        RequestBodyTooLarge: 読み込んだ合計が max_bytes を超えた場合
+    """
+    total = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        total += len(chunk)
+        if total > max_bytes:
+            raise RequestBodyTooLarge(max_bytes)
+        yield chunk
+
+
+def prepare_upstream_body(req):
+    """
+    Backend へ転送するボディを準備
+
+    Args:
+        req: Flask の request オブジェクト
+
+    Returns:
+        requests.request(data=...) にそのまま渡せる値
+        - None: ボディなし
+        - bytes: 小さなボディ（一括読み込み）
+        - SizedBody / Iterator[bytes]: ストリーミング転送
+
+    Raises:
+        RequestBodyTooLarge: Content-Length が上限を超えている場合
+    """
+    content_length = req.content_length
+    if content_length is not None and content_length > MAX_REQUEST_BODY_BYTES:
+        # 読み込む前に拒否できる（Backend に何も送らない）
+        raise RequestBodyTooLarge(MAX_REQUEST_BODY_BYTES)
+
+    is_chunked = "chunked" in req.headers.get("Transfer-Encoding", "").lower()
+    if not content_length and not is_chunked:
+        return None
+
+    # 小さなボディ: 一括で読み込んで、そのバッファをそのまま転送
+    # cache=False: Flask 側にコピーを残さない
+    if content_length is not None and content_length <= STREAM_BODY_THRESHOLD_BYTES:
+        return req.get_data(cache=False)
+
+    # 大きなボディ / サイズ不明: 読みながら転送
+    chunks = iter_body_chunks(req.stream, MAX_REQUEST_BODY_BYTES)
+    if content_length is not None:
+        return SizedBody(chunks, content_length)
+    return chunks
@@ -0,0 +1,170 @@
+"""
+リトライ・ヘッジリクエストモジュール
+
+安全なリクエスト（副作用のない GET /agents）に限り、
+- 失敗したら再試行（リトライ）
+- 応答が遅ければ並行してもう1本送信（ヘッジ）し、先に返ってきた方を使う
+ことで、遅い応答（テールレイテンシ）を減らします。
+
+【リトライ予算】
+障害中に全リクエストがリトライすると Backend への負荷が倍増する。
+そのため、リトライ・ヘッジは「通常リクエスト数 × RETRY_BUDGET_RATIO」までに制限する。
+（例: 0.1 なら、通常リクエスト10件につき追加の試行は1件まで）
+"""
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+import requests
+
+# ===== 設定 =====
+
+# 1リクエストあたりの最大試行回数（最初の1回を含む）
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "2"))
+
+# この秒数以内に応答がなければヘッジリクエストを送る
+HEDGE_DELAY_SECONDS = float(os.environ.get("HEDGE_DELAY_SECONDS", "1.0"))
+
+# リトライ予算: 通常リクエスト1件あたりに貯まる追加試行の枠
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", "0.1"))
+
+# リトライ予算の上限（貯めすぎてバースト的にリトライしないように）
+RETRY_BUDGET_MAX_TOKENS = float(os.environ.get("RETRY_BUDGET_MAX_TOKENS", "10"))
+
+# リトライ・ヘッジ対象のパス（GET のみ。Backend に転送するパスだけ。
+# Gateway 自身の /health は転送しないため含めない）
+SAFE_PATHS = frozenset({"agents"})
+
+# 再試行する価値のあるステータスコード
+RETRYABLE_STATUSES = frozenset({502, 503, 504})
+
+# ヘッジリクエスト用のスレッドプール
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("HEDGE_MAX_WORKERS", "16")),
+    thread_name_prefix="hedge",
+)
+
+
+class RetryBudget:
+    """
+    リトライ予算（トークンバケット、スレッドセーフ）
+
+    通常リクエストのたびに RETRY_BUDGET_RATIO だけトークンが貯まり、
+    リトライ・ヘッジのたびに1トークン消費する。
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, max_tokens: float = RETRY_BUDGET_MAX_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """通常リクエスト1件分の予算を追加"""
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        """追加の試行1回分の予算を消費（足りなければ False）"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+# 転送先ごとのリトライ予算
+# 形式: {company_url: RetryBudget}
+_budgets: dict[str, RetryBudget] = {}
+_budgets_lock = threading.Lock()
+
+
+def get_retry_budget(company_url: str) -> RetryBudget:
+    """転送先のリトライ予算を取得（なければ作成）"""
+    budget = _budgets.get(company_url)
+    if budget is None:
+        with _budgets_lock:
+            budget = _budgets.setdefault(company_url, RetryBudget())
+    return budget
+
+
+def is_safe_request(method: str, path: str) -> bool:
+    """リトライ・ヘッジしてよいリクエストか（副作用のない GET のみ）"""
+    return method == "GET" and path.strip("/") in SAFE_PATHS
+
+
+def _close_response(future) -> None:
+    """使われなかった試行のレスポンスを閉じる（done_callback 用）"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def hedged_request(
+    send: Callable[[], requests.Response],
+    budget: RetryBudget,
+    max_attempts: int = RETRY_MAX_ATTEMPTS,
+    hedge_delay: float = HEDGE_DELAY_SECONDS,
+) -> requests.Response:
+    """
+    ヘッジ・リトライ付きでリクエストを送信
+
+    処理の流れ:
+    1. 1本目を送信
+    2. hedge_delay 秒以内に応答がない / 失敗した場合、予算があれば追加で送信
+    3. 最初に返ってきた成功レスポンスを使い、残りは応答後に閉じる
+
+    Args:
+        send: 1回分のリクエストを送信する関数
+        budget: 転送先のリトライ予算
+        max_attempts: 最大試行回数（最初の1回を含む）
+        hedge_delay: ヘッジリクエストを送るまでの待ち時間（秒）
+
+    Returns:
+        requests.Response: 採用したレスポンス（すべて失敗した場合は最後の失敗レスポンス）
+
+    Raises:
+        requests.RequestException: すべての試行が例外で終わった場合
+    """
+    futures = [_executor.submit(send)]
+    pending = set(futures)
+    can_retry = True
+    last_response = None
+    last_error = None
+
+    while pending:
+        retry_allowed = can_retry and len(futures) < max_attempts
+        done, pending = wait(
+            pending,
+            timeout=hedge_delay if retry_allowed else None,
+            return_when=FIRST_COMPLETED,
+        )
+
+        for future in done:
+            try:
+                resp = future.result()
+            except requests.RequestException as e:
+                last_error = e
+                continue
+
+            if last_response is not None:
+                last_response.close()
+            if resp.status_code not in RETRYABLE_STATUSES:
+                # 採用: 残りの試行は応答が来たら閉じる
+                for other in pending:
+                    other.add_done_callback(_close_response)
+                return resp
+            last_response = resp
+
+        # 応答が遅い（done が空）か失敗した: 予算があればもう1本送る
+        if retry_allowed:
+            if budget.try_spend():
+                future = _executor.submit(send)
+                futures.append(future)
+                pending.add(future)
+            else:
+                can_retry = False
+
+    if last_response is not None:
+        return last_response
+    raise last_error
@@ -0,0 +1,228 @@
+"""
+エンドポイント選択モジュール
+
+1つの顧客に複数の転送先（リージョン・リビジョン違いの Backend）がある場合に、
+どのエンドポイントへ転送するかを決めます。
+
+【選択のルール】
+1. 同じ thread_id のリクエストは同じエンドポイントへ（スティッキー）
+   → チェックポイントのキャッシュが効きやすい
+2. 新しい会話は、重みと実測値（EWMA のレイテンシ・エラー率）で選ぶ
+   → 重み付きランダムで2つ選び、スコアの良い方を使う（Power of Two Choices）
+3. 失敗が続くエンドポイントは一定時間除外（アウトライア除外）
+   → ただし全滅した場合は除外を無視して全エンドポイントから選ぶ
+4. サーキットブレーカーが遮断中のエンドポイントには送らない（スティッキーな thread_id も含む）
+   → 全エンドポイントが遮断中の場合だけ、選べない（Gateway は 503 を返す）
+
+【EWMA（指数移動平均）とは？】
+新しい値ほど重視する平均。ewma = α × 今回の値 + (1 - α) × 前回の ewma
+過去の全データを保存せずに「最近の傾向」を追跡できる。
+"""
+import hashlib
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# ===== 設定 =====
+
+# EWMA の平滑化係数（大きいほど最新の値に敏感）
+ROUTING_EWMA_ALPHA = float(os.environ.get("ROUTING_EWMA_ALPHA", "0.2"))
+
+# スコア計算でエラー率にかける重み（エラー率 100% でレイテンシ (1 + この値) 倍扱い）
+ROUTING_ERROR_PENALTY = float(os.environ.get("ROUTING_ERROR_PENALTY", "10"))
+
+# 何回連続で失敗したら除外するか
+EJECT_CONSECUTIVE_FAILURES = int(os.environ.get("EJECT_CONSECUTIVE_FAILURES", "5"))
+
+# EWMA のエラー率がこれを超えたら除外
+EJECT_ERROR_RATE = float(os.environ.get("EJECT_ERROR_RATE", "0.5"))
+
+# 除外する秒数
+EJECT_SECONDS = float(os.environ.get("EJECT_SECONDS", "30"))
+
+# thread_id → エンドポイントの対応を覚えておく最大件数
+STICKY_THREADS_MAX = int(os.environ.get("STICKY_THREADS_MAX", "10000"))
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """転送先エンドポイント"""
+    url: str
+    weight: float = 1.0
+
+
+class EndpointStats:
+    """1つのエンドポイントの実測値"""
+
+    def __init__(self):
+        self.ewma_latency = None  # 秒（まだ計測していなければ None）
+        self.ewma_error = 0.0     # 0.0〜1.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def score(self) -> float:
+        """小さいほど良いスコア（未計測のエンドポイントは優先して試す）"""
+        if self.ewma_latency is None:
+            return 0.0
+        return self.ewma_latency * (1 + ROUTING_ERROR_PENALTY * self.ewma_error)
+
+
+def _rendezvous_weight(thread_id: str, endpoint: Endpoint) -> float:
+    """
+    thread_id とエンドポイントの組み合わせごとの重み（Rendezvous Hashing）
+
+    エンドポイントが増減しても、大部分の thread_id は同じエンドポイントに割り当てられ続ける。
+    """
+    digest = hashlib.sha256(f"{thread_id}|{endpoint.url}".encode()).digest()
+    # 0 < h <= 1 の一様乱数に変換し、重み付きで比較できる形にする
+    h = (int.from_bytes(digest[:8], "big") + 1) / 2**64
+    return h ** (1 / endpoint.weight)
+
+
+class EndpointRouter:
+    """エンドポイントの選択と実測値の記録（スレッドセーフ）"""
+
+    def __init__(self):
+        self._stats: dict[str, EndpointStats] = {}
+        self._sticky: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_stats(self, url: str) -> EndpointStats:
+        stats = self._stats.get(url)
+        if stats is None:
+            stats = self._stats[url] = EndpointStats()
+        return stats
+
+    def select(self, endpoints: list[Endpoint], thread_id: str = None,
+               is_available: Callable[[str], bool] = None) -> Endpoint | None:
+        """
+        転送先エンドポイントを選ぶ
+
+        Args:
+            endpoints: 顧客のエンドポイント一覧（1件以上）
+            thread_id: 会話スレッドID（あればスティッキーに振り分ける）
+            is_available: URL を受け取り、転送してよいかを返す関数（サーキットブレーカーの状態）
+                False のエンドポイントは、スティッキーな thread_id の転送先でも選ばない
+
+        Returns:
+            Endpoint: 選ばれたエンドポイント（転送できるエンドポイントがなければ None）
+        """
+        if is_available is not None:
+            endpoints = [e for e in endpoints if is_available(e.url)]
+        if len(endpoints) <= 1:
+            return endpoints[0] if endpoints else None
+
+        now = time.monotonic()
+        with self._lock:
+            healthy = [e for e in endpoints if self._get_stats(e.url).ejected_until <= now]
+            # 全滅している場合は除外を無視（どこにも送れないよりはまし）
+            candidates = healthy or endpoints
+
+            if thread_id:
+                sticky_url = self._sticky.get(thread_id)
+                for endpoint in candidates:
+                    if endpoint.url == sticky_url:
+                        self._sticky.move_to_end(thread_id)
+                        return endpoint
+                return max(candidates, key=lambda e: _rendezvous_weight(thread_id, e))
+
+            if len(candidates) == 1:
+                return candidates[0]
+            first, second = random.choices(candidates, weights=[e.weight for e in candidates], k=2)
+            return min(first, second, key=lambda e: self._get_stats(e.url).score())
+
+    def remember_thread(self, thread_id: str, url: str) -> None:
+        """thread_id をエンドポイントに紐付ける（以降の同じスレッドは同じ転送先へ）"""
+        with self._lock:
+            self._sticky[thread_id] = url
+            self._sticky.move_to_end(thread_id)
+            while len(self._sticky) > STICKY_THREADS_MAX:
+                self._sticky.popitem(last=False)
+
+    def record(self, url: str, latency: float, ok: bool) -> None:
+        """
+        転送結果を記録
+
+        Args:
+            url: エンドポイントの URL
+            latency: 応答ヘッダーを受け取るまでの秒数
+            ok: 成功したか
+        """
+        with self._lock:
+            stats = self._get_stats(url)
+            if stats.ewma_latency is None:
+                stats.ewma_latency = latency
+            else:
+                stats.ewma_latency += ROUTING_EWMA_ALPHA * (latency - stats.ewma_latency)
+            stats.ewma_error += ROUTING_EWMA_ALPHA * ((0.0 if ok else 1.0) - stats.ewma_error)
+
+            if ok:
+                stats.consecutive_failures = 0
+                return
+
+            stats.consecutive_failures += 1
+            if (stats.consecutive_failures >= EJECT_CONSECUTIVE_FAILURES
+                    or stats.ewma_error > EJECT_ERROR_RATE):
+                # エラー率・連続失敗数はリセットしない（復帰後の最初の転送が失敗したら、すぐに再び除外する。
+                # 成功すれば連続失敗数は 0 に戻り、エラー率も下がっていく）
+                stats.ejected_until = time.monotonic() + EJECT_SECONDS
+
+
+# アプリ全体で共有するルーター
+router = EndpointRouter()
+
+
+def parse_endpoints(data: dict) -> list[Endpoint]:
+    """
+    顧客ドキュメントからエンドポイント一覧を取り出す
+
+    Firestore 構造:
+        customers/{customer_id}
+        ├── cloud_functions_url: "https://..."       （単一エンドポイント: 従来の形式）
+        └── endpoints: [                              （複数エンドポイント: 任意）
+              {"url": "https://...", "weight": 2},
+              "https://...",                          （文字列だけなら weight=1）
+            ]
+
+    weight が未設定・null なら 1。不正な項目（URL がない・weight が正の数でない）は
+    警告を出して読み飛ばす（残りのエンドポイントと cloud_functions_url は使う）。
+
+    Returns:
+        list[Endpoint]: エンドポイント一覧（設定がなければ空リスト）
+    """
+    items = data.get("endpoints") or []
+    if not isinstance(items, list):
+        logger.warning(f"endpoints がリストではないため無視します: {items!r}")
+        items = []
+
+    endpoints = []
+    for item in items:
+        if isinstance(item, str) and item:
+            endpoints.append(Endpoint(url=item))
+            continue
+        if not (isinstance(item, dict) and isinstance(item.get("url"), str) and item["url"]):
+            logger.warning(f"エンドポイントの設定が不正なため読み飛ばします: {item!r}")
+            continue
+        raw_weight = item.get("weight")
+        try:
+            if isinstance(raw_weight, bool):
+                raise ValueError(raw_weight)
+            weight = 1.0 if raw_weight is None else float(raw_weight)
+        except (TypeError, ValueError):
+            weight = math.nan
+        if not (math.isfinite(weight) and weight > 0):
+            logger.warning(f"エンドポイントの weight が不正なため読み飛ばします: {item!r}")
+            continue
+        endpoints.append(Endpoint(url=item["url"], weight=weight))
+
+    if not endpoints and data.get("cloud_functions_url"):
+        endpoints.append(Endpoint(url=data["cloud_functions_url"]))
+    return endpoints
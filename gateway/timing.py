@@ -0,0 +1,248 @@
+"""
+Gateway の段階ごとの処理時間の計測
+
+リクエストが遅かったとき、Gateway（認証・アドミッション制御・転送先の取得・Backend の応答待ち）と
+Backend のどちらで時間を使ったのかを見分けるためのモジュールです。
+
+【出力先】
+- Server-Timing レスポンスヘッダー: Gateway の段階の後に Backend の Server-Timing を続ける
+  例: Server-Timing: gateway_auth;dur=35.2, gateway_upstream;dur=2430.1, gateway_total;dur=2470.0,
+      auth;dur=0.1, llm;dur=2310.5, total;dur=2402.3
+- ログ: レスポンスを送り終えたら「処理時間: path=/chat status=200 gateway_auth=35.2ms ...」を出力する
+- ヒストグラム: 顧客・段階ごとの p50 / p95 / p99（Gateway の GET /metrics の "timing"）
+
+【段階】
+- gateway_auth: Firebase トークンの検証・Custom Claims の取得
+- gateway_admission: Gateway でのレート制限
+- gateway_routing: 転送先のエンドポイントの取得（Firestore・キャッシュ）
+- gateway_upstream: Backend に転送してから応答ヘッダーが届くまで
+- gateway_relay: 応答のボディの中継（ヘッダーを送った後のためログとヒストグラムのみ）
+- total {パス}: Gateway が受け付けてから応答を送り終えるまで
+
+ヒストグラムの仕組みは Backend の common/timing.py と同じ（対数バケット・インスタンスごとの累計）。
+"""
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import Flask, g, request
+
+logger = logging.getLogger(__name__)
+
+# ===== 設定 =====
+
+# 段階ごとの処理時間を Server-Timing レスポンスヘッダーで返すか（false: ログとメトリクスのみ）
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "true").lower() == "true"
+
+# ヒストグラムのバケット: 0.1ms から約 1 時間まで、隣との比 2 ** (1/8)（誤差 約 9% 以内）
+_BUCKET_MIN_MS = 0.1
+_BUCKET_GROWTH = 2 ** 0.125
+_BUCKET_BOUNDS = [_BUCKET_MIN_MS * _BUCKET_GROWTH ** i for i in range(202)]
+
+# 記録する顧客数の上限（超えたら最も長く記録のない顧客から消す）
+_MAX_CUSTOMERS = 1000
+
+# 全顧客の合計を記録するキー
+ALL_CUSTOMERS = "*"
+
+PERCENTILES = (50, 95, 99)
+
+# ヒストグラムの total をパスごとに分ける（それ以外のパスは /other にまとめる）
+_TIMED_PATHS = frozenset({"chat", "chat/batch", "chat/cancel", "jobs", "agents"})
+
+
+def route_label(path: str) -> str:
+    """ヒストグラムの total に使うパスの名前（ID を含むパスはまとめる）"""
+    path = path.strip("/")
+    if path.startswith("jobs/"):
+        return "/jobs/<job_id>"
+    return f"/{path}" if path in _TIMED_PATHS else "/other"
+
+
+class Histogram:
+    """処理時間（ミリ秒）の対数バケットのヒストグラム（TimingStats のロックの中で使う）"""
+
+    def __init__(self):
+        self._buckets: dict[int, int] = {}   # {バケットの番号: 件数}
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float) -> None:
+        index = min(bisect.bisect_left(_BUCKET_BOUNDS, ms), len(_BUCKET_BOUNDS) - 1)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        """p パーセンタイル（そのバケットの上限。最大値は超えない）"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(_BUCKET_BOUNDS[index], self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        result = {"count": self.count}
+        for p in PERCENTILES:
+            result[f"p{p}_ms"] = round(self.percentile(p), 1)
+        result["avg_ms"] = round(self.sum_ms / self.count, 1) if self.count else 0.0
+        result["max_ms"] = round(self.max_ms, 1)
+        return result
+
+
+class TimingStats:
+    """顧客・段階ごとのヒストグラム（スレッドセーフ）"""
+
+    def __init__(self, max_customers: int = _MAX_CUSTOMERS):
+        self.max_customers = max_customers
+        self._histograms: OrderedDict[str, dict[str, Histogram]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, customer_id: str, durations: dict[str, float]) -> None:
+        """1リクエスト分の {段階: 時間（ミリ秒）} を記録"""
+        with self._lock:
+            for key in (customer_id, ALL_CUSTOMERS):
+                stages = self._histograms.get(key)
+                if stages is None:
+                    stages = self._histograms[key] = {}
+                self._histograms.move_to_end(key)
+                for stage, ms in durations.items():
+                    histogram = stages.get(stage)
+                    if histogram is None:
+                        histogram = stages[stage] = Histogram()
+                    histogram.record(ms)
+            while len(self._histograms) > self.max_customers + 1:
+                oldest = next(key for key in self._histograms if key != ALL_CUSTOMERS)
+                del self._histograms[oldest]
+
+    def stats(self) -> dict:
+        """{顧客ID: {段階: {"count", "p50_ms", "p95_ms", "p99_ms", "avg_ms", "max_ms"}}}（"*" は全顧客）"""
+        with self._lock:
+            return {
+                customer_id: {stage: histogram.summary() for stage, histogram in sorted(stages.items())}
+                for customer_id, stages in self._histograms.items()
+            }
+
+
+_stats = TimingStats()
+
+
+def get_timing_stats() -> dict:
+    """顧客・段階ごとの処理時間のパーセンタイル"""
+    return _stats.stats()
+
+
+class RequestTimer:
+    """1リクエストの段階ごとの処理時間（ミリ秒）"""
+
+    def __init__(self):
+        self.customer_id: str | None = None
+        self.started_at = time.monotonic()
+        self._durations: dict[str, float] = {}   # 記録した順
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._durations[stage] = self._durations.get(stage, 0.0) + seconds * 1000
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ブロックの実行時間を name の段階に加える（例外で抜けた場合も記録する）"""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started_at)
+
+    def durations(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._durations)
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started_at) * 1000
+
+
+def request_timer() -> RequestTimer:
+    """実行中のリクエストのタイマー"""
+    timer = g.get("request_timer")
+    if timer is None:
+        timer = g.request_timer = RequestTimer()
+    return timer
+
+
+# ===== Flask への組み込み =====
+
+def _start_request_timer() -> None:
+    """リクエストごとのタイマーを作成（before_request フック）"""
+    g.request_timer = RequestTimer()
+
+
+def _finish_request_timer(response):
+    """
+    Server-Timing ヘッダーを付け、レスポンスを送り終えたら記録する（after_request フック）
+
+    Backend の Server-Timing（転送した応答のヘッダー）があれば、Gateway の段階の後に続ける。
+    """
+    timer = g.get("request_timer")
+    if timer is None:
+        return response
+
+    if SERVER_TIMING_ENABLED:
+        entries = [f"{stage};dur={ms:.1f}" for stage, ms in timer.durations().items()]
+        entries.append(f"gateway_total;dur={timer.elapsed_ms():.1f}")
+        if response.headers.get("Server-Timing"):
+            entries.append(response.headers["Server-Timing"])
+        response.headers["Server-Timing"] = ", ".join(entries)
+    else:
+        response.headers.pop("Server-Timing", None)
+
+    method, path, status = request.method, request.path, response.status_code
+    total_stage = f"total {route_label(path)}"
+
+    def log_timing() -> None:
+        if timer.customer_id is None:
+            # 認証前に終わったリクエスト（/health・CORS プリフライト・認証エラー）は記録しない
+            return
+        durations = timer.durations()
+        total_ms = timer.elapsed_ms()
+        _stats.record(timer.customer_id, {**durations, total_stage: total_ms})
+        fields = " ".join(f"{stage}={ms:.1f}ms" for stage, ms in durations.items())
+        logger.info(
+            f"処理時間: method={method} path={path} status={status} "
+            f"customer_id={timer.customer_id} total={total_ms:.1f}ms {fields}".rstrip(),
+            extra={"json_fields": {
+                "method": method,
+                "path": path,
+                "status": status,
+                "customer_id": timer.customer_id,
+                "total_ms": round(total_ms, 1),
+                "timing_ms": {stage: round(ms, 1) for stage, ms in durations.items()},
+            }},
+        )
+
+    # ストリーミングの中継は、送り終えた時点（close）で記録する
+    response.call_on_close(log_timing)
+    return response
+
+
+def setup_timing(app: Flask) -> None:
+    """
+    Flaskアプリに処理時間の計測を適用
+
+    Args:
+        app: Flaskアプリケーションインスタンス
+    """
+    app.before_request(_start_request_timer)
+    app.after_request(_finish_request_timer)